@@ -0,0 +1,369 @@
+"""
+Load generation benchmark: starts the server in each mode, drives a mix of logins, score posts and high score
+list requests from many concurrent keep-alive clients and reports the throughput and latency percentiles.
+The results are printed and saved as JSON to compare releases.
+
+    python bench.py [--modes forked threaded] [--mix login=1,score=8,highscorelist=1] [-o results.json]
+
+Every mode runs with and without --store_tokens unless --tokens is given. The client random generators are
+seeded (--seed), so two runs send the same requests in the same order per client.
+"""
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import random
+import socket
+import urllib
+import httplib
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+
+SERVER_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_server.py')
+
+MODES = {
+    'forked': [],
+    'threaded': ['--threaded'],
+    'event_loop': ['--event_loop'],
+    'prefork': ['--prefork', str(multiprocessing.cpu_count())],
+    'shm_levels': ['--shm_levels'],
+}
+DEFAULT_MODES = ['forked', 'threaded']
+OPERATIONS = ('login', 'score', 'highscorelist')
+DEFAULT_MIX = 'login=1,score=8,highscorelist=1'
+PERCENTILES = (50, 99, 99.9)
+
+
+def parse_mix(mix):
+    """
+    'login=1,score=8' -> [('login', 1.0), ('score', 8.0)]
+    """
+    weights = []
+    for item in mix.split(','):
+        name, _sep, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('unknown operation %r, expected one of %s' % (name, OPERATIONS))
+        try:
+            weights.append((name, float(weight or 1)))
+        except ValueError:
+            raise argparse.ArgumentTypeError('bad weight %r' % weight)
+    if not sum(w for _name, w in weights) > 0:
+        raise argparse.ArgumentTypeError('the mix needs a positive weight')
+    return weights
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest rank percentile of an already sorted list, None if it's empty
+    """
+    if not sorted_values:
+        return None
+    rank = int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+def summarize(latencies, errors, elapsed):
+    """
+    Throughput (requests per second) and latency percentiles (milliseconds) of a list of latencies (seconds)
+    """
+    latencies = sorted(latencies)
+    summary = {'requests': len(latencies),
+               'errors': errors,
+               'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0.0}
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        summary['p%s_ms' % str(p).replace('.', '')] = round(value * 1000, 3) if value is not None else None
+    return summary
+
+
+class _Client(object):
+    """
+    One keep-alive connection playing a user: logs in, then sends the requests picked from the mix
+    """
+    def __init__(self, port, user_id, levels, max_score, mix, seed):
+        self.port = port
+        self.user_id = user_id
+        self.levels = levels
+        self.max_score = max_score
+        self.random = random.Random(seed)
+        self.choices = []
+        total = 0.0
+        for name, weight in mix:
+            total += weight
+            self.choices.append((total, name))
+        self.total = total
+        self.conn = None
+        self.session_key = None
+
+    def _request(self, method, path, body=None):
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = httplib.HTTPConnection('localhost', self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body)
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.getheader('connection', '').lower() == 'close':
+                    self.close()
+                return response.status, data
+            except (httplib.HTTPException, socket.error):
+                # the server closed the kept alive connection (idle timeout, max requests), retried once
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def login(self):
+        status, data = self._request('GET', '/%s/login' % self.user_id)
+        if status == 200:
+            self.session_key = urllib.quote(data)  # base64 tokens, ending with a new line
+        return status == 200
+
+    def score(self):
+        level_id = self.random.randint(1, self.levels)
+        status, _data = self._request('POST', '/%s/score?sessionkey=%s' % (level_id, self.session_key),
+                                      str(self.random.randint(0, self.max_score)))
+        return status == 204
+
+    def highscorelist(self):
+        status, _data = self._request('GET', '/%s/highscorelist' % self.random.randint(1, self.levels))
+        return status == 200
+
+    def next_operation(self):
+        value = self.random.random() * self.total
+        for limit, name in self.choices:
+            if value < limit:
+                return name
+        return self.choices[-1][1]
+
+
+def _run_clients(port, first_client, num_clients, args, start_at, measure_at, stop_at, results):
+    """
+    Client process: runs num_clients client threads and puts its latencies in the results queue
+    """
+    latencies = dict((name, []) for name in OPERATIONS)
+    errors = dict((name, 0) for name in OPERATIONS)
+    lock = threading.Lock()
+
+    def client_loop(index):
+        client = _Client(port, args.first_user + index, args.levels, args.max_score, args.mix, args.seed + index)
+        local = dict((name, []) for name in OPERATIONS)
+        local_errors = dict((name, 0) for name in OPERATIONS)
+        try:
+            while time.time() < start_at:
+                time.sleep(0.001)
+            try:
+                client.login()
+            except (httplib.HTTPException, socket.error):
+                pass
+            while True:
+                name = client.next_operation()
+                begin = time.time()
+                if begin >= stop_at:
+                    break
+                try:
+                    ok = getattr(client, name)()
+                except (httplib.HTTPException, socket.error):
+                    ok = False
+                end = time.time()
+                if begin >= measure_at:
+                    local[name].append(end - begin)
+                    if not ok:
+                        local_errors[name] += 1
+        finally:
+            client.close()
+        with lock:
+            for name in OPERATIONS:
+                latencies[name].extend(local[name])
+                errors[name] += local_errors[name]
+
+    threads = [threading.Thread(target=client_loop, args=(first_client + i,)) for i in xrange(num_clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((latencies, errors))
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return True
+        except socket.error as e:
+            if e.args[0] != errno.ECONNREFUSED:
+                raise
+            time.sleep(0.05)
+    return False
+
+
+def stop_server(server, timeout=10):
+    """
+    Interrupt the server (as Ctrl-C would) so it stops its sync managers and children, kill its whole process
+    group if it did not exit after timeout seconds. The server must be the leader of its own process group
+    """
+    server.send_signal(signal.SIGINT)
+    deadline = time.time() + timeout
+    while server.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    try:
+        os.killpg(server.pid, signal.SIGKILL)  # also the processes left by the server
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+    server.wait()
+
+
+def run_benchmark(mode, store_tokens, args):
+    """
+    Start the server, run the clients against it and return the results of the run
+    """
+    server_args = [sys.executable, SERVER_MAIN, '-p', str(args.port), '--logfile', args.logfile,
+                   '--log_sample', str(args.log_sample)] + MODES[mode]
+    if store_tokens:
+        server_args.append('--store_tokens')
+    server_args.extend(args.server_args)
+    server = subprocess.Popen(server_args, preexec_fn=os.setsid)  # own process group, see stop_server
+    try:
+        if not wait_for_port(args.port):
+            raise RuntimeError('the server (%s) did not start listening on port %s' % (' '.join(server_args),
+                                                                                       args.port))
+        results = multiprocessing.Queue()
+        start_at = time.time() + 0.5  # every client process started
+        measure_at = start_at + args.warmup
+        stop_at = measure_at + args.duration
+        processes = []
+        per_process = [args.clients // args.client_procs + (i < args.clients % args.client_procs)
+                       for i in xrange(args.client_procs)]
+        first = 0
+        for num_clients in per_process:
+            if num_clients:
+                p = multiprocessing.Process(target=_run_clients, args=(args.port, first, num_clients, args,
+                                                                       start_at, measure_at, stop_at, results))
+                p.start()
+                processes.append(p)
+            first += num_clients
+
+        latencies = dict((name, []) for name in OPERATIONS)
+        errors = dict((name, 0) for name in OPERATIONS)
+        for _p in processes:
+            process_latencies, process_errors = results.get()
+            for name in OPERATIONS:
+                latencies[name].extend(process_latencies[name])
+                errors[name] += process_errors[name]
+        for p in processes:
+            p.join()
+    finally:
+        stop_server(server)
+
+    all_latencies = [l for name in OPERATIONS for l in latencies[name]]
+    result = {'mode': mode,
+              'store_tokens': store_tokens,
+              'server_args': server_args[2:],
+              'total': summarize(all_latencies, sum(errors.values()), args.duration),
+              'operations': dict((name, summarize(latencies[name], errors[name], args.duration))
+                                 for name, _weight in args.mix)}
+    return result
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(SERVER_MAIN),
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_result(result):
+    total = result['total']
+    print '%-12s %-13s %9.1f req/s  p50 %8s ms  p99 %8s ms  p999 %8s ms  errors %s' % (
+        result['mode'], 'store_tokens' if result['store_tokens'] else 'signed_tokens', total['throughput'],
+        total['p50_ms'], total['p99_ms'], total['p999_ms'], total['errors'])
+    for name in sorted(result['operations']):
+        op = result['operations'][name]
+        print '    %-22s %9.1f req/s  p50 %8s ms  p99 %8s ms  p999 %8s ms  errors %s' % (
+            name, op['throughput'], op['p50_ms'], op['p99_ms'], op['p999_ms'], op['errors'])
+
+
+def get_parameters(argv=None):
+    parser = argparse.ArgumentParser(description='Load generation benchmark of the server modes')
+    parser.add_argument('--modes', nargs='+', choices=sorted(MODES), default=DEFAULT_MODES,
+                        help='Server modes to benchmark [default: %s]' % ' '.join(DEFAULT_MODES))
+    parser.add_argument('--tokens', choices=('both', 'stored', 'signed'), default='both',
+                        help='Run every mode with --store_tokens (stored), without it (signed) or both '
+                             '[default: %(default)s]')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='Relative weights of the operations [default: %s]' % DEFAULT_MIX)
+    parser.add_argument('-c', '--clients', type=int, default=32,
+                        help='Concurrent clients, each one a user with a keep-alive connection '
+                             '[default: %(default)s]')
+    parser.add_argument('--client_procs', type=int, default=max(1, multiprocessing.cpu_count() // 2),
+                        help='Processes running the client threads [default: %(default)s]')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='Measured seconds per run [default: %(default)s]')
+    parser.add_argument('--warmup', type=float, default=1,
+                        help='Seconds of requests sent before measuring [default: %(default)s]')
+    parser.add_argument('--levels', type=int, default=100,
+                        help='Levels the scores are posted to and read from [default: %(default)s]')
+    parser.add_argument('--max_score', type=int, default=100000,
+                        help='Scores are random between 0 and this value [default: %(default)s]')
+    parser.add_argument('--first_user', type=int, default=1,
+                        help='User id of the first client [default: %(default)s]')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the first client random generator [default: %(default)s]')
+    parser.add_argument('-p', '--port', type=int, default=8090,
+                        help='Port of the benchmarked servers [default: %(default)s]')
+    parser.add_argument('--log_sample', type=float, default=0,
+                        help='--log_sample of the benchmarked servers [default: %(default)s]')
+    parser.add_argument('--logfile', default=os.path.join(tempfile.gettempdir(), 'bench_server.log'),
+                        help='--logfile of the benchmarked servers [default: %(default)s]')
+    parser.add_argument('-o', '--output',
+                        help='JSON file where the results are saved [default: results are only printed]')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER,
+                        help='Extra arguments for every server, after --')
+    args = parser.parse_args(argv)
+    if args.server_args and args.server_args[0] == '--':
+        args.server_args = args.server_args[1:]
+    args.client_procs = max(1, min(args.client_procs, args.clients))
+    return args
+
+
+def main(argv=None):
+    args = get_parameters(argv)
+    token_modes = {'both': [False, True], 'stored': [True], 'signed': [False]}[args.tokens]
+    report = {'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'revision': _git_revision(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'cpus': multiprocessing.cpu_count(),
+              'parameters': {'clients': args.clients, 'client_procs': args.client_procs,
+                             'duration': args.duration, 'warmup': args.warmup, 'levels': args.levels,
+                             'max_score': args.max_score, 'seed': args.seed, 'mix': dict(args.mix),
+                             'log_sample': args.log_sample, 'server_args': args.server_args},
+              'runs': []}
+    for mode in args.modes:
+        for store_tokens in token_modes:
+            result = run_benchmark(mode, store_tokens, args)
+            print_result(result)
+            report['runs'].append(result)
+            if args.output:
+                # saved after every run, so an interrupted benchmark keeps the finished runs
+                with open(args.output, 'w') as f:
+                    json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+if __name__ == '__main__':
+    main()
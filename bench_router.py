@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of the per request routing cost: the compiled router (urls.Urls) vs the previous
+regex scan (every pattern tried in turn, urlparse and parse_qs on every request)
+
+    python bench_router.py [-n NUMBER]
+"""
+import re
+import timeit
+import argparse
+import urllib2
+
+from urls import Urls
+from views import LoginView, ScoreView, BatchScoreView, HighestScoreView, BatchHighestScoreView
+
+PATHS = ['/4711/login',
+         '/2/score?sessionkey=UICJDNKFT3GWBFUIGUSV6Q3NQM',
+         '/scores?sessionkey=UICJDNKFT3GWBFUIGUSV6Q3NQM',
+         '/2/highscorelist',
+         '/highscorelists?levels=1,2,3',
+         '/not/found']
+
+
+class RegexUrls(object):
+    """
+    Router before the trie (views still get the parsed query params, as it used to)
+    """
+    def __init__(self):
+        urls = [
+            ('^/(?P<user_id>\d+)/login/?$', LoginView),
+            ('^/(?P<level_id>\d+)/score/?$', ScoreView),
+            ('^/scores/?$', BatchScoreView),
+            ('^/(?P<level_id>\d+)/highscorelist/?$', HighestScoreView),
+            ('^/highscorelists/?$', BatchHighestScoreView)
+        ]
+        self.urls = [(re.compile(r), c) for r, c in urls]
+
+    def match(self, url):
+        parsed = urllib2.urlparse.urlparse(url)
+
+        for regex, klass in self.urls:
+            res = regex.match(parsed.path)
+            if res:
+                kwargs = res.groupdict()
+                view = klass(query_string=parsed.query, **kwargs)
+                view.query_params  # eagerly parsed
+                return view
+
+        return None
+
+
+def bench(router, number):
+    def run():
+        for path in PATHS:
+            router.match(path)
+    return min(timeit.repeat(run, number=number, repeat=3)) / (number * len(PATHS))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Routing micro-benchmark')
+    parser.add_argument('-n', '--number', type=int, default=20000,
+                        help='Iterations over the sample paths [default: %(default)s]')
+    args = parser.parse_args()
+
+    for name, router in [('regex scan', RegexUrls()), ('compiled trie', Urls())]:
+        print '%-14s %.2f us per request' % (name, bench(router, args.number) * 1e6)
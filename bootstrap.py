@@ -1,24 +1,124 @@
+import os
+
 # poor man's dependency injection
 singletons = {'users': None,
               'levels': None,
+              'highscores_cache': None,
+              'metrics': None,
+              'score_queue': None,
+              'ranks': None,
               'server': None}
 
 
 def init_singletons(settings):
     """
     Create storage singletons 
-    if the server is multiprocess (actually creates a local sync manager for users and another for levels)
+    if the server is multiprocess, forked per request or pre-forked (actually creates a local sync manager
+    for users and another for levels)
     if the server is multithreaded dictionaries are directly shared using threading.locks to protect them
     if the users are 'non-stored' the tokens are signed using sha1 (they contain the user_id and the timeout)
     and no memory container is created to hold them.
+    if compact_tokens is set the stored tokens are kept in a shared memory map instead of a sync manager.
+    if shm_levels is set the levels are kept in a shared memory map instead of a sync manager,
+    otherwise if store_shards is more than 1 the levels are spread over that many stores by level id
+    (a sync manager process each when forked).
+    The request, lock and sync manager metrics (see /metrics) are kept in shared memory counters when forked.
+    The rendered high score lists are cached in the levels sync manager (in the manager of the shard
+    of each level if store_shards is more than 1, or a local dictionary if there is no sync manager).
+    When forked, the local_cache most recently used lists are also cached in each process, so unchanged lists
+    are served without a manager round trip.
+    if wal is set the stores are recovered from that log and every change is logged to it
+    (the saved scores and, if store_tokens is set, the logins).
+    if rank_index is set every score is also saved in a rank index (in its own sync manager when forked)
+    answering the rank of any user of a level, it starts with the top scores recovered from the log.
+    if async_scores is set the score posts are answered once queued and a background thread saves them
+    in batches (after the log, if wal is set, so a score is logged when it's applied).
+    if snapshot is set the stores start from that snapshot (memory mapped, read lazily) before replaying
+    the log, and a new snapshot is written every snapshot_interval seconds and on SIGUSR1.
     """
     # import inside the method to avoid circular dependencies (otherwise we
     # would need a new module with only the dictionary)
-    from storage import Levels, UsersStored
+    from storage import (Levels, ShardedLevels, LevelsDict, ShardedLevelsDict, UsersStored, CountingProxy,
+                         StorageManager, close_proxy_connections)
+    from ranks import RankIndex, RankedLevels
+    from metrics import Metrics
+    from urls import ROUTES
+    from shm_levels import SharedMemoryLevels
+    from cache import RenderCache, LocalRenderCache
     from server import server_factory
     from users import UsersNonStored
+    from compact_users import CompactUsersStored
+    from wal import ScoreLog, DurableLevels, DurableUsers, recover
+    from snapshot import Snapshot, SnapshotWriter
+    from ingest import ScoreQueue
+
+    # the event loop server runs in a single thread of a single process
+    forked = not settings.event_loop and (settings.prefork or not settings.threaded)
+    if settings.store_tokens and settings.compact_tokens:
+        singletons['users'] = CompactUsersStored(forked, max_users=settings.max_users)
+    elif settings.store_tokens:
+        singletons['users'] = UsersStored(forked)
+    else:
+        singletons['users'] = UsersNonStored(settings.token_cache)
+    if settings.shm_levels:
+        singletons['levels'] = SharedMemoryLevels(forked, max_levels=settings.max_levels,
+                                                  lock_stripes=settings.lock_stripes, top_scores=settings.top_scores)
+    elif settings.store_shards > 1:
+        singletons['levels'] = ShardedLevels(settings.store_shards, forked, lock_stripes=settings.lock_stripes,
+                                             top_scores=settings.top_scores)
+    else:
+        singletons['levels'] = Levels(forked, lock_stripes=settings.lock_stripes, top_scores=settings.top_scores)
+    singletons['metrics'] = Metrics([view.__name__ for _route, view in ROUTES], forked)
+    for store in getattr(singletons['levels'], 'shards', [singletons['levels']]):
+        store.locks.set_metrics(singletons['metrics'])
+    CountingProxy.metrics = singletons['metrics']
+    manager = getattr(singletons['levels'], 'manager', None)
+    if manager is None:
+        cache_entries = LevelsDict()
+    elif isinstance(singletons['levels'], ShardedLevels):
+        cache_entries = ShardedLevelsDict(singletons['levels'])
+    else:
+        cache_entries = manager.LevelsDict()
+    if forked and settings.local_cache:
+        shared_cache = RenderCache(cache_entries, forked) if manager else None
+        singletons['highscores_cache'] = LocalRenderCache(shared_cache, settings.local_cache, forked)
+    else:
+        singletons['highscores_cache'] = RenderCache(cache_entries, forked)
+
+    if settings.snapshot and os.path.exists(settings.snapshot):
+        snapshot = Snapshot(settings.snapshot)
+        singletons['levels'].snapshot = snapshot
+        if settings.store_tokens:
+            singletons['users'].snapshot = snapshot
+
+    if settings.wal:
+        recover(settings.wal, singletons['levels'], singletons['users'] if settings.store_tokens else None)
+        log = ScoreLog(settings.wal, forked)
+        singletons['levels'] = DurableLevels(singletons['levels'], log)
+        if settings.store_tokens:
+            singletons['users'] = DurableUsers(singletons['users'], log)
+
+    if settings.rank_index:
+        # its own sync manager process, so the high score lists don't wait for it
+        if forked:
+            rank_manager = StorageManager()
+            rank_manager.start()
+            singletons['ranks'] = rank_manager.RankIndex()
+        else:
+            singletons['ranks'] = RankIndex()
+        singletons['ranks'].update_many([(user, level, score) for level, level_scores in singletons['levels'].dump()
+                                         for user, score in level_scores])
+        singletons['levels'] = RankedLevels(singletons['levels'], singletons['ranks'])
+
+    if settings.async_scores:
+        singletons['score_queue'] = ScoreQueue(singletons['levels'], settings.score_batch, forked)
+        singletons['score_queue'].start()
+
+    if settings.snapshot:
+        SnapshotWriter(settings.snapshot, singletons['levels'], singletons['users'] if settings.store_tokens else None,
+                       interval=settings.snapshot_interval).start()
 
-    forked = not settings.threaded
-    singletons['users'] = UsersStored(forked) if settings.store_tokens else UsersNonStored()
-    singletons['levels'] = Levels(forked)
+    # the proxies used above (by recover and the rank index seeding) keep a connection per manager
+    # in this thread, that the forked children would share
+    close_proxy_connections()
     singletons['server'] = server_factory(settings)
@@ -0,0 +1,181 @@
+"""
+Cache of the rendered high score lists, invalidated by per level version numbers
+"""
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+from counters import Counters
+
+LOCAL_CACHE_SIZE = 1024  # levels per process
+
+
+def render_stats(stats):
+    """
+    Hits and misses of the stats of a cache (see RenderCache.stats) in the Prometheus text format
+    """
+    lines = []
+    for result in ('hits', 'misses'):
+        lines.append('# TYPE highscores_cache_%s_total counter' % result)
+        for cache, prefix in (('shared', ''), ('local', 'local_')):
+            if prefix + result in stats:
+                lines.append('highscores_cache_%s_total{cache="%s"} %s' % (result, cache, stats[prefix + result]))
+    return '\n'.join(lines) + '\n'
+
+
+class LevelVersions(object):
+    """
+    Version numbers of the levels, bumped every time the top scores of a level change.
+    Levels are mapped to a fixed number of slots (level id modulo slots), a collision only makes
+    a cached list look stale. The slots live in shared memory when forked.
+
+    The number of slots must be a multiple of the number of lock stripes of the store, so
+    every slot is only bumped holding the same stripe lock.
+    """
+    def __init__(self, slots, forked=True):
+        self.num_slots = slots
+        self.slots = multiprocessing.RawArray('L', slots) if forked else [0] * slots
+
+    def get(self, level):
+        return self.slots[level % self.num_slots]
+
+    def bump(self, level):
+        """
+        Must be called holding the stripe lock of the level, after the level was updated
+        """
+        self.slots[level % self.num_slots] += 1
+
+
+class RenderCache(object):
+    """
+    Rendered responses per level, stored with the version of the level they were rendered from.
+    The entries container is a storage.LevelsDict or its manager proxy (when shared between processes).
+    """
+    def __init__(self, entries, forked=True):
+        self.entries = entries
+        self.counters = Counters(['hits', 'misses'], forked)
+
+    def get(self, level, version):
+        """
+        Return the cached data if it was rendered for this version, None otherwise
+        """
+        entry = self.entries.get(level)
+        if entry is not None and entry[0] == version:
+            self.counters.incr('hits')
+            return entry[1]
+        self.counters.incr('misses')
+        return None
+
+    def get_many(self, levels, versions):
+        """
+        Same as get for several levels, in a single lookup
+        """
+        res = []
+        for entry, version in zip(self.entries.get_many(levels), versions):
+            res.append(entry[1] if entry is not None and entry[0] == version else None)
+        hits = len(levels) - res.count(None)
+        self.counters.incr('hits', hits)
+        self.counters.incr('misses', len(levels) - hits)
+        return res
+
+    def put(self, level, version, data):
+        """
+        The version must have been read before the data used to render it, so an entry
+        is never older than its version
+        """
+        self.entries[level] = (version, data)
+
+    def put_many(self, entries):
+        """
+        Store several {level: (version, data)} entries at once (see put)
+        """
+        self.entries.update(entries)
+
+    def stats(self):
+        return self.counters.as_dict()
+
+    def render(self):
+        return render_stats(self.stats())
+
+
+class LocalRenderCache(object):
+    """
+    Rendered responses of the most recently used levels kept in the memory of each process, in front of
+    a shared RenderCache (or of the store if shared is None), so a list that did not change since the process
+    last read it is served without any manager round trip, only checking its version in shared memory.
+    Same interface as RenderCache, the least recently used entries are evicted beyond size entries.
+    Processes forked per connection start with the (empty) cache of the parent, so it pays off with
+    keep-alive connections and pre-forked workers.
+    """
+    def __init__(self, shared=None, size=LOCAL_CACHE_SIZE, forked=True):
+        """
+        :param shared: RenderCache shared by every process, or None
+        :param size: max number of levels cached per process
+        :param forked: boolean, if True the hit counters live in shared memory
+        """
+        self.shared = shared
+        self.size = size
+        self.entries = OrderedDict()  # level: (version, data), least recently used first
+        self.lock = threading.Lock()
+        self.counters = Counters(['local_hits', 'local_misses'], forked)
+
+    def _get_local(self, level, version):
+        with self.lock:
+            entry = self.entries.pop(level, None)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                return None  # stale, dropped
+            self.entries[level] = entry  # most recently used
+            return entry[1]
+
+    def _put_local(self, level, version, data):
+        with self.lock:
+            self.entries.pop(level, None)
+            if len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+            self.entries[level] = (version, data)
+
+    def get(self, level, version):
+        data = self._get_local(level, version)
+        if data is not None:
+            self.counters.incr('local_hits')
+            return data
+        self.counters.incr('local_misses')
+        if self.shared is not None:
+            data = self.shared.get(level, version)
+            if data is not None:
+                self._put_local(level, version, data)
+        return data
+
+    def get_many(self, levels, versions):
+        res = [self._get_local(level, version) for level, version in zip(levels, versions)]
+        missing = [i for i, data in enumerate(res) if data is None]
+        self.counters.incr('local_hits', len(levels) - len(missing))
+        self.counters.incr('local_misses', len(missing))
+        if missing and self.shared is not None:
+            shared_res = self.shared.get_many([levels[i] for i in missing], [versions[i] for i in missing])
+            for i, data in zip(missing, shared_res):
+                if data is not None:
+                    res[i] = data
+                    self._put_local(levels[i], versions[i], data)
+        return res
+
+    def put(self, level, version, data):
+        self._put_local(level, version, data)
+        if self.shared is not None:
+            self.shared.put(level, version, data)
+
+    def put_many(self, entries):
+        for level, (version, data) in entries.iteritems():
+            self._put_local(level, version, data)
+        if self.shared is not None:
+            self.shared.put_many(entries)
+
+    def stats(self):
+        stats = self.shared.stats() if self.shared is not None else {}
+        stats.update(self.counters.as_dict())
+        return stats
+
+    def render(self):
+        return render_stats(self.stats())
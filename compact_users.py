@@ -0,0 +1,161 @@
+"""
+Stored users kept in an anonymous shared memory map: the raw 16 bytes of the token of every user
+in an open addressing table, a fixed and predictable size per session
+"""
+import mmap
+import struct
+import logging
+import multiprocessing
+import threading
+
+from users import Users, SESSION_KEY_EXPIRATION
+from storage import UserToken
+from counters import Counters
+from shm_levels import StorageFullError
+
+logger = logging.getLogger('storage')
+
+# slot: user_id + 1 (0 means an empty slot), raw uuid1 token
+_SLOT = struct.Struct('<I16s')
+_KEY = struct.Struct('<I')
+MAX_PROBE = 32  # slots, a user is always stored within this distance of its first slot
+
+
+class CompactUsersStored(Users):
+    """
+    Same tokens as storage.UsersStored, stored in fixed size slots of a shared memory region
+    (20 bytes per user). The slot of a user is found with open addressing (linear probing on the user id),
+    so the number of users is bounded by max_users.
+
+    Slots are never emptied: the slot of an expired session is reused when a new user is stored
+    in its probe sequence. Probing stops after max_probe slots, so finding a user (even an absent one,
+    once every slot has been used) reads at most max_probe slots and a login decodes at most max_probe
+    tokens. A login is rejected when the max_probe slots of its user hold live sessions of other users,
+    so max_users should be well above the expected live sessions (e.g. twice).
+    Writers are serialized by a single lock, validate reads the slot without locking (a token being
+    overwritten by a new login of the same user may be rejected, as it would be right after the login).
+    """
+    snapshot = None  # snapshot.Snapshot with the tokens saved before a restart, set when the server starts
+    max_probe = MAX_PROBE
+
+    def __init__(self, forked=True, max_users=2 ** 20):
+        """
+        :param forked: boolean, if True a process lock protects the region, otherwise a thread lock
+        :param max_users: number of user slots allocated in the shared region
+        """
+        self.max_users = max_users
+        # anonymous maps are shared (MAP_SHARED) with the children created by fork
+        self.region = mmap.mmap(-1, self.max_users * _SLOT.size)
+        self.lock = multiprocessing.Lock() if forked else threading.Lock()
+        self.counters = Counters(['slots_used'], forked)  # slots holding a session, live or expired
+
+    @staticmethod
+    def _expired(bin_token):
+        return UserToken.validate(UserToken.from_bytes(bin_token), timeout=SESSION_KEY_EXPIRATION) is None
+
+    def _find_slot(self, user_id):
+        """
+        Offset of the slot of the user or None
+        """
+        key = user_id + 1
+        index = user_id % self.max_users
+        for _ in xrange(min(self.max_probe, self.max_users)):
+            offset = index * _SLOT.size
+            slot_key, = _KEY.unpack_from(self.region, offset)
+            if slot_key == key:
+                return offset
+            if slot_key == 0:
+                return None
+            index = (index + 1) % self.max_users
+        return None
+
+    def _claim_slot(self, user_id):
+        """
+        Offset of the slot of the user, or of the first reusable slot (expired or empty) in its probe sequence
+        (the first max_probe slots). Must be called holding the lock.
+        """
+        key = user_id + 1
+        index = user_id % self.max_users
+        reusable = None
+        for _ in xrange(min(self.max_probe, self.max_users)):
+            offset = index * _SLOT.size
+            slot_key, bin_token = _SLOT.unpack_from(self.region, offset)
+            if slot_key == key:
+                return offset
+            if slot_key == 0:
+                return offset if reusable is None else reusable
+            if reusable is None and self._expired(bin_token):
+                reusable = offset
+            index = (index + 1) % self.max_users
+
+        if reusable is None:
+            raise StorageFullError('No free slot for user %s (max_users=%s)' % (user_id, self.max_users))
+        return reusable
+
+    def _store(self, user_id, token):
+        with self.lock:
+            offset = self._claim_slot(user_id)
+            if not _KEY.unpack_from(self.region, offset)[0]:
+                self.counters.incr_unlocked('slots_used')
+            _SLOT.pack_into(self.region, offset, user_id + 1, UserToken.to_bytes(token))
+
+    def login(self, user_id):
+        """
+        get a new login token, raises StorageFullError if there is no slot left for the user
+        """
+        token = UserToken.get(user_id)
+        self._store(user_id, token)
+        return token
+
+    def validate(self, token):
+        """
+        return the user_id if the token is valid or None otherwise
+        """
+        user_id = UserToken.validate(token, timeout=SESSION_KEY_EXPIRATION)
+        if user_id:
+            offset = self._find_slot(user_id)
+            if offset is not None:
+                offset += _KEY.size
+                if self.region[offset:offset + 16] == UserToken.to_bytes(token):
+                    return user_id
+            elif self.snapshot is not None and self.snapshot.get_token(user_id) == token:
+                return user_id
+        return None
+
+    def restore(self, user_id, token):
+        """
+        store a token issued before a restart, if it has not expired
+        """
+        if UserToken.validate(token, timeout=SESSION_KEY_EXPIRATION) == user_id:
+            self._store(user_id, token)
+
+    def dump(self):
+        """
+        (user_id, token) pairs of the tokens not expired yet (not including the snapshot ones)
+        """
+        for index in xrange(self.max_users):
+            key, bin_token = _SLOT.unpack_from(self.region, index * _SLOT.size)
+            if key:
+                token = UserToken.from_bytes(bin_token)
+                if UserToken.validate(token, timeout=SESSION_KEY_EXPIRATION) == key - 1:
+                    yield key - 1, token
+
+    def live_sessions(self):
+        """
+        number of sessions not expired yet (not including the snapshot ones), scans the whole table
+        """
+        return sum(1 for _session in self.dump())
+
+    def stats(self):
+        return {'live_sessions': self.live_sessions(), 'max_users': self.max_users,
+                'slots_used': self.counters.get('slots_used')}
+
+    def render(self):
+        """
+        Slots used (by live or expired sessions) and allocated, in the Prometheus text format. The live
+        sessions are left out, counting them scans the whole table
+        """
+        return ('# TYPE users_slots_used gauge\n'
+                'users_slots_used %s\n'
+                '# TYPE users_slots gauge\n'
+                'users_slots %s\n') % (self.counters.get('slots_used'), self.max_users)
@@ -0,0 +1,55 @@
+"""
+Integer counters shared by every process or thread of the server
+"""
+import multiprocessing
+import threading
+
+
+class Counters(object):
+    """
+    Fixed set of named counters.
+    If forked=True the values live in a shared memory array (created before the server forks),
+    so the children update the same counters without any manager round trip,
+    otherwise a plain list shared between threads is used.
+    """
+    def __init__(self, names, forked=True):
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        if forked:
+            self.values = multiprocessing.RawArray('L', len(self.names))
+            self.lock = multiprocessing.Lock()
+        else:
+            self.values = [0] * len(self.names)
+            self.lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.values[self.index[name]] += value
+
+    def incr_unlocked(self, name, value=1):
+        """
+        Only for callers already holding a lock that serializes every update of this counter
+        """
+        self.values[self.index[name]] += value
+
+    def set_unlocked(self, name, value):
+        """
+        Same as incr_unlocked, replacing the value (e.g. a gauge)
+        """
+        self.values[self.index[name]] = value
+
+    def get(self, name):
+        return self.values[self.index[name]]
+
+    def as_dict(self):
+        return dict(zip(self.names, self.values[:]))
+
+    def render(self, prefix):
+        """
+        Every counter in the Prometheus text format, named <prefix>_<name>_total
+        """
+        lines = []
+        for name, value in zip(self.names, self.values[:]):
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            lines.append('%s_%s_total %s' % (prefix, name, value))
+        return '\n'.join(lines) + '\n'
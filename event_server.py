@@ -0,0 +1,296 @@
+"""
+Single process HTTP server serving many connections with non-blocking sockets and an event loop
+(epoll when available, poll otherwise)
+"""
+import time
+import errno
+import select
+import socket
+import logging
+
+from responses import *
+from counters import Counters
+import logs
+from server import dispatch, route_name, render_response, KEEP_ALIVE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION, CONNECTION_COUNTERS
+
+logger = logging.getLogger('handler')
+access_logger = logging.getLogger('access')
+
+MAX_HEADER_SIZE = 65536
+MAX_BODY_SIZE = 1024 * 1024
+MAX_OUTPUT_SIZE = 1024 * 1024  # bytes of responses buffered per connection before its next requests wait
+RECV_SIZE = 65536
+METHODS = {'GET': 'get', 'POST': 'post', 'PUT': 'put', 'HEAD': 'head', 'DELETE': 'delete'}
+
+if hasattr(select, 'epoll'):
+    _Poller = select.epoll
+    POLL_IN, POLL_OUT, POLL_ERR, POLL_HUP = select.EPOLLIN, select.EPOLLOUT, select.EPOLLERR, select.EPOLLHUP
+    _POLL_TIMEOUT_SCALE = 1  # seconds
+else:
+    _Poller = select.poll
+    POLL_IN, POLL_OUT, POLL_ERR, POLL_HUP = select.POLLIN, select.POLLOUT, select.POLLERR, select.POLLHUP
+    _POLL_TIMEOUT_SCALE = 1000  # milliseconds
+
+
+class BadRequest(Exception):
+    pass
+
+
+class _Connection(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.inbuf = ''
+        self.outbuf = ''
+        self.close_after_write = False
+        self.num_requests = 0
+        self.last_active = time.time()
+
+
+def listen_socket(server_address, reuse_port=False, backlog=1024):
+    """
+    Non-blocking TCP socket bound to the address and listening, with SO_REUSEPORT if reuse_port is set
+    (several processes then listen on the same port, the kernel balances the connections)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(server_address)
+    sock.listen(backlog)
+    sock.setblocking(0)
+    return sock
+
+
+class EventLoopHTTPServer(object):
+    """
+    Serve every connection from one process and one thread, reading and writing only when the sockets
+    are ready. Requests are dispatched to the same views as the forked and threaded servers,
+    connections are kept alive (HTTP/1.1) and pipelined requests are answered in order. A connection is not
+    read while more than MAX_OUTPUT_SIZE bytes of its responses wait to be sent.
+    Idle connections are closed after keep_alive_timeout seconds without requests (checked about once
+    per second) and connections after max_requests requests.
+    """
+    request_queue_size = 1024
+
+    def __init__(self, server_address, url_patterns, keep_alive_timeout=KEEP_ALIVE_TIMEOUT,
+                 max_requests=MAX_REQUESTS_PER_CONNECTION, counters=None, profiler=None, sock=None):
+        """
+        :param sock: listening socket (see listen_socket) shared with other processes, by default a new one
+            is bound to server_address
+        """
+        self.url_patterns = url_patterns
+        self.keep_alive_timeout = keep_alive_timeout
+        self.max_requests = max_requests
+        self.counters = counters or Counters(CONNECTION_COUNTERS, forked=False)
+        self.profiler = profiler  # profiling.RequestProfiler of the sampled requests, if any
+        self.next_idle_check = 0
+        self.socket = sock or listen_socket(server_address, backlog=self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.poller = _Poller()
+        self.poller.register(self.socket.fileno(), POLL_IN)
+        self.connections = {}
+
+    def set_max_children(self, max_children):
+        pass
+
+    def serve_forever(self, poll_interval=0.5):
+        listen_fd = self.socket.fileno()
+        while True:
+            try:
+                events = self.poller.poll(poll_interval * _POLL_TIMEOUT_SCALE)
+            except (IOError, select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if self.keep_alive_timeout:
+                self._close_idle()
+
+            for fd, event in events:
+                if fd == listen_fd:
+                    self._accept()
+                    continue
+
+                conn = self.connections.get(fd)
+                if conn is None:
+                    continue
+                if event & POLL_IN:
+                    self._read(conn)
+                elif event & (POLL_ERR | POLL_HUP):
+                    self._close(conn)
+                    continue
+                if event & POLL_OUT and conn.fd in self.connections:
+                    self._write(conn)
+
+    def server_close(self):
+        for conn in self.connections.values():
+            self._close(conn)
+        self.poller.close()
+        self.socket.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = _Connection(sock, address)
+            self.connections[conn.fd] = conn
+            self.counters.incr('connections')
+            self.poller.register(conn.fd, POLL_IN)
+
+    def _close_idle(self):
+        now = time.time()
+        if now < self.next_idle_check:
+            return
+        self.next_idle_check = now + 1
+
+        limit = now - self.keep_alive_timeout
+        for conn in self.connections.values():
+            # connections with a response being written are not idle
+            if conn.last_active < limit and not conn.outbuf:
+                if conn.num_requests:
+                    self.counters.incr('idle_timeouts')
+                self._close(conn)
+
+    def _close(self, conn):
+        self.connections.pop(conn.fd, None)
+        try:
+            self.poller.unregister(conn.fd)
+        except (IOError, KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+    def _read(self, conn):
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self._close(conn)
+            return
+
+        if not data:
+            self._close(conn)
+            return
+
+        conn.inbuf += data
+        conn.last_active = time.time()
+        self._process(conn)
+        self._write(conn)
+
+    def _process(self, conn):
+        """
+        Answer the buffered requests in order (pipelined), until a request asks to close the connection
+        or the buffered responses reach MAX_OUTPUT_SIZE
+        """
+        while not conn.close_after_write and len(conn.outbuf) < MAX_OUTPUT_SIZE:
+            try:
+                request = self._parse_request(conn)
+            except BadRequest as e:
+                logger.debug('Bad request from %s: %s', conn.address, e)
+                conn.outbuf += render_response(ResponseBadRequest(), close=True)
+                conn.close_after_write = True
+                break
+            if request is None:
+                break
+            conn.outbuf += self._handle(conn, *request)
+
+    def _write(self, conn):
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self._close(conn)
+                    return
+                sent = 0
+            conn.outbuf = conn.outbuf[sent:]
+            if conn.inbuf and len(conn.outbuf) < MAX_OUTPUT_SIZE:
+                self._process(conn)  # the requests left waiting for the output to drain
+
+        if len(conn.outbuf) >= MAX_OUTPUT_SIZE:
+            self.poller.modify(conn.fd, POLL_OUT)
+        elif conn.outbuf:
+            self.poller.modify(conn.fd, POLL_IN | POLL_OUT)
+        elif conn.close_after_write:
+            self._close(conn)
+        else:
+            self.poller.modify(conn.fd, POLL_IN)
+
+    def _parse_request(self, conn):
+        """
+        Return (method, path, version, headers, data) if a full request is buffered, None otherwise.
+        Header names are lower case.
+        """
+        end = conn.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(conn.inbuf) > MAX_HEADER_SIZE:
+                raise BadRequest('header too large')
+            return None
+
+        lines = conn.inbuf[:end].split('\r\n')
+        request_line = lines[0].split()
+        if len(request_line) != 3:
+            raise BadRequest('bad request line %r' % lines[0])
+        method, path, version = request_line
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise BadRequest('bad header %r' % line)
+            headers[name.strip().lower()] = value.strip()
+
+        content_length = headers.get('content-length', '0')
+        if not content_length.isdigit() or int(content_length) > MAX_BODY_SIZE:
+            raise BadRequest('bad content length %r' % content_length)
+        content_length = int(content_length)
+
+        body_start = end + 4
+        if len(conn.inbuf) < body_start + content_length:
+            return None
+
+        data = conn.inbuf[body_start:body_start + content_length]
+        conn.inbuf = conn.inbuf[body_start + content_length:]
+        return method, path, version, headers, data
+
+    def _handle(self, conn, method, path, version, headers, data):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            close = connection == 'close'
+        else:
+            close = connection != 'keep-alive'
+        conn.num_requests += 1
+        self.counters.incr('requests')
+        if conn.num_requests > 1:
+            self.counters.incr('reused')
+        if self.max_requests and conn.num_requests >= self.max_requests and not close:
+            self.counters.incr('max_requests_closed')
+            close = True
+        conn.close_after_write = close
+
+        log_sampled = logs.sampled()
+        command = METHODS.get(method)
+        if command is None:
+            response = Response(501, {}, '')
+        else:
+            if log_sampled:
+                logger.debug('Event loop, method: %s', method)
+            args = (self.url_patterns, command, path, headers, data if command in ('post', 'put') else None)
+            if self.profiler is not None and self.profiler.sampled():
+                response = self.profiler.run(route_name(self.url_patterns, path), dispatch, *args)
+            else:
+                response = dispatch(*args)
+            if log_sampled:
+                logger.debug('response data: < %s >', response.data)
+        if log_sampled:
+            access_logger.info('%s "%s %s %s" %s', conn.address[0], method, path, version, response.code)
+
+        return render_response(response, close, head=method == 'HEAD')
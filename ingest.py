@@ -0,0 +1,198 @@
+"""
+Asynchronous score ingestion: the score view only validates the request and pushes the score to a datagram
+socket (created before forking, so it is shared by every process and thread) and answers right away.
+A background thread of the main process drains the socket in batches, keeps the highest score per level
+and user of each batch and saves the whole batch with a single Levels.save_scores call (see
+ScoreQueue.apply_retrying when it fails).
+The socket buffer bounds the queue: when it is full the score is saved synchronously by the view.
+"""
+import time
+import errno
+import struct
+import socket
+import logging
+import threading
+
+from counters import Counters
+
+logger = logging.getLogger('storage')
+
+SCORE_RECORD = struct.Struct('!IIId')  # user, level, score, enqueue time
+QUEUE_BUFFER_SIZE = 1024 * 1024  # bytes of the socket buffers
+DEFAULT_BATCH_SIZE = 1000  # scores
+APPLY_RETRIES = 4  # retries of a batch that failed with a transient error, before applying its scores one by one
+RETRY_DELAY = 0.1  # seconds before the first retry, doubled for every next one
+TRANSIENT_ERRORS = (EnvironmentError, EOFError)  # e.g. a broken sync manager connection
+# scores queued, scores applied (saved or discarded by a higher score of the same batch), batches applied,
+# scores saved synchronously because the queue was full, scores that failed to be applied even alone,
+# apply lag of the last batch and max apply lag
+QUEUE_COUNTERS = ['enqueued', 'applied', 'batches', 'full', 'dropped', 'lag_us_last', 'lag_us_max']
+_STOP = 'STOP'
+_FULL_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+
+def aggregate(records):
+    """
+    Highest score per (level, user) of the (user, level, score) records, as (user, level, score) tuples
+    """
+    best = {}
+    for user, level, score in records:
+        key = (level, user)
+        if score > best.get(key, -1):
+            best[key] = score
+    return [(user, level, score) for (level, user), score in best.iteritems()]
+
+
+class ScoreQueue(object):
+    """
+    Bounded queue of scores shared by every process, applied to the levels store by a background thread
+    (see start). Scores are applied at least once while the server runs, the ones still queued when it
+    stops are applied by stop.
+    """
+    def __init__(self, levels, batch_size=DEFAULT_BATCH_SIZE, forked=True, buffer_size=QUEUE_BUFFER_SIZE):
+        """
+        :param levels: store the scores are saved to (see storage.Levels.save_scores)
+        :param batch_size: max number of scores applied at once
+        :param forked: boolean, if True the counters live in shared memory
+        :param buffer_size: bytes of the socket buffers, roughly the bound of the queue
+        """
+        self.levels = levels
+        self.batch_size = batch_size
+        self.receiver, self.sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+        self.receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        self.counters = Counters(QUEUE_COUNTERS, forked)
+        self.aggregator = None
+
+    def put(self, user, level, score):
+        """
+        Queue a score without blocking, returns False if the queue is full (the score is not queued)
+        """
+        try:
+            self.sender.send(SCORE_RECORD.pack(user, level, score, time.time()), socket.MSG_DONTWAIT)
+        except socket.error as e:
+            if e.args[0] in _FULL_ERRORS:
+                self.counters.incr('full')
+                return False
+            raise
+        self.counters.incr('enqueued')
+        return True
+
+    def _receive(self):
+        """
+        Wait for a score, then read the ones already queued up to batch_size.
+        Returns the records and whether the queue was stopped
+        """
+        records = []
+        data = self.receiver.recv(SCORE_RECORD.size)
+        while data != _STOP:
+            records.append(SCORE_RECORD.unpack(data))
+            if len(records) >= self.batch_size:
+                break
+            try:
+                data = self.receiver.recv(SCORE_RECORD.size, socket.MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return records, data == _STOP
+
+    def apply(self, records):
+        """
+        Save the (user, level, score, enqueue time) records in one Levels.save_scores call
+        """
+        if not records:
+            return
+        self.levels.save_scores(aggregate(record[:3] for record in records))
+        lag_us = int((time.time() - min(record[3] for record in records)) * 1e6)
+        with self.counters.lock:
+            self.counters.incr_unlocked('applied', len(records))
+            self.counters.incr_unlocked('batches')
+            self.counters.set_unlocked('lag_us_last', lag_us)
+            if lag_us > self.counters.get('lag_us_max'):
+                self.counters.set_unlocked('lag_us_max', lag_us)
+
+    def apply_retrying(self, records):
+        """
+        Apply the records (every one of them was accepted by the view). Transient errors (of the connection
+        to a sync manager) are retried with backoff, then, as right away for any other error (e.g. a full
+        store), the records are applied one by one so a record that can't be saved only loses itself
+        """
+        delay = RETRY_DELAY
+        for retry in xrange(APPLY_RETRIES + 1):
+            try:
+                self.apply(records)
+                return
+            except TRANSIENT_ERRORS as e:
+                if retry == APPLY_RETRIES:
+                    logger.warning('Error applying %s queued scores, applying them one by one: %s', len(records), e)
+                    break
+                logger.warning('Error applying %s queued scores, retrying in %ss: %s', len(records), delay, e)
+            except Exception as e:
+                logger.warning('Error applying %s queued scores, applying them one by one: %s', len(records), e)
+                break
+            time.sleep(delay)
+            delay *= 2
+        for record in records:
+            try:
+                self.apply([record])
+            except Exception as e:
+                self.counters.incr('dropped')
+                logger.error('Error applying the queued score %s, dropped: %s', record[:3], e, exc_info=True)
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            records, stopped = self._receive()
+            self.apply_retrying(records)
+
+    def start(self):
+        """
+        Start the thread applying the queued scores (in the main process, before forking)
+        """
+        self.aggregator = threading.Thread(target=self._run, name='ScoreAggregator')
+        self.aggregator.daemon = True
+        self.aggregator.start()
+
+    def stop(self, timeout=5):
+        """
+        Apply the scores queued so far and stop the thread
+        """
+        self.sender.send(_STOP)
+        if self.aggregator is not None:
+            self.aggregator.join(timeout)
+
+    def stats(self):
+        """
+        The depth is the number of scores queued and not applied (or dropped) yet
+        """
+        values = self.counters.as_dict()
+        return {'depth': max(0, values['enqueued'] - values['applied'] - values['dropped']),
+                'enqueued': values['enqueued'],
+                'applied': values['applied'],
+                'batches': values['batches'],
+                'full': values['full'],
+                'dropped': values['dropped'],
+                'lag_last_ms': values['lag_us_last'] / 1000.0,
+                'lag_max_ms': values['lag_us_max'] / 1000.0}
+
+    def render(self):
+        """
+        Queue metrics in the Prometheus text format (see metrics.Metrics.render)
+        """
+        stats = self.stats()
+        return ('# TYPE score_queue_depth gauge\n'
+                'score_queue_depth %(depth)s\n'
+                '# TYPE score_queue_apply_lag_seconds gauge\n'
+                'score_queue_apply_lag_seconds %(lag_last)s\n'
+                '# TYPE score_queue_max_apply_lag_seconds gauge\n'
+                'score_queue_max_apply_lag_seconds %(lag_max)s\n'
+                '# TYPE score_queue_enqueued_total counter\n'
+                'score_queue_enqueued_total %(enqueued)s\n'
+                '# TYPE score_queue_applied_total counter\n'
+                'score_queue_applied_total %(applied)s\n'
+                '# TYPE score_queue_full_total counter\n'
+                'score_queue_full_total %(full)s\n'
+                '# TYPE score_queue_dropped_total counter\n'
+                'score_queue_dropped_total %(dropped)s\n') % dict(stats, lag_last=stats['lag_last_ms'] / 1000.0,
+                                                              lag_max=stats['lag_max_ms'] / 1000.0)
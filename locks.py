@@ -0,0 +1,117 @@
+"""
+Striped locks: a fixed pool of locks where each key is always protected by the same lock
+"""
+import time
+import multiprocessing
+import threading
+
+from counters import Counters
+
+DEFAULT_STRIPES = 16
+
+
+def render_stripes(striped_locks):
+    """
+    Acquisitions and contended acquisitions per stripe of the StripedLock of every shard of a store,
+    in the Prometheus text format (without the shard label when there is a single one)
+    """
+    lines = []
+    for counter in ('acquired', 'contended'):
+        lines.append('# TYPE lock_stripe_%s_total counter' % counter)
+        for shard, locks in enumerate(striped_locks):
+            values = locks.counters.as_dict()
+            for stripe in xrange(locks.num_stripes):
+                labels = 'stripe="%s"' % stripe
+                if len(striped_locks) > 1:
+                    labels = 'shard="%s",%s' % (shard, labels)
+                lines.append('lock_stripe_%s_total{%s} %s' % (counter, labels, values['%s_%s' % (counter, stripe)]))
+    return '\n'.join(lines) + '\n'
+
+
+class _Stripe(object):
+    """
+    Context manager for one lock of the pool, counting how many acquisitions had to wait
+    (and timing the wait and hold times if metrics are set)
+    """
+    metrics = None  # metrics.Metrics, see StripedLock.set_metrics
+
+    def __init__(self, lock, index, counters):
+        self.lock = lock
+        self.acquired = 'acquired_%s' % index
+        self.contended = 'contended_%s' % index
+        self.counters = counters
+
+    def __enter__(self):
+        if self.metrics is not None:
+            start = time.time()
+        if not self.lock.acquire(False):
+            self.lock.acquire()
+            self.counters.incr_unlocked(self.contended)
+        # the counters of the stripe are only updated holding its lock
+        self.counters.incr_unlocked(self.acquired)
+        if self.metrics is not None:
+            # only read by the holder of the lock, before releasing it
+            self.acquired_at = time.time()
+            self.wait = self.acquired_at - start
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.metrics is None:
+            self.lock.release()
+            return
+        wait, hold = self.wait, time.time() - self.acquired_at
+        self.lock.release()
+        self.metrics.observe_lock(wait, hold)
+
+
+class StripedLock(object):
+    """
+    Pool of locks keyed by an integer id (e.g. a level id) so unrelated keys are not serialized
+    behind a single lock. Lock contention is counted per stripe to help sizing the pool.
+    """
+    def __init__(self, stripes=DEFAULT_STRIPES, forked=True):
+        """
+        :param stripes: number of locks in the pool
+        :param forked: boolean, if True process locks are used, otherwise thread locks
+        """
+        self.num_stripes = stripes
+        lock_class = multiprocessing.Lock if forked else threading.Lock
+        names = []
+        for i in xrange(stripes):
+            names.extend(['acquired_%s' % i, 'contended_%s' % i])
+        self.counters = Counters(names, forked)
+        self.stripes = [_Stripe(lock_class(), i, self.counters) for i in xrange(stripes)]
+
+    def stripe(self, key):
+        """
+        get the lock protecting the key (to be used in a with statement)
+        """
+        return self.stripes[key % self.num_stripes]
+
+    def group(self, keys):
+        """
+        Group the keys by stripe, returns (stripe, keys) pairs so each lock is taken once for all its keys
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(key % self.num_stripes, []).append(key)
+        return [(self.stripes[index], groups[index]) for index in sorted(groups)]
+
+    def set_metrics(self, metrics):
+        """
+        Time the lock waits and holds in the metrics (metrics.Metrics)
+        """
+        for stripe in self.stripes:
+            stripe.metrics = metrics
+
+    def stats(self):
+        """
+        Lock acquisitions and contended acquisitions (the ones that had to wait), total and per stripe
+        """
+        values = self.counters.as_dict()
+        acquired = [values['acquired_%s' % i] for i in xrange(self.num_stripes)]
+        contended = [values['contended_%s' % i] for i in xrange(self.num_stripes)]
+        return {'stripes': self.num_stripes,
+                'acquired': sum(acquired),
+                'contended': sum(contended),
+                'contended_per_stripe': contended}
@@ -0,0 +1,120 @@
+"""
+Queued logging: the request path only pushes the log records to a datagram socket, a background thread
+of the main process formats and writes them, so formatting and disk I/O never block a request.
+The socket pair is created before forking, so every process (and thread) sends to the same writer.
+"""
+import random
+import socket
+import logging
+import threading
+import cPickle as pickle
+
+from counters import Counters
+
+MAX_RECORD_SIZE = 32768  # bytes, longer messages are truncated
+SEND_BUFFER_SIZE = 4 * 1024 * 1024  # records are dropped (and counted) when the writer falls this far behind
+# attributes of the records sent to the writer (exc_info is sent already formatted in exc_text)
+_RECORD_ATTRS = ('name', 'levelno', 'levelname', 'pathname', 'filename', 'module', 'lineno', 'funcName',
+                 'created', 'msecs', 'relativeCreated', 'process', 'processName', 'thread', 'threadName',
+                 'msg', 'args', 'exc_text')
+_STOP = 'STOP'
+
+_sample_rate = 1.0
+
+
+def set_sample_rate(rate):
+    global _sample_rate
+    _sample_rate = rate
+
+
+def sampled():
+    """
+    True if the per request logs of this request must be written (see set_sample_rate),
+    to be checked before calling the logger so the unsampled requests don't even create a record
+    """
+    return _sample_rate >= 1 or random.random() < _sample_rate
+
+
+class QueueHandler(logging.Handler):
+    """
+    Send the records (not formatted) to the writer without blocking, records are dropped if the socket
+    buffer is full
+    """
+    def __init__(self, sock, counters):
+        logging.Handler.__init__(self)
+        self.sock = sock
+        self.counters = counters
+
+    def emit(self, record):
+        try:
+            if record.exc_info and not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            fields = dict((attr, getattr(record, attr, None)) for attr in _RECORD_ATTRS)
+            try:
+                data = pickle.dumps(fields, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError):
+                fields['msg'], fields['args'] = record.getMessage(), None
+                data = pickle.dumps(fields, pickle.HIGHEST_PROTOCOL)
+            if len(data) > MAX_RECORD_SIZE:
+                fields['msg'], fields['args'] = record.getMessage()[:MAX_RECORD_SIZE // 4] + '...', None
+                fields['exc_text'] = fields['exc_text'] and fields['exc_text'][-MAX_RECORD_SIZE // 4:]
+                data = pickle.dumps(fields, pickle.HIGHEST_PROTOCOL)
+            self.sock.send(data, socket.MSG_DONTWAIT)
+        except socket.error:
+            self.counters.incr('dropped')
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(threading.Thread):
+    """
+    Background thread receiving the records and passing them to the actual handlers (files, stderr)
+    """
+    daemon = True
+
+    def __init__(self, receiver, sender, handlers, counters):
+        threading.Thread.__init__(self, name='LogWriter')
+        self.receiver = receiver
+        self.sender = sender
+        self.handlers = handlers
+        self.counters = counters
+
+    def run(self):
+        while True:
+            data = self.receiver.recv(2 * MAX_RECORD_SIZE)
+            if data == _STOP:
+                return
+            try:
+                record = logging.makeLogRecord(pickle.loads(data))
+            except Exception:
+                continue
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def stop(self, timeout=1):
+        """
+        Write the records already sent by this process and stop the thread
+        """
+        self.sender.send(_STOP)
+        self.join(timeout)
+        dropped = self.counters.get('dropped')
+        if dropped:
+            record = logging.makeLogRecord({'name': 'logs', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                            'msg': '%s log records dropped', 'args': (dropped,)})
+            for handler in self.handlers:
+                handler.handle(record)
+
+
+def start_queued_logging(logger, handlers):
+    """
+    Log the records of the logger to the handlers through a LogWriter thread, returns the writer
+    """
+    receiver, sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SEND_BUFFER_SIZE)
+    counters = Counters(['dropped'], forked=True)
+    writer = LogWriter(receiver, sender, handlers, counters)
+    writer.start()
+    logger.addHandler(QueueHandler(sender, counters))
+    return writer
@@ -0,0 +1,127 @@
+"""
+Request, lock and sync manager metrics of every process or thread of the server, rendered by the /metrics view
+"""
+import os
+import bisect
+import thread
+
+from counters import Counters
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)  # seconds
+STATUS_CODES = (200, 204, 400, 401, 404, 405, 500, 501, 503)
+MANAGER_TYPEIDS = ('LevelsDict', 'SessionIndex', 'RankIndex')
+DEFAULT_SHARDS = 8
+NOT_FOUND = 'NotFound'  # view name of the requests without a matching route
+
+
+def _histogram_names(name):
+    return (['%s_bucket_%s' % (name, i) for i in xrange(len(LATENCY_BUCKETS) + 1)] +
+            ['%s_count' % name, '%s_sum_us' % name])
+
+
+class Metrics(object):
+    """
+    Counters and latency histograms kept in shards of shared memory counters (see counters.Counters):
+    each process (or thread) updates the shard of its pid (or thread id) holding the lock of that shard only,
+    so processes and threads rarely wait for each other. The shards are added up when the metrics are read.
+    """
+    def __init__(self, views, forked=True, shards=DEFAULT_SHARDS):
+        """
+        :param views: names of the views (requests are counted per view)
+        :param forked: boolean, if True the shards live in shared memory and are picked by pid
+        :param shards: number of counter shards
+        """
+        self.views = list(views) + [NOT_FOUND]
+        self.forked = forked
+        names = []
+        for view in self.views:
+            names.append('requests_%s' % view)
+            names.extend(_histogram_names('latency_%s' % view))
+        names.extend('responses_%s' % code for code in STATUS_CODES + ('other',))
+        names.extend(_histogram_names('lock_wait'))
+        names.extend(_histogram_names('lock_hold'))
+        names.extend('manager_calls_%s' % typeid for typeid in MANAGER_TYPEIDS)
+        self.shards = [Counters(names, forked) for _ in xrange(shards)]
+
+    def _shard(self):
+        if self.forked:
+            key = os.getpid()
+        else:
+            # thread ids are aligned addresses (the low bits are always the same), hashed to spread them
+            key = (thread.get_ident() * 0x9E3779B97F4A7C15 >> 40) & 0xffffff
+        return self.shards[key % len(self.shards)]
+
+    @staticmethod
+    def _observe(shard, name, seconds):
+        """
+        Must be called holding the lock of the shard
+        """
+        shard.incr_unlocked('%s_bucket_%s' % (name, bisect.bisect_left(LATENCY_BUCKETS, seconds)))
+        shard.incr_unlocked('%s_count' % name)
+        shard.incr_unlocked('%s_sum_us' % name, int(seconds * 1e6))
+
+    def observe_request(self, view, code, seconds):
+        """
+        Count a request answered by the view (a view name) with the status code in seconds
+        """
+        if code not in STATUS_CODES:
+            code = 'other'
+        shard = self._shard()
+        with shard.lock:
+            shard.incr_unlocked('requests_%s' % view)
+            self._observe(shard, 'latency_%s' % view, seconds)
+            shard.incr_unlocked('responses_%s' % code)
+
+    def observe_lock(self, wait, hold):
+        """
+        Time spent waiting for a store lock and holding it
+        """
+        shard = self._shard()
+        with shard.lock:
+            self._observe(shard, 'lock_wait', wait)
+            self._observe(shard, 'lock_hold', hold)
+
+    def count_manager_call(self, typeid):
+        self._shard().incr('manager_calls_%s' % typeid)
+
+    def as_dict(self):
+        """
+        Values of every counter, added up over the shards
+        """
+        values = dict.fromkeys(self.shards[0].names, 0)
+        for shard in self.shards:
+            for name, value in shard.as_dict().iteritems():
+                values[name] += value
+        return values
+
+    @staticmethod
+    def _render_histogram(lines, values, metric, name, labels=''):
+        cumulative = 0
+        for i, bucket in enumerate(LATENCY_BUCKETS + ('+Inf',)):
+            cumulative += values['%s_bucket_%s' % (name, i)]
+            lines.append('%s_bucket{%sle="%s"} %s' % (metric, labels + ',' if labels else '', bucket, cumulative))
+        labels = '{%s}' % labels if labels else ''
+        lines.append('%s_sum%s %s' % (metric, labels, values['%s_sum_us' % name] / 1e6))
+        lines.append('%s_count%s %s' % (metric, labels, values['%s_count' % name]))
+
+    def render(self):
+        """
+        Metrics in the Prometheus text format
+        """
+        values = self.as_dict()
+        lines = ['# TYPE requests_total counter']
+        lines.extend('requests_total{view="%s"} %s' % (view, values['requests_%s' % view]) for view in self.views)
+        lines.append('# TYPE request_latency_seconds histogram')
+        for view in self.views:
+            self._render_histogram(lines, values, 'request_latency_seconds', 'latency_%s' % view, 'view="%s"' % view)
+        lines.append('# TYPE responses_total counter')
+        lines.extend('responses_total{code="%s"} %s' % (code, values['responses_%s' % code])
+                     for code in STATUS_CODES + ('other',))
+        lines.append('# TYPE lock_wait_seconds histogram')
+        self._render_histogram(lines, values, 'lock_wait_seconds', 'lock_wait')
+        lines.append('# TYPE lock_hold_seconds histogram')
+        self._render_histogram(lines, values, 'lock_hold_seconds', 'lock_hold')
+        lines.append('# TYPE manager_calls_total counter')
+        lines.extend('manager_calls_total{typeid="%s"} %s' % (typeid, values['manager_calls_%s' % typeid])
+                     for typeid in MANAGER_TYPEIDS)
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,126 @@
+"""
+Opt-in profiling of a sample of the requests.
+A sampled request runs under its own cProfile.Profile and the result is dumped right away to a spool
+directory (forked children only live for one connection), a background thread of the main process merges
+the spooled profiles every interval seconds into one pstats file per server mode and route:
+
+    <directory>/<mode>.<route>.prof      e.g. /tmp/profiles/forked.ScoreView.prof
+
+The files can be read with pstats (python -m pstats /tmp/profiles/forked.ScoreView.prof).
+"""
+import os
+import pstats
+import random
+import logging
+import cProfile
+import itertools
+import threading
+
+logger = logging.getLogger('profiling')
+
+SPOOL_DIR = 'spool'
+SUFFIX = '.prof'
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_INTERVAL = 60  # seconds
+
+
+class RequestProfiler(object):
+    """
+    Profile the sampled requests (see sampled) and merge their profiles per route.
+    Requests that are not sampled only pay the sampled() call.
+    """
+    def __init__(self, directory, sample_rate=DEFAULT_SAMPLE_RATE, mode='forked', interval=DEFAULT_INTERVAL):
+        """
+        :param directory: where the merged pstats files are written (created if needed)
+        :param sample_rate: fraction of the requests profiled
+        :param mode: server mode, part of the names of the files
+        :param interval: seconds between merges of the spooled profiles
+        """
+        self.directory = directory
+        self.spool = os.path.join(directory, SPOOL_DIR)
+        if not os.path.isdir(self.spool):
+            os.makedirs(self.spool)
+        self.sample_rate = sample_rate
+        self.mode = mode
+        self.interval = interval
+        self.sequence = itertools.count()
+        self.merger = None
+        self.stopped = threading.Event()
+        self.merge_lock = threading.Lock()
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def run(self, route, func, *args):
+        """
+        Call func(*args) under a profiler and spool its profile tagged with the route, returns its result
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            try:
+                self._spool(route, profile)
+            except (EnvironmentError, ValueError) as e:
+                logger.warning('Error saving the profile of %s: %s', route, e)
+
+    def _spool(self, route, profile):
+        # unique per process and thread, renamed when complete so the merger never reads a partial file
+        name = '%s.%s.%s.%s.%s' % (self.mode, route, os.getpid(), threading.current_thread().ident,
+                                   next(self.sequence))
+        path = os.path.join(self.spool, name)
+        profile.dump_stats(path + '.tmp')
+        os.rename(path + '.tmp', path + SUFFIX)
+
+    def merge(self):
+        """
+        Add the spooled profiles to the pstats file of their mode and route, returns the number merged
+        """
+        with self.merge_lock:
+            groups = {}
+            for name in os.listdir(self.spool):
+                if name.endswith(SUFFIX):
+                    mode, route = name.split('.')[:2]
+                    groups.setdefault('%s.%s' % (mode, route), []).append(os.path.join(self.spool, name))
+
+            merged = 0
+            for tag, paths in groups.iteritems():
+                target = os.path.join(self.directory, tag + SUFFIX)
+                try:
+                    stats = pstats.Stats(*([target] if os.path.exists(target) else []) + paths)
+                    stats.dump_stats(target + '.tmp')
+                    os.rename(target + '.tmp', target)
+                except (EnvironmentError, ValueError, TypeError, EOFError) as e:
+                    logger.error('Error merging the profiles of %s: %s', tag, e)
+                    continue
+                for path in paths:
+                    os.unlink(path)
+                merged += len(paths)
+            return merged
+
+    def _merge_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                merged = self.merge()
+            except Exception as e:
+                logger.error('Error merging profiles: %s', e, exc_info=True)
+                continue
+            if merged:
+                logger.info('%s request profiles merged in %s', merged, self.directory)
+
+    def start(self):
+        """
+        Start the merging thread (in the main process, before forking)
+        """
+        self.merger = threading.Thread(target=self._merge_loop, name='ProfileMerger')
+        self.merger.daemon = True
+        self.merger.start()
+
+    def stop(self):
+        """
+        Stop the merging thread and merge the profiles spooled since the last merge
+        """
+        self.stopped.set()
+        if self.merger is not None:
+            self.merger.join(self.interval)
+        self.merge()
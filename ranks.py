@@ -0,0 +1,229 @@
+"""
+Rank of every user of a level (not only the top scores), answered in logarithmic time.
+Ranks follow the order of the high score lists: descending score, ties broken by the lowest user id.
+"""
+import random
+import threading
+
+SKIPLIST_LEVELS = 24  # tuned for up to 2 ** 24 users per level, larger levels only get slower
+_SCORE_BITS = 31
+_MAX_SCORE = 2 ** _SCORE_BITS - 1
+
+
+def _key(user, score):
+    """
+    Single integer sorting like (-score, user), cheaper to compare than a tuple
+    """
+    return ((_MAX_SCORE - score) << _SCORE_BITS) | user
+
+
+def _user_score(key):
+    return key & _MAX_SCORE, _MAX_SCORE - (key >> _SCORE_BITS)
+
+
+class _Node(object):
+    __slots__ = ('value', 'next', 'width')
+
+    def __init__(self, value, levels):
+        self.value = value
+        self.next = [None] * levels
+        self.width = [None] * levels  # positions skipped by each link
+
+
+_NIL = _Node(float('inf'), 0)  # sentinel after the last node, greater than every value
+
+
+class IndexableSkiplist(object):
+    """
+    Sorted collection of distinct values with insertion, removal, positional access and rank in O(log n):
+    every link of the skiplist also stores how many positions it skips.
+    """
+    def __init__(self, levels=SKIPLIST_LEVELS):
+        self.levels = levels
+        self.size = 0
+        self.head = _Node(None, levels)
+        self.head.next = [_NIL] * levels
+        self.head.width = [1] * levels
+
+    def __len__(self):
+        return self.size
+
+    def _random_levels(self):
+        levels = 1
+        while levels < self.levels and random.random() < 0.5:
+            levels += 1
+        return levels
+
+    def insert(self, value):
+        chain = [None] * self.levels  # last node before the value, per level
+        steps = [0] * self.levels  # positions advanced at each level
+        node = self.head
+        for level in xrange(self.levels - 1, -1, -1):
+            while node.next[level].value <= value:
+                steps[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        new_levels = self._random_levels()
+        new_node = _Node(value, new_levels)
+        distance = 0  # from chain[level] to the new node, minus one
+        for level in xrange(new_levels):
+            previous = chain[level]
+            new_node.next[level] = previous.next[level]
+            previous.next[level] = new_node
+            new_node.width[level] = previous.width[level] - distance
+            previous.width[level] = distance + 1
+            distance += steps[level]
+        for level in xrange(new_levels, self.levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        chain = [None] * self.levels
+        node = self.head
+        for level in xrange(self.levels - 1, -1, -1):
+            while node.next[level].value < value:
+                node = node.next[level]
+            chain[level] = node
+        node = chain[0].next[0]
+        if node.value != value:
+            raise KeyError(value)
+
+        for level in xrange(len(node.next)):
+            previous = chain[level]
+            previous.width[level] += node.width[level] - 1
+            previous.next[level] = node.next[level]
+        for level in xrange(len(node.next), self.levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def rank(self, value):
+        """
+        Number of values lower than value
+        """
+        position = 0
+        node = self.head
+        for level in xrange(self.levels - 1, -1, -1):
+            while node.next[level].value < value:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        position = index + 1
+        node = self.head
+        for level in xrange(self.levels - 1, -1, -1):
+            while node.width[level] <= position:
+                position -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def slice(self, start, stop):
+        """
+        Values from the start position to the stop one (not included), walking the bottom level
+        """
+        values = []
+        if start >= min(stop, self.size):
+            return values
+        position = start + 1
+        node = self.head
+        for level in xrange(self.levels - 1, -1, -1):
+            while node.width[level] <= position:
+                position -= node.width[level]
+                node = node.next[level]
+        for _ in xrange(min(stop, self.size) - start):
+            values.append(node.value)
+            node = node.next[0]
+        return values
+
+
+class RankIndex(object):
+    """
+    Best score of every user per level, with a skiplist per level to answer ranks.
+    Hosted by a sync manager when forked (its methods are then called from several manager threads,
+    so they are serialized by a lock) or used directly by the threads of the server.
+    """
+    def __init__(self):
+        self.levels = {}  # level: ({user: best score}, IndexableSkiplist of keys)
+        self.lock = threading.Lock()
+
+    def update_many(self, scores):
+        """
+        Save the (user, level, score) tuples that improve the best score of their user
+        """
+        with self.lock:
+            for user, level, score in scores:
+                entry = self.levels.get(level)
+                if entry is None:
+                    entry = self.levels[level] = ({}, IndexableSkiplist())
+                best, keys = entry
+                old_score = best.get(user)
+                if old_score is not None:
+                    if old_score >= score:
+                        continue
+                    keys.remove(_key(user, old_score))
+                best[user] = score
+                keys.insert(_key(user, score))
+
+    def rank(self, level, user):
+        """
+        (rank, score) of the user in the level (the first rank is 1), None if the user has no score
+        """
+        with self.lock:
+            best, keys = self.levels.get(level, ({}, None))
+            score = best.get(user)
+            if score is None:
+                return None
+            return keys.rank(_key(user, score)) + 1, score
+
+    def range(self, level, first, last):
+        """
+        (rank, user, score) tuples from the first rank to the last one (both included)
+        """
+        with self.lock:
+            entry = self.levels.get(level)
+            if entry is None:
+                return []
+            return [(first + i,) + _user_score(key) for i, key in enumerate(entry[1].slice(first - 1, last))]
+
+    def count(self, level):
+        """
+        Number of users with a score in the level
+        """
+        with self.lock:
+            entry = self.levels.get(level)
+            return len(entry[0]) if entry is not None else 0
+
+    def stats(self):
+        with self.lock:
+            return {'levels': len(self.levels), 'scores': sum(len(best) for best, _keys in self.levels.itervalues())}
+
+
+class RankedLevels(object):
+    """
+    Levels store also saving every score in a RankIndex (or its manager proxy),
+    every other method is served by the wrapped store, so the high score lists are read as before
+    """
+    def __init__(self, levels, ranks):
+        self.levels = levels
+        self.ranks = ranks
+
+    def __getattr__(self, name):
+        return getattr(self.levels, name)
+
+    def save_score(self, user, level, score):
+        changed = self.levels.save_score(user, level, score)
+        self.ranks.update_many([(user, level, score)])
+        return changed
+
+    def save_scores(self, scores):
+        saved = self.levels.save_scores(scores)
+        self.ranks.update_many(scores)
+        return saved
+
+    def stats(self):
+        stats = self.levels.stats()
+        stats['ranks'] = self.ranks.stats()
+        return stats
@@ -1,13 +1,41 @@
+from BaseHTTPServer import BaseHTTPRequestHandler
+
 __all__ = ['Response', 'ResponseBadRequest', 'ResponseInternalServerError', 'ResponseNoContent',
-           'ResponseNotAllowed', 'ResponseNotFound', 'ResponseUnauthorized']
+           'ResponseNotAllowed', 'ResponseNotFound', 'ResponseServiceUnavailable', 'ResponseUnauthorized']
+
+
+def _encode_header_block(code, headers, content_length):
+    """
+    Status line, Content-Length, Content-Type (text/plain if not in the headers) and the headers, CRLF terminated
+    """
+    reason = BaseHTTPRequestHandler.responses.get(code, ('',))[0]
+    lines = ['HTTP/1.1 %s %s' % (code, reason),
+             'Content-Length: %s' % content_length]
+    if ('Content-Type' not in headers and
+            'content-type' not in headers):
+        lines.append('Content-Type: text/plain')
+    for k, v in headers.iteritems():
+        lines.append('%s: %s' % (k, v))
+    lines.append('')
+    return '\r\n'.join(lines)
 
 
 class Response(object):
+    header_block = None  # pre-encoded status line and headers, set for the default responses
+
     def __init__(self, code, headers, data):
         self.code = code
         self.headers = headers
         self.data = data
 
+    def encode_headers(self):
+        """
+        Status line and headers of the response (see _encode_header_block)
+        """
+        if self.header_block is not None:
+            return self.header_block
+        return _encode_header_block(self.code, self.headers, len(self.data))
+
 
 class _DefaultResponse(type):
     def __init__(cls, name, bases, dct):
@@ -25,10 +53,14 @@ class _DefaultResponse(type):
                 "</html>"
             ) % dct
 
+        # the headers only change if an instance gets extra headers, so they are encoded once per class
+        cls.header_block = _encode_header_block(cls.code, {'Content-Type': 'text/html'}, len(cls.data))
+
         def _init(self, headers=None):
             self.headers = {'Content-Type': 'text/html'}
             if headers:
                 self.headers.update(headers)
+                self.header_block = None
 
         cls.__init__ = _init
 
@@ -67,3 +99,9 @@ class ResponseInternalServerError(Response):
     __metaclass__ = _DefaultResponse
     code = 500
     message = 'Internal Server Error'
+
+
+class ResponseServiceUnavailable(Response):
+    __metaclass__ = _DefaultResponse
+    code = 503
+    message = 'Service Unavailable'
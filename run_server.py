@@ -3,6 +3,13 @@ import logging
 import logging.handlers
 import argparse
 from bootstrap import init_singletons, singletons
+from topscores import NUM_TOP_SCORES
+from users import TOKEN_CACHE_SIZE
+from cache import LOCAL_CACHE_SIZE
+from ingest import DEFAULT_BATCH_SIZE
+from server import KEEP_ALIVE_TIMEOUT, MAX_REQUESTS_PER_CONNECTION
+from logs import start_queued_logging, set_sample_rate
+from profiling import DEFAULT_SAMPLE_RATE, DEFAULT_INTERVAL
 
 logger = logging.getLogger()
 
@@ -19,58 +26,207 @@ def get_parameters():
 
     parser.add_argument('--max_proc', type=int,
                         default=60,
-                        help=('Max children processes allowed (only for forked server) '
+                        help=('Max children processes allowed (forked server) or worker threads (threaded server) '
                               '[default: %(default)s]'))
 
+    parser.add_argument('--queue_size', type=int,
+                        default=128,
+                        help=('Max connections waiting for a worker thread (threaded server), '
+                              'further connections get a 503 response [default: %(default)s]'))
+
     parser.add_argument('--threaded', action='store_true',
                         default=False,
                         help=("Use a multithread server (faster for non cpu intensive tasks and low number of cores) "
                               "instead of multiprocess or forked (integration tests run in 45%% of the time "
                               "used by multiprocess in a dual core i5 laptop)"))
 
+    parser.add_argument('--event_loop', action='store_true',
+                        default=False,
+                        help=("Serve every connection from a single process and thread with non-blocking sockets "
+                              "(epoll), for many concurrent keep-alive clients"))
+
+    parser.add_argument('--prefork', type=int,
+                        default=0,
+                        help=("Number of long lived worker processes started at startup (and restarted if they die), "
+                              "each one serving many connections with an event loop, instead of forking a process "
+                              "per request [default: %(default)s, disabled]"))
+
+    parser.add_argument('--reuse_port', action='store_true',
+                        default=False,
+                        help="Pre-forked workers listen on their own SO_REUSEPORT socket instead of a shared one")
+
+    parser.add_argument('--keep_alive_timeout', type=int,
+                        default=KEEP_ALIVE_TIMEOUT,
+                        help=('Seconds a persistent connection is kept open waiting for a new request, '
+                              '0 to wait forever [default: %(default)s]'))
+
+    parser.add_argument('--max_requests', type=int,
+                        default=MAX_REQUESTS_PER_CONNECTION,
+                        help=('Requests answered per connection before closing it, 0 for no limit '
+                              '[default: %(default)s]'))
+
     parser.add_argument('--logfile', type=str,
                         default='/tmp/basic_test_server.log',
                         help='Log file path [default: %(default)s]')
 
+    parser.add_argument('--debug', action='store_true',
+                        help='Log debug messages (e.g. every request and response)')
+
+    parser.add_argument('--log_sample', type=float,
+                        default=1.0,
+                        help=('Fraction of the requests whose access and debug logs are written '
+                              '[default: %(default)s]'))
+
     parser.add_argument('--store_tokens', action='store_true',
                         default=False,
                         help=("Store the user tokens in memory (only one token is valid per user at any time) "
                               "if the tokens are not stored, they are only invalidated by expiration time"))
 
+    parser.add_argument('--compact_tokens', action='store_true',
+                        help=('Keep the stored tokens (see --store_tokens) as raw bytes in a shared memory table '
+                              'instead of a sync manager dictionary'))
+
+    parser.add_argument('--max_users', type=int,
+                        default=2 ** 20,
+                        help=('Number of user slots (20 bytes each) allocated when --compact_tokens is set, '
+                              'keep it about twice the expected live sessions [default: %(default)s]'))
+
+    parser.add_argument('--token_cache', type=int,
+                        default=TOKEN_CACHE_SIZE,
+                        help=('Number of validated signed tokens cached per process when --store_tokens is not '
+                              'set, 0 to check the signature of every request [default: %(default)s]'))
+
+    parser.add_argument('--shm_levels', action='store_true',
+                        default=False,
+                        help=("Keep the level scores in a shared memory map updated in place by every process "
+                              "instead of a sync manager process"))
+
+    parser.add_argument('--store_shards', type=int,
+                        default=1,
+                        help=('Number of stores (sync manager processes when forked) the levels are spread over '
+                              'by level id, so scores of different levels are saved in parallel, ignored with '
+                              '--shm_levels [default: %(default)s]'))
+
+    parser.add_argument('--max_levels', type=int,
+                        default=2 ** 16,
+                        help=('Number of level slots reserved in the shared memory map, keep it about twice the '
+                              'expected levels [default: %(default)s]'))
+
+    parser.add_argument('--lock_stripes', type=int,
+                        default=16,
+                        help=('Number of locks protecting the levels, each level is always protected by the same '
+                              'lock (contention per lock is logged when the server stops) [default: %(default)s]'))
+
+    parser.add_argument('--top_scores', type=int,
+                        default=NUM_TOP_SCORES,
+                        help='Number of high scores kept and returned per level [default: %(default)s]')
+
+    parser.add_argument('--local_cache', type=int,
+                        default=LOCAL_CACHE_SIZE,
+                        help=('Number of rendered high score lists cached in each process of the forked and '
+                              'pre-forked servers (least recently used first evicted) and served while their '
+                              'level does not change, 0 to always ask the shared cache [default: %(default)s]'))
+
+    parser.add_argument('--rank_index', action='store_true',
+                        help=('Keep the best score of every user per level (not only the top scores) to answer '
+                              'their ranks (/<levelid>/rank/<userid> and /<levelid>/ranks?from=&to=), in its own '
+                              'sync manager process when forked. Only the top scores are recovered after a '
+                              'restart'))
+
+    parser.add_argument('--async_scores', action='store_true',
+                        help=('Answer the score posts once the score is queued, a background thread saves the '
+                              'queued scores in batches keeping the highest score per level and user (the scores '
+                              'are saved synchronously while the queue is full)'))
+
+    parser.add_argument('--score_batch', type=int,
+                        default=DEFAULT_BATCH_SIZE,
+                        help='Max number of queued scores saved at once with --async_scores [default: %(default)s]')
+
+    parser.add_argument('--wal', type=str,
+                        default=None,
+                        help=("Log file where the scores (and the logins if --store_tokens is set) are saved "
+                              "before answering, the server recovers its state from it when started "
+                              "[default: no persistence]"))
+
+    parser.add_argument('--snapshot', type=str,
+                        default=None,
+                        help=("Binary snapshot file of the levels (and the tokens if --store_tokens is set), the "
+                              "server starts from it if it exists (before replaying --wal) and writes it every "
+                              "--snapshot_interval seconds and when it gets a SIGUSR1 signal [default: no snapshot]"))
+
+    parser.add_argument('--snapshot_interval', type=int,
+                        default=0,
+                        help='Seconds between snapshots, 0 to only write them on SIGUSR1 [default: %(default)s]')
+
+    parser.add_argument('--profile_dir', type=str,
+                        default=None,
+                        help=("Profile a sample of the requests (see --profile_sample) and merge their profiles "
+                              "every --profile_interval seconds into a pstats file per server mode and route in "
+                              "this directory, e.g. forked.ScoreView.prof [default: no profiling]"))
+
+    parser.add_argument('--profile_sample', type=float,
+                        default=DEFAULT_SAMPLE_RATE,
+                        help='Fraction of the requests profiled when --profile_dir is set [default: %(default)s]')
+
+    parser.add_argument('--profile_interval', type=int,
+                        default=DEFAULT_INTERVAL,
+                        help='Seconds between merges of the request profiles [default: %(default)s]')
+
     return parser.parse_args()
 
 
-def config_logger(logfile, debug=True):
+def config_logger(logfile, debug=False, sample_rate=1.0):
+    """
+    The records are written by a background thread (see logs.py), returns it
+    """
     if debug:
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
+    set_sample_rate(sample_rate)
 
+    handlers = []
     handler = logging.handlers.RotatingFileHandler(
         logfile, maxBytes=2000000, backupCount=5)
     fmt = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
     handler.setFormatter(fmt)
-    logger.addHandler(handler)
+    handlers.append(handler)
 
     if sys.stdin.isatty():
         # write also to stderr
         handler = logging.StreamHandler()
         fmt = logging.Formatter('%(levelname)s:%(name)s:%(message)s')
         handler.setFormatter(fmt)
-        logger.addHandler(handler)
+        handlers.append(handler)
+
+    return start_queued_logging(logger, handlers)
 
 
 def simple_server_main():
     args = get_parameters()
 
-    config_logger(args.logfile)
+    log_writer = config_logger(args.logfile, args.debug, args.log_sample)
 
     init_singletons(args)
 
     server = singletons['server']
     server.set_max_children(args.max_proc)
     logger.info('Starting server, use <Ctrl-C> to stop')
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('Levels stats: %s', singletons['levels'].stats())
+        logger.info('High scores cache stats: %s', singletons['highscores_cache'].stats())
+        logger.info('Connection stats: %s', server.connection_counters.as_dict())
+        if args.store_tokens:
+            logger.info('Users stats: %s', singletons['users'].stats())
+    finally:
+        if singletons['score_queue'] is not None:
+            singletons['score_queue'].stop()
+            logger.info('Score queue stats: %s', singletons['score_queue'].stats())
+        if server.profiler is not None:
+            server.profiler.stop()
+        log_writer.stop()
 
 
 if __name__ == '__main__':
@@ -1,48 +1,210 @@
+import os
+import time
+import Queue
+import errno
+import select
+import signal
+import socket
 import threading
-import multiprocessing
 import logging
+from email.utils import formatdate
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from SocketServer import ForkingMixIn, ThreadingMixIn
+from SocketServer import BaseServer, ForkingMixIn
 from responses import *
 from urls import Urls
+from counters import Counters
+from metrics import NOT_FOUND
+from profiling import RequestProfiler
+from bootstrap import singletons
+import logs
 
 
 logger = logging.getLogger('handler')
+access_logger = logging.getLogger('access')
+
+KEEP_ALIVE_TIMEOUT = 15  # seconds
+MAX_REQUESTS_PER_CONNECTION = 1000
+IDLE_POLL_INTERVAL = 0.1  # seconds, how often an idle connection of the thread pool checks for waiting ones
+# connections accepted, requests answered, requests answered on a reused connection, connections closed
+# after waiting keep_alive_timeout for a new request, connections closed after max_requests requests,
+# idle connections closed because other connections were waiting for a worker thread
+CONNECTION_COUNTERS = ['connections', 'requests', 'reused', 'idle_timeouts', 'max_requests_closed', 'busy_closed']
+
+_SERVER_LINE = 'Server: %s %s\r\n' % (BaseHTTPRequestHandler.server_version, BaseHTTPRequestHandler.sys_version)
+
+
+def dispatch(url_patterns, command, path, headers, data):
+    """
+    Get the response of the view matching the path (shared by every server mode)
+    """
+    start = time.time()
+    view = None
+    try:
+        view = url_patterns.match(path)
+        if not view:
+            response = ResponseNotFound()
+        else:
+            response = getattr(view, command)(headers, data)
+    except Exception as e:
+        logger.error('Error processing view: %s', e, exc_info=True)
+        response = ResponseInternalServerError()
+
+    metrics = singletons['metrics']
+    if metrics is not None:
+        metrics.observe_request(type(view).__name__ if view else NOT_FOUND, response.code, time.time() - start)
+    return response
+
+
+def route_name(url_patterns, path):
+    """
+    Name of the view matching the path (as counted in the metrics), to tag the profiles of the requests
+    """
+    view = url_patterns.match(path)
+    return type(view).__name__ if view else NOT_FOUND
+
+
+_CONNECTION_LINES = {False: 'Connection: keep-alive\r\n\r\n', True: 'Connection: close\r\n\r\n'}
+_date_line = (0, '')  # (second, Date header line), formatted once per second
+
+
+def _get_date_line():
+    global _date_line
+    now = int(time.time())
+    second, line = _date_line
+    if second != now:
+        line = 'Date: %s\r\n' % formatdate(now, usegmt=True)
+        _date_line = (now, line)  # a single assignment, threads never see a mixed pair
+    return line
+
+
+def render_response(response, close=False, head=False):
+    """
+    Serialize the status line, headers and body of a response in a single string, to be sent with a single
+    write (the default responses have their status line and headers pre-encoded)
+    """
+    parts = [response.encode_headers(), _SERVER_LINE, _get_date_line(), _CONNECTION_LINES[bool(close)]]
+    if not head:
+        parts.append(response.data)
+    return ''.join(parts)
 
 
 class Handler(BaseHTTPRequestHandler):
+    """
+    Persistent connections (HTTP/1.1) are served until the client closes them, no new request arrives
+    in timeout seconds or max_requests requests were answered. Pipelined requests are read from the
+    buffered rfile and answered in order. With a thread pool an idle connection is also closed as soon as
+    other connections wait for a worker thread (see ThreadPoolMixIn.busy).
+    """
     protocol_version = 'HTTP/1.1'
     url_patterns = Urls()
+    timeout = KEEP_ALIVE_TIMEOUT  # socket timeout set by StreamRequestHandler.setup
+    max_requests = MAX_REQUESTS_PER_CONNECTION  # 0 means no limit
+    counters = Counters(CONNECTION_COUNTERS, forked=False)  # replaced by server_factory
+    log_sampled = True  # if the per request logs of the current request are written (see logs.sampled)
+    profiler = None  # profiling.RequestProfiler, set by server_factory if the requests are profiled
 
-    def handle_in_view(self, command, data):
-        proc = multiprocessing.current_process()
-        thread = threading.currentThread()
-        logger.debug('Process: %s pid=%s, thread: %s, method: %s', proc.name, proc.ident, thread.getName(), self.command)
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.num_requests = 0
+        self.counters.incr('connections')
 
+    def handle_one_request(self):
+        """
+        Same as BaseHTTPRequestHandler.handle_one_request, counting the idle timeouts
+        """
+        if self.num_requests and not self._wait_for_request():
+            self.close_connection = 1
+            return
         try:
-            view = self.url_patterns.match(self.path)
-            if not view:
-                response = ResponseNotFound()
-            else:
-                response = getattr(view, command)(self.headers, data)
-        except Exception as e:
-            logger.error('Error processing view: %s', e, exc_info=True)
-            response = ResponseInternalServerError()
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            if self.num_requests:
+                self.counters.incr('idle_timeouts')
+            self.close_connection = 1
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        method = getattr(self, 'do_' + self.command, None)
+        if method is None:
+            self.send_error(501, 'Unsupported method (%r)' % self.command)
+            return
+        try:
+            method()
+        except socket.timeout as e:
+            self.log_error('Request timed out: %r', e)
+            self.close_connection = 1
+
+    def _wait_for_request(self):
+        """
+        Wait for the next request of a persistent connection in slices of IDLE_POLL_INTERVAL, returns False
+        if the connection should be closed because the thread pool is busy or the timeout expired.
+        Without a thread pool readline just waits up to timeout
+        """
+        busy = getattr(self.server, 'busy', None)
+        # data left in the buffer of rfile (a pipelined request), socket._fileobject keeps it at the end
+        if busy is None or self.rfile._rbuf.tell():
+            return True
+        deadline = time.time() + self.timeout if self.timeout else None
+        while True:
+            if busy():
+                self.counters.incr('busy_closed')
+                return False
+            wait = IDLE_POLL_INTERVAL if deadline is None else min(IDLE_POLL_INTERVAL, deadline - time.time())
+            if wait <= 0:
+                self.counters.incr('idle_timeouts')
+                return False
+            try:
+                readable, _, _ = select.select([self.connection], [], [], wait)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if readable:
+                return True
 
-        self.send_response(response.code)
+    def log_request(self, code='-', size='-'):
+        if self.log_sampled:
+            access_logger.info('%s "%s" %s', self.client_address[0], self.requestline, code)
+
+    def log_error(self, format, *args):
+        logger.warning('%s - ' + format, self.client_address[0], *args)
+
+    def handle_in_view(self, command, data):
+        if self.profiler is not None and self.profiler.sampled():
+            self.profiler.run(route_name(self.url_patterns, self.path), self._handle_in_view, command, data)
+        else:
+            self._handle_in_view(command, data)
 
-        self.send_header('Content-Length', len(response.data))
-        if ('Content-Type' not in response.headers and
-            'content-type' not in response.headers):
-            self.send_header('Content-Type', 'text/plain')
-        for k, v in response.headers.iteritems():
-            self.send_header(k, v)
-        self.end_headers()
+    def _handle_in_view(self, command, data):
+        self.log_sampled = logs.sampled()
+        if self.log_sampled:
+            logger.debug('method: %s', self.command)
 
-        logger.debug('response data: < %s >', response.data)
-        if response.data:
-            self.wfile.write(response.data)
-        self.wfile.write('\n')
+        response = dispatch(self.url_patterns, command, self.path, self.headers, data)
+
+        self.num_requests += 1
+        self.counters.incr('requests')
+        if self.num_requests > 1:
+            self.counters.incr('reused')
+        if self.max_requests and self.num_requests >= self.max_requests and not self.close_connection:
+            self.counters.incr('max_requests_closed')
+            self.close_connection = 1
+
+        self.log_request(response.code)
+        if self.log_sampled:
+            logger.debug('response data: < %s >', response.data)
+        # status line, headers and body in a single write (wfile is not buffered)
+        self.wfile.write(render_response(response, close=self.close_connection, head=command == 'head'))
 
     def do_GET(self):
         self.handle_in_view('get', None)
@@ -74,19 +236,203 @@ class ForkedHTTPServer(ForkingMixIn, HTTPServer):
         self.max_children = max_children
 
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-    """Handle requests in a separate thread"""
+class ThreadPoolMixIn:
+    """
+    Handle requests in a fixed pool of worker threads fed by a bounded queue of accepted connections.
+    When the queue is full the connection gets a 503 response right away. Idle keep-alive connections
+    are closed while connections are queued (see Handler), so they don't keep the new ones waiting.
+    """
+    pool_size = 60
+    queue_size = 128
+    reject_timeout = 1  # seconds, max time spent sending a 503 response
+
+    def serve_forever(self, poll_interval=0.5):
+        self.requests = Queue.Queue(self.queue_size)
+        self.idle_workers = 0  # worker threads waiting for a connection
+        self.idle_lock = threading.Lock()
+        for i in xrange(self.pool_size):
+            th = threading.Thread(target=self.process_request_worker, name='Worker-%s' % i)
+            th.daemon = True
+            th.start()
+        BaseServer.serve_forever(self, poll_interval)
+
+    def process_request_worker(self):
+        while True:
+            with self.idle_lock:
+                self.idle_workers += 1
+            request, client_address = self.requests.get()
+            with self.idle_lock:
+                self.idle_workers -= 1
+            try:
+                self.finish_request(request, client_address)
+                self.shutdown_request(request)
+            except:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+    def busy(self):
+        """
+        True if accepted connections are waiting for a worker thread (more than the idle worker threads
+        about to take them)
+        """
+        return self.requests.qsize() > self.idle_workers
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Queue.Full:
+            self.reject_request(request, client_address)
+
+    def reject_request(self, request, client_address):
+        logger.debug('Request queue full, rejecting %s', client_address)
+        try:
+            request.settimeout(self.reject_timeout)
+            request.sendall(render_response(ResponseServiceUnavailable(), close=True))
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+
+class ThreadedHTTPServer(ThreadPoolMixIn, HTTPServer):
+    """Handle requests in a pool of threads"""
+
+    def __init__(self, server_address, handler_class, queue_size=ThreadPoolMixIn.queue_size):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.queue_size = queue_size
+
+    def set_max_children(self, max_children):
+        self.pool_size = max_children
+
+
+class PreForkedHTTPServer(object):
+    """
+    Start a fixed number of long lived worker processes, each one serving many connections with an event loop
+    (see event_server.EventLoopHTTPServer), so idle keep-alive connections don't hold a worker.
+    The workers accept on a listening socket bound before forking, or on their own SO_REUSEPORT
+    socket if reuse_port is set. Dead workers are restarted by the parent process.
+    """
+    restart_delay = 1  # seconds to wait before restarting a worker that died just after starting
+
+    def __init__(self, server_address, handler_class, workers, reuse_port=False):
+        """
+        :param handler_class: Handler class, its url_patterns, timeout, max_requests, counters and profiler
+            are used by the event loops of the workers
+        """
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError('SO_REUSEPORT is not supported in this platform')
+
+        # imported here, event_server depends on this module
+        from event_server import listen_socket
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.num_workers = workers
+        self.workers = {}  # pid: start time
+        self.socket = None if reuse_port else listen_socket(server_address)
 
     def set_max_children(self, max_children):
         pass
 
+    def _worker_server(self):
+        from event_server import EventLoopHTTPServer, listen_socket
+        handler = self.handler_class
+        sock = self.socket or listen_socket(self.server_address, reuse_port=True)
+        return EventLoopHTTPServer(self.server_address, handler.url_patterns, keep_alive_timeout=handler.timeout,
+                                   max_requests=handler.max_requests, counters=handler.counters,
+                                   profiler=handler.profiler, sock=sock)
+
+    def _start_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.time()
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        status = 1
+        try:
+            server = self._worker_server()
+            logger.info('Worker started pid=%s', os.getpid())
+            server.serve_forever()
+        except KeyboardInterrupt:
+            status = 0
+        except Exception as e:
+            logger.error('Worker error: %s', e, exc_info=True)
+        finally:
+            os._exit(status)
+
+    @staticmethod
+    def _terminate(signum, frame):
+        raise SystemExit(0)
+
+    def serve_forever(self):
+        # stopping the parent also stops the workers
+        signal.signal(signal.SIGTERM, self._terminate)
+        for _ in xrange(self.num_workers):
+            self._start_worker()
+
+        try:
+            while True:
+                try:
+                    pid, status = os.wait()
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                # other children (e.g. the sync managers) are not restarted here
+                start_time = self.workers.pop(pid, None)
+                if start_time is None:
+                    continue
+
+                logger.warning('Worker pid=%s died (status %s), restarting it', pid, status)
+                if time.time() - start_time < self.restart_delay:
+                    time.sleep(self.restart_delay)
+                self._start_worker()
+        finally:
+            for pid in self.workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+
+def server_mode(settings):
+    if settings.event_loop:
+        return 'event_loop'
+    elif settings.prefork:
+        return 'prefork'
+    elif settings.threaded:
+        return 'threaded'
+    return 'forked'
+
 
 def server_factory(settings):
-    if settings.threaded:
-        server = ThreadedHTTPServer((settings.host, settings.port), Handler)
+    forked = not settings.event_loop and (settings.prefork or not settings.threaded)
+    counters = Counters(CONNECTION_COUNTERS, forked)
+    profiler = None
+    if settings.profile_dir:
+        profiler = RequestProfiler(settings.profile_dir, settings.profile_sample, server_mode(settings),
+                                   settings.profile_interval)
+        profiler.start()
+    Handler.timeout = settings.keep_alive_timeout or None
+    Handler.max_requests = settings.max_requests
+    Handler.counters = counters
+    Handler.profiler = profiler
+
+    if settings.event_loop:
+        # imported here, event_server depends on this module
+        from event_server import EventLoopHTTPServer
+        server = EventLoopHTTPServer((settings.host, settings.port), Handler.url_patterns,
+                                     keep_alive_timeout=settings.keep_alive_timeout,
+                                     max_requests=settings.max_requests, counters=counters, profiler=profiler)
+    elif settings.prefork:
+        server = PreForkedHTTPServer((settings.host, settings.port), Handler, settings.prefork, settings.reuse_port)
+    elif settings.threaded:
+        server = ThreadedHTTPServer((settings.host, settings.port), Handler, settings.queue_size)
     else:
         server = ForkedHTTPServer((settings.host, settings.port), Handler)
 
+    server.connection_counters = counters
+    server.profiler = profiler
     return server
 
 
@@ -0,0 +1,56 @@
+"""
+Index of the stored sessions (user_id: token) where the sessions expire
+"""
+import time
+
+from users import SESSION_KEY_EXPIRATION
+
+
+class SessionIndex(dict):
+    """
+    user_id: token dictionary with a timing wheel to remove the expired sessions.
+
+    The wheel has a slot per tick (slot_seconds) of the session lifetime, a session is appended to the
+    slot of the tick of its timestamp. When the clock moves to a new tick, the slot that is one lifetime old
+    is emptied and its sessions are removed (unless the user logged in again with a new token),
+    so every session is added and removed once: amortized O(1) per operation.
+
+    Hosted by the sync manager (storage.StorageManager) when shared between processes, the writers
+    (add, expire and live_sessions) must be serialized by the caller.
+    """
+    def __init__(self, expiration=SESSION_KEY_EXPIRATION, slot_seconds=1):
+        dict.__init__(self)
+        self.slot_seconds = slot_seconds
+        # ticks of a session lifetime, the sessions of tick t are expired once the clock is at tick t + lifetime
+        self.lifetime = expiration // slot_seconds + 1
+        self.wheel = [[] for _ in xrange(self.lifetime + 1)]
+        self.tick = int(time.time() // slot_seconds)
+
+    def add(self, user_id, token, timestamp):
+        """
+        Store the token of the user, created at timestamp (posix time)
+        """
+        self.expire()
+        tick = min(int(timestamp // self.slot_seconds), self.tick)
+        if tick <= self.tick - self.lifetime:
+            return  # already expired
+        self[user_id] = token
+        self.wheel[tick % len(self.wheel)].append((user_id, token))
+
+    def expire(self):
+        """
+        Remove the sessions expired since the last call
+        """
+        now_tick = int(time.time() // self.slot_seconds)
+        # after a long pause every slot is swept once
+        for tick in xrange(max(self.tick, now_tick - len(self.wheel)) + 1, now_tick + 1):
+            expired_slot = self.wheel[(tick - self.lifetime) % len(self.wheel)]
+            for user_id, token in expired_slot:
+                if self.get(user_id) == token:
+                    del self[user_id]
+            del expired_slot[:]
+        self.tick = max(self.tick, now_tick)
+
+    def live_sessions(self):
+        self.expire()
+        return len(self)
@@ -0,0 +1,186 @@
+"""
+Levels store kept in an anonymous shared memory map (inherited by the forked children),
+so the score tables are read and updated in place without any manager process or pickling
+"""
+import mmap
+import struct
+import logging
+import multiprocessing
+import threading
+
+from topscores import TopScores, NUM_TOP_SCORES
+from locks import StripedLock, DEFAULT_STRIPES, render_stripes
+from cache import LevelVersions
+from storage import VERSION_SLOTS_PER_STRIPE, SHARD_HASH_MULTIPLIER, group_scores
+
+logger = logging.getLogger('storage')
+
+# slot header: level_id + 1 (0 means an empty slot), number of scores used
+_HEADER = struct.Struct('<II')
+# one score entry: user_id, score
+_ENTRY = struct.Struct('<II')
+MAX_PROBE = 32  # slots, a level is always stored within this distance of its first slot
+
+
+class StorageFullError(Exception):
+    pass
+
+
+class SharedMemoryLevels(object):
+    """
+    Manage the levels in fixed size slots of a shared memory region.
+    Each slot holds a level id and its top scores table (user, score pairs in descending score order),
+    the slot of a level is found with open addressing (linear probing from a multiplicative hash of the level id,
+    so consecutive level ids don't form a cluster). Probing stops after max_probe slots, so a lookup (even of
+    an unknown level) reads at most max_probe slots: a new level is rejected when those slots are used,
+    before the table is full, max_levels should be well above the expected levels (e.g. twice).
+    The region is mapped before the server forks, so every child updates the same memory.
+
+    The scores of a level are read and written holding the stripe lock of the level,
+    claiming an empty slot for a new level also requires the table lock (two levels of different
+    stripes could be probing the same empty slot).
+
+    If a snapshot is set, the levels without scores in the region are read from it (see storage.Levels).
+    """
+    snapshot = None
+    max_probe = MAX_PROBE
+
+    def __init__(self, forked=True, max_levels=2 ** 16, lock_stripes=DEFAULT_STRIPES, top_scores=NUM_TOP_SCORES):
+        """
+        :param forked: boolean, if True process locks are used to protect the region,
+            otherwise thread locks are enough.
+        :param max_levels: number of level slots allocated in the shared region
+        :param lock_stripes: number of locks used to protect the level slots
+        :param top_scores: max number of scores kept per level (size of the slots)
+        """
+        self.max_levels = max_levels
+        self.top_scores = top_scores
+        self.slot_size = _HEADER.size + self.top_scores * _ENTRY.size
+        # anonymous maps are shared (MAP_SHARED) with the children created by fork
+        self.region = mmap.mmap(-1, self.max_levels * self.slot_size)
+        self.table_lock = multiprocessing.Lock() if forked else threading.Lock()
+        self.locks = StripedLock(lock_stripes, forked)
+        self.versions = LevelVersions(lock_stripes * VERSION_SLOTS_PER_STRIPE, forked)
+
+    def _find_slot(self, level, create=False):
+        """
+        Return the offset of the slot used by the level, if create is True an empty slot is claimed
+        when the level is not found, otherwise None is returned
+        (slot keys are written once, as a single aligned word, so probing does not need the table lock)
+        """
+        key = level + 1
+        index = (((level * SHARD_HASH_MULTIPLIER) & 0xffffffff) * self.max_levels) >> 32
+        for _ in xrange(min(self.max_probe, self.max_levels)):
+            offset = index * self.slot_size
+            slot_key, _count = _HEADER.unpack_from(self.region, offset)
+            if slot_key == key:
+                return offset
+            if slot_key == 0:
+                if not create:
+                    return None
+                _HEADER.pack_into(self.region, offset, key, 0)
+                return offset
+            index = (index + 1) % self.max_levels
+
+        if create:
+            raise StorageFullError('No free slot for level %s (max_levels=%s)' % (level, self.max_levels))
+        return None
+
+    def _read_scores(self, offset, level=None):
+        """
+        If the slot is empty and the level is given, the snapshot scores of the level are returned
+        """
+        _key, count = _HEADER.unpack_from(self.region, offset)
+        if not count and level is not None and self.snapshot is not None:
+            return self.snapshot.get_scores(level)
+        offset += _HEADER.size
+        return [_ENTRY.unpack_from(self.region, offset + i * _ENTRY.size) for i in xrange(count)]
+
+    def _write_scores(self, offset, scores):
+        key, _count = _HEADER.unpack_from(self.region, offset)
+        _HEADER.pack_into(self.region, offset, key, len(scores))
+        offset += _HEADER.size
+        for i, (user, score) in enumerate(scores):
+            _ENTRY.pack_into(self.region, offset + i * _ENTRY.size, user, score)
+
+    def _claim_slot(self, level):
+        offset = self._find_slot(level)
+        if offset is None:
+            with self.table_lock:
+                offset = self._find_slot(level, create=True)
+        return offset
+
+    def save_score(self, user, level, score):
+        """
+        returns True if the score changed the top scores of the level
+        """
+        with self.locks.stripe(level):
+            offset = self._claim_slot(level)
+            level_scores = TopScores(self.top_scores, self._read_scores(offset, level))
+
+            if level_scores.add(user, score):
+                self._write_scores(offset, level_scores.items())
+                self.versions.bump(level)
+                return True
+        return False
+
+    def save_scores(self, scores):
+        """
+        Save several (user, level, score) tuples, taking each stripe lock once.
+        Returns the (user, level, score) tuples that changed the top scores.
+        The slots of every level are claimed before any score is changed, so if the table is full
+        (StorageFullError) none of the scores is saved
+        """
+        saved = []
+        by_level = group_scores(scores)
+        offsets = dict((level, self._claim_slot(level)) for level in by_level)
+        for stripe, levels in self.locks.group(by_level):
+            with stripe:
+                for level in levels:
+                    offset = offsets[level]
+                    level_scores = TopScores(self.top_scores, self._read_scores(offset, level))
+                    changed = False
+                    for user, score in by_level[level]:
+                        if level_scores.add(user, score):
+                            changed = True
+                            saved.append((user, level, score))
+                    if changed:
+                        self._write_scores(offset, level_scores.items())
+                        self.versions.bump(level)
+        return saved
+
+    def get_version(self, level):
+        return self.versions.get(level)
+
+    def get_highest_scores(self, level):
+        """
+        Retrieves the high scores for a specific level in descending score order
+        (see storage.Levels.get_highest_scores)
+        """
+        with self.locks.stripe(level):
+            offset = self._find_slot(level)
+            if offset is None:
+                return self.snapshot.get_scores(level) if self.snapshot is not None else []
+            return self._read_scores(offset, level)
+
+    def get_highest_scores_many(self, levels):
+        return [self.get_highest_scores(level) for level in levels]
+
+    def dump(self):
+        """
+        (level, [(user, score), ...]) pairs of every level with scores in the region (not including the
+        snapshot ones)
+        """
+        for index in xrange(self.max_levels):
+            offset = index * self.slot_size
+            key, count = _HEADER.unpack_from(self.region, offset)
+            if key and count:
+                with self.locks.stripe(key - 1):
+                    scores = self._read_scores(offset)
+                yield key - 1, scores
+
+    def stats(self):
+        return {'locks': self.locks.stats()}
+
+    def render(self):
+        return render_stripes([self.locks])
@@ -0,0 +1,173 @@
+"""
+Binary snapshot of the levels (and stored users) state, memory mapped when the server starts
+
+Layout (little endian, fixed width records):
+    header: magic, number of levels, number of score records, number of users,
+            level index offset, users offset
+    score records: level id, user id, score (uint32 each), sorted by level and descending score
+    level index: level id, first score record, number of score records (uint32 each), sorted by level id
+    users: user id (uint32), token (16 bytes), sorted by user id
+"""
+import os
+import mmap
+import heapq
+import signal
+import struct
+import logging
+import threading
+
+from storage import UserToken
+from users import SESSION_KEY_EXPIRATION
+
+logger = logging.getLogger('storage')
+
+MAGIC = 'GSN1'
+_HEADER = struct.Struct('<4sIIIII')
+_SCORE = struct.Struct('<III')
+_INDEX = struct.Struct('<III')
+_USER = struct.Struct('<I16s')
+
+
+class Snapshot(object):
+    """
+    Read only view of a snapshot file. The file is memory mapped and the records are found
+    with binary searches, so only the pages of the levels actually read are loaded in memory.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self.map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.num_levels, self.num_scores, self.num_users, self.index_offset, self.users_offset = \
+            _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a snapshot file' % path)
+
+    def _search(self, record, offset, count, key):
+        """
+        Binary search of the record with the key as first field, returns the record or None
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            values = record.unpack_from(self.map, offset + middle * record.size)
+            if values[0] < key:
+                low = middle + 1
+            elif values[0] > key:
+                high = middle
+            else:
+                return values
+        return None
+
+    def get_scores(self, level):
+        """
+        (user, score) pairs of the level in descending score order
+        """
+        entry = self._search(_INDEX, self.index_offset, self.num_levels, level)
+        if entry is None:
+            return []
+        _level, first, count = entry
+        offset = _HEADER.size + first * _SCORE.size
+        return [_SCORE.unpack_from(self.map, offset + i * _SCORE.size)[1:] for i in xrange(count)]
+
+    def iter_levels(self):
+        for i in xrange(self.num_levels):
+            yield _INDEX.unpack_from(self.map, self.index_offset + i * _INDEX.size)[0]
+
+    def get_token(self, user_id):
+        entry = self._search(_USER, self.users_offset, self.num_users, user_id)
+        if entry is None:
+            return None
+        return UserToken.from_bytes(entry[1])
+
+    def iter_users(self):
+        for i in xrange(self.num_users):
+            user_id, token = _USER.unpack_from(self.map, self.users_offset + i * _USER.size)
+            yield user_id, UserToken.from_bytes(token)
+
+
+def _unique(sorted_iterable):
+    last = None
+    for value in sorted_iterable:
+        if value != last:
+            yield value
+            last = value
+
+
+def write_snapshot(path, levels, users=None):
+    """
+    Write the state of the stores (merged with the snapshot they were started from) to a new snapshot,
+    replacing the file once it is complete
+    """
+    old_snapshot = levels.snapshot
+    live_levels = dict(levels.dump())
+    all_levels = sorted(live_levels)
+    if old_snapshot is not None:
+        all_levels = _unique(heapq.merge(all_levels, old_snapshot.iter_levels()))
+
+    index = []
+    num_scores = 0
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write('\0' * _HEADER.size)
+        for level in all_levels:
+            level_scores = live_levels.get(level) or old_snapshot.get_scores(level)
+            snapshot_file.write(''.join(_SCORE.pack(level, user, score) for user, score in level_scores))
+            index.append(_INDEX.pack(level, num_scores, len(level_scores)))
+            num_scores += len(level_scores)
+
+        index_offset = snapshot_file.tell()
+        snapshot_file.write(''.join(index))
+        users_offset = snapshot_file.tell()
+
+        tokens = {}
+        if users is not None:
+            if users.snapshot is not None:
+                tokens.update(users.snapshot.iter_users())
+            tokens.update(users.dump())
+        num_users = 0
+        for user_id in sorted(tokens):
+            if UserToken.validate(tokens[user_id], timeout=SESSION_KEY_EXPIRATION) == user_id:
+                snapshot_file.write(_USER.pack(user_id, UserToken.to_bytes(tokens[user_id])))
+                num_users += 1
+
+        snapshot_file.seek(0)
+        snapshot_file.write(_HEADER.pack(MAGIC, len(index), num_scores, num_users, index_offset, users_offset))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.rename(tmp_path, path)
+    logger.info('Snapshot written to %s: %s levels, %s scores, %s users', path, len(index), num_scores,
+                num_users)
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Background thread writing a snapshot every interval seconds (if interval is not 0)
+    and when the process gets a SIGUSR1 signal, so request handling is never blocked by it
+    """
+    daemon = True
+
+    def __init__(self, path, levels, users=None, interval=0):
+        threading.Thread.__init__(self, name='SnapshotWriter')
+        self.path = path
+        self.levels = levels
+        self.users = users
+        self.interval = interval or None
+        self.requested = threading.Event()
+
+    def request(self, signum=None, frame=None):
+        self.requested.set()
+
+    def start(self):
+        # the handler only wakes up the thread, it must be installed from the main thread
+        signal.signal(signal.SIGUSR1, self.request)
+        signal.siginterrupt(signal.SIGUSR1, False)
+        threading.Thread.start(self)
+
+    def run(self):
+        while True:
+            self.requested.wait(self.interval)
+            self.requested.clear()
+            try:
+                write_snapshot(self.path, self.levels, self.users)
+            except Exception as e:
+                logger.error('Error writing snapshot: %s', e, exc_info=True)
@@ -4,17 +4,102 @@ define singleton memory objects shared by the different processes
 """
 import time
 import uuid
+import itertools
 import logging
 
 import binascii
 import multiprocessing
 import threading
+from multiprocessing.managers import SyncManager, BaseProxy, DictProxy, MakeProxyType
 
 from users import Users, SESSION_KEY_EXPIRATION
+from locks import StripedLock, DEFAULT_STRIPES, render_stripes
+from topscores import TopScores, NUM_TOP_SCORES
+from cache import LevelVersions
+from sessions import SessionIndex
+from ranks import RankIndex
+
+VERSION_SLOTS_PER_STRIPE = 256
+SHARD_HASH_MULTIPLIER = 2654435761  # Knuth's multiplicative hash, see ShardedLevels.shard
 
 logger = logging.getLogger('storage')
 
-NUM_TOP_SCORES = 15
+
+class LevelsDict(dict):
+    """
+    Dictionary with bulk operations, hosted by the sync manager to save round trips
+    (also used directly when the server is multithreaded)
+    """
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+
+class CountingProxy(BaseProxy):
+    """
+    Proxy counting its manager round trips in the metrics
+    """
+    metrics = None  # metrics.Metrics, set when the server starts
+
+    def _callmethod(self, methodname, args=(), kwds={}):
+        if CountingProxy.metrics is not None:
+            CountingProxy.metrics.count_manager_call(self._token.typeid)
+        return BaseProxy._callmethod(self, methodname, args, kwds)
+
+
+_LevelsDictProxyBase = MakeProxyType('LevelsDictProxyBase', DictProxy._exposed_ + ('get_many',))
+
+
+class LevelsDictProxy(CountingProxy, _LevelsDictProxyBase):
+    _method_to_typeid_ = DictProxy._method_to_typeid_
+
+
+_SessionIndexProxyBase = MakeProxyType('SessionIndexProxyBase', ('get', 'add', 'items', 'live_sessions'))
+
+
+class SessionIndexProxy(CountingProxy, _SessionIndexProxyBase):
+    pass
+
+
+_RankIndexProxyBase = MakeProxyType('RankIndexProxyBase', ('update_many', 'rank', 'range', 'count', 'stats'))
+
+
+class RankIndexProxy(CountingProxy, _RankIndexProxyBase):
+    pass
+
+
+class StorageManager(SyncManager):
+    """
+    Sync manager also serving the levels dictionaries, the session index and the rank index
+    """
+    pass
+
+
+StorageManager.register('LevelsDict', LevelsDict, LevelsDictProxy)
+StorageManager.register('SessionIndex', SessionIndex, SessionIndexProxy)
+StorageManager.register('RankIndex', RankIndex, RankIndexProxy)
+
+
+def close_proxy_connections():
+    """
+    Close the manager connections opened by this thread (every proxy call opens one per manager and thread
+    and keeps it). Called in the main process before forking, otherwise every child would inherit them
+    and the children would read each other's replies from the same sockets.
+    """
+    for tls, _idset in BaseProxy._address_to_local.values():
+        connection = getattr(tls, 'connection', None)
+        if connection is not None:
+            connection.close()
+            del tls.connection
+
+
+def group_scores(scores):
+    """
+    Group (user, level, score) tuples by level, returns a dict level: [(user, score), ...]
+    """
+    by_level = {}
+    for user, level, score in scores:
+        by_level.setdefault(level, []).append((user, score))
+    return by_level
 
 
 class UserToken(object):
@@ -43,11 +128,24 @@ class UserToken(object):
         The user_id is used as node of the uuid
         """
         token = uuid.uuid1(int(user_id))
-        bin_token_str = binascii.unhexlify(token.hex)
+        return UserToken.from_bytes(binascii.unhexlify(token.hex))
+
+    @staticmethod
+    def from_bytes(bin_token_str):
+        """
+        Encode the 16 bytes of a token in base64
+        """
         b64 = binascii.b2a_base64(bin_token_str)
         # using the URL- and filesystem-safe alphabet, which substitutes - instead of + and _ instead of / i
         return b64.replace('+', '-').replace('/', '_')
 
+    @staticmethod
+    def to_bytes(b64_token):
+        """
+        Decode a base64 token to its 16 bytes
+        """
+        return binascii.a2b_base64(b64_token.replace('-', '+').replace('_', '/'))
+
     @staticmethod
     def get_posixtime(uuid1):
         """
@@ -60,6 +158,13 @@ class UserToken(object):
         t = t / 1e7
         return t
 
+    @staticmethod
+    def get_timestamp(b64_token):
+        """
+        Posix timestamp of the token creation
+        """
+        return UserToken.get_posixtime(uuid.UUID(bytes=UserToken.to_bytes(b64_token)))
+
     @staticmethod
     def validate(b64_token, timeout):
         """
@@ -86,19 +191,23 @@ class UsersStored(Users):
     The user_id and the time stamp are embedded in the token we would not even need to store the user,
     but we can store it to validate that the token is not self-generated by the client (encryption would also work)
     and to store more user related data in the future.
+    The tokens are kept in a sessions.SessionIndex, removing them once expired.
     """
+    snapshot = None  # snapshot.Snapshot with the tokens saved before a restart, set when the server starts
+
     def __init__(self, forked=True):
         """
         :param forked: boolean, if True a sync manager server is created to share data
             otherwise the data will be shared only between threads.
         """
         if forked:
-            self.manager = multiprocessing.Manager()
-            self.users = self.manager.dict()
+            self.manager = StorageManager()
+            self.manager.start()
+            self.users = self.manager.SessionIndex()
             self.lock = multiprocessing.Lock()  # saves inter process communication vs. self.manager.Lock()
         else:
             self.manager = None
-            self.users = {}
+            self.users = SessionIndex()
             self.lock = threading.Lock()
 
     def login(self, user_id):
@@ -107,7 +216,7 @@ class UsersStored(Users):
         """
         token = UserToken.get(user_id)
         with self.lock:
-            self.users[user_id] = token
+            self.users.add(user_id, token, time.time())
         return token
 
     def validate(self, token):
@@ -116,60 +225,276 @@ class UsersStored(Users):
         """
         user_id = UserToken.validate(token, timeout=SESSION_KEY_EXPIRATION)
         if user_id:
-            if self.users[user_id] == token:
+            stored_token = self.users.get(user_id)
+            if stored_token is None and self.snapshot is not None:
+                stored_token = self.snapshot.get_token(user_id)
+            if stored_token == token:
                 return user_id
-        logger.debug('Users: %s \nUser_id: %s \nUser_token: %s', self.users, user_id, token)
+        logger.debug('Invalid token for user_id %s: %s', user_id, token)
         return None
 
+    def restore(self, user_id, token):
+        """
+        store a token issued before a restart, if it has not expired
+        """
+        if UserToken.validate(token, timeout=SESSION_KEY_EXPIRATION) == user_id:
+            with self.lock:
+                self.users.add(user_id, token, UserToken.get_timestamp(token))
+
+    def dump(self):
+        """
+        (user_id, token) pairs of the tokens not expired yet (not including the snapshot ones)
+        """
+        for user_id, token in self.users.items():
+            if UserToken.validate(token, timeout=SESSION_KEY_EXPIRATION) == user_id:
+                yield user_id, token
+
+    def live_sessions(self):
+        """
+        number of sessions not expired yet (not including the snapshot ones)
+        """
+        with self.lock:
+            return self.users.live_sessions()
+
+    def stats(self):
+        return {'live_sessions': self.live_sessions()}
+
 
 class Levels(object):
     """
     Manage shared levels object
     When created, this will spawn a 'manager' process if forked=True
+
+    If a snapshot is set, the levels not in the store are read from it, and a level is only
+    copied to the store when a score changes it.
     """
-    def __init__(self, forked=True):
+    snapshot = None  # snapshot.Snapshot with the levels saved before a restart, set when the server starts
+
+    def __init__(self, forked=True, lock_stripes=DEFAULT_STRIPES, top_scores=NUM_TOP_SCORES):
         """
         :param forked: boolean, if True a sync manager server is created to share data
             otherwise the data will be shared only between threads.
+        :param lock_stripes: number of locks used to protect the levels (each level is always
+            protected by the same lock, so updates of unrelated levels run concurrently)
+        :param top_scores: max number of scores kept per level
         """
         if forked:
-            self.manager = multiprocessing.Manager()
-            self.levels = self.manager.dict()  # dictionaries with the highest scores per level (key:user, value:score)
-            # if more than one high score per user was allowed we could use heaps instead
-            self.lock = multiprocessing.Lock()
+            self.manager = StorageManager()
+            self.manager.start()
+            self.levels = self.manager.LevelsDict()  # TopScores objects with the highest scores per level
         else:
             self.manager = None
-            self.levels = {}
-            self.lock = threading.Lock()
+            self.levels = LevelsDict()
+        self.locks = StripedLock(lock_stripes, forked)
+        self.versions = LevelVersions(lock_stripes * VERSION_SLOTS_PER_STRIPE, forked)
+        self.top_scores = top_scores
 
     def save_score(self, user, level, score):
-        with self.lock:
-            manager_level = self.levels.get(level, {})
+        """
+        returns True if the score changed the top scores of the level
+        """
+        with self.locks.stripe(level):
+            manager_level = self.levels.get(level) or self._new_level(level)
+
+            if manager_level.add(user, score):
+                # We need to re-assign the modified object to the container (remotely creating a new container
+                # does not work), this is skipped when the score does not change the table
+                # https://docs.python.org/2/library/multiprocessing.html#multiprocessing.managers.SyncManager.list
+                self.levels[level] = manager_level
+                self.versions.bump(level)
+                return True
+        return False
+
+    def save_scores(self, scores):
+        """
+        Save several (user, level, score) tuples, taking each stripe lock once and reading and writing
+        all the levels of the stripe in a single manager round trip each.
+        Returns the (user, level, score) tuples that changed the top scores
+        """
+        saved = []
+        by_level = group_scores(scores)
+        for stripe, levels in self.locks.group(by_level):
+            with stripe:
+                changed = {}
+                for level, manager_level in zip(levels, self.levels.get_many(levels)):
+                    manager_level = manager_level or self._new_level(level)
+                    for user, score in by_level[level]:
+                        if manager_level.add(user, score):
+                            changed[level] = manager_level
+                            saved.append((user, level, score))
 
-            if user in manager_level:
-                if manager_level[user] < score:
-                    manager_level[user] = score
+                if changed:
+                    self.levels.update(changed)
+                    for level in changed:
+                        self.versions.bump(level)
+        return saved
 
-            else:
-                manager_level[user] = score
+    def _snapshot_scores(self, level):
+        return self.snapshot.get_scores(level) if self.snapshot is not None else []
 
-                if len(manager_level) > NUM_TOP_SCORES:
-                    user_to_remove = min(manager_level, key=lambda x: manager_level[x])
-                    manager_level.pop(user_to_remove)
+    def _new_level(self, level):
+        return TopScores(self.top_scores, self._snapshot_scores(level))
 
-            # We need to re-assign the modified object to the container (remotely creating a new container does not work)
-            # https://docs.python.org/2/library/multiprocessing.html#multiprocessing.managers.SyncManager.list
-            self.levels[level] = manager_level
+    def get_version(self, level):
+        """
+        Version of the top scores of the level, it changes every time they change
+        """
+        return self.versions.get(level)
 
     def get_highest_scores(self, level):
         """
         Retrieves the high scores for a specific level. 
         The result is a comma separated list in descending score order. 
-        Because of memory reasons no more than 15 scores are to be returned for each level. 
+        Because of memory reasons no more than top_scores (15 by default) scores are to be returned for each level.
         
         If a user hasn't submitted a score for the level, no score is present for that user. 
         A request for a high score list of a level without any scores submitted shall be an empty string.
+        The tables are kept sorted, so no sort is needed here.
+        """
+        level_scores = self.levels.get(level)
+        if not level_scores:
+            return self._snapshot_scores(level)
+        return level_scores.items()
+
+    def get_highest_scores_many(self, levels):
+        """
+        Same as get_highest_scores for several levels, fetched in a single manager round trip
+        """
+        return [level_scores.items() if level_scores else self._snapshot_scores(level)
+                for level, level_scores in zip(levels, self.levels.get_many(levels))]
+
+    def dump(self):
+        """
+        (level, [(user, score), ...]) pairs of every level in the store (not including the snapshot ones)
+        """
+        for level, level_scores in self.levels.items():
+            yield level, level_scores.items()
+
+    def stats(self):
+        return {'locks': self.locks.stats()}
+
+    def render(self):
+        return render_stripes([self.locks])
+
+
+class ShardedLevels(object):
+    """
+    Levels spread by level id over several Levels stores, each one with its own sync manager process,
+    striped locks and versions, so the scores of levels in different shards are saved by different
+    processes (and cores) in parallel. Every level always lives in the same shard.
+    """
+    def __init__(self, shards, forked=True, lock_stripes=DEFAULT_STRIPES, top_scores=NUM_TOP_SCORES):
+        """
+        :param shards: number of Levels stores (sync manager processes if forked)
+        see Levels for the other parameters (lock_stripes is per shard)
+        """
+        self.shards = [Levels(forked, lock_stripes, top_scores) for _ in xrange(shards)]
+        self.manager = self.shards[0].manager
+
+    @property
+    def snapshot(self):
+        return self.shards[0].snapshot
+
+    @snapshot.setter
+    def snapshot(self, snapshot):
+        for shard in self.shards:
+            shard.snapshot = snapshot
+
+    def shard(self, level):
+        """
+        The store of the level, picked with the high bits of a multiplicative hash so consecutive level ids
+        are spread over the shards and over the lock stripes of each shard (that use level % stripes)
+        """
+        return self.shards[(((level * SHARD_HASH_MULTIPLIER) & 0xffffffff) >> 16) % len(self.shards)]
+
+    def _group(self, levels):
         """
-        res = self.levels.get(level, {}).items()
-        res.sort(key=lambda x: x[1], reverse=True)
-        return res
+        Group the levels by shard, returns (shard, [(position of the level, level), ...]) pairs
+        """
+        groups = {}
+        for i, level in enumerate(levels):
+            groups.setdefault(self.shard(level), []).append((i, level))
+        return groups.iteritems()
+
+    def save_score(self, user, level, score):
+        return self.shard(level).save_score(user, level, score)
+
+    def save_scores(self, scores):
+        """
+        Same as Levels.save_scores, a call per shard with the scores of its levels
+        """
+        by_shard = {}
+        for user, level, score in scores:
+            by_shard.setdefault(self.shard(level), []).append((user, level, score))
+        saved = []
+        for shard, shard_scores in by_shard.iteritems():
+            saved.extend(shard.save_scores(shard_scores))
+        return saved
+
+    def get_version(self, level):
+        return self.shard(level).get_version(level)
+
+    def get_highest_scores(self, level):
+        return self.shard(level).get_highest_scores(level)
+
+    def get_highest_scores_many(self, levels):
+        """
+        Same as Levels.get_highest_scores_many, a manager round trip per shard
+        """
+        result = [None] * len(levels)
+        for shard, positions in self._group(levels):
+            shard_levels = [level for _i, level in positions]
+            for (i, _level), scores in zip(positions, shard.get_highest_scores_many(shard_levels)):
+                result[i] = scores
+        return result
+
+    def dump(self):
+        return itertools.chain.from_iterable(shard.dump() for shard in self.shards)
+
+    def stats(self):
+        return {'shards': [shard.stats() for shard in self.shards]}
+
+    def render(self):
+        return render_stripes([shard.locks for shard in self.shards])
+
+
+class ShardedLevelsDict(object):
+    """
+    LevelsDict interface over a LevelsDict proxy per shard of a ShardedLevels, each level in the sync manager
+    of its shard (e.g. the cached high score lists, see cache.RenderCache), so no manager serves them all
+    """
+    def __init__(self, levels):
+        """
+        :param levels: forked ShardedLevels
+        """
+        self.levels = levels
+        self.dicts = dict((shard, shard.manager.LevelsDict()) for shard in levels.shards)
+
+    def _group(self, keys):
+        """
+        Group the keys (levels) by dictionary, returns (dictionary, [(position of the key, key), ...]) pairs
+        """
+        return [(self.dicts[shard], positions) for shard, positions in self.levels._group(keys)]
+
+    def get(self, key, default=None):
+        return self.dicts[self.levels.shard(key)].get(key, default)
+
+    def __setitem__(self, key, value):
+        self.dicts[self.levels.shard(key)][key] = value
+
+    def get_many(self, keys):
+        """
+        Same as LevelsDict.get_many, a manager round trip per shard
+        """
+        result = [None] * len(keys)
+        for levels_dict, positions in self._group(keys):
+            for (i, _key), value in zip(positions, levels_dict.get_many([key for _i, key in positions])):
+                result[i] = value
+        return result
+
+    def update(self, entries):
+        groups = {}
+        for key, value in entries.iteritems():
+            groups.setdefault(self.levels.shard(key), {})[key] = value
+        for shard, shard_entries in groups.iteritems():
+            self.dicts[shard].update(shard_entries)
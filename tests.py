@@ -1,14 +1,46 @@
 import os
 import time
+import signal
+import socket
+import pickle
+import shutil
+import tempfile
+import Queue
 import random
 import subprocess
 import threading
 import unittest
+import logging
+import logging.handlers
+import pstats
 import requests
 import storage
 from mock import patch
-from storage import NUM_TOP_SCORES, UserToken
-from users import UserTokenSigned
+from storage import (NUM_TOP_SCORES, UserToken, Levels, ShardedLevels, LevelsDict, ShardedLevelsDict, UsersStored,
+                     CountingProxy)
+import shm_levels
+from shm_levels import SharedMemoryLevels, StorageFullError
+from locks import StripedLock, render_stripes
+from topscores import TopScores
+from sessions import SessionIndex
+import compact_users
+from compact_users import CompactUsersStored
+from server import ThreadedHTTPServer, Handler, render_response
+import event_server
+from event_server import EventLoopHTTPServer, _Connection
+from responses import Response, ResponseNotFound, ResponseNotAllowed
+from wal import ScoreLog, DurableLevels, DurableUsers, recover
+from snapshot import Snapshot, write_snapshot
+from cache import RenderCache, LocalRenderCache
+from urls import Urls
+from logs import start_queued_logging, set_sample_rate, sampled
+from metrics import Metrics, NOT_FOUND
+from profiling import RequestProfiler
+from ingest import ScoreQueue, aggregate
+from views import (LoginView, ScoreView, BatchScoreView, HighestScoreView, BatchHighestScoreView, RankView,
+                   RankRangeView)
+from ranks import IndexableSkiplist, RankIndex, RankedLevels
+from users import UserTokenSigned, UsersNonStored, SESSION_KEY_EXPIRATION
 
 
 class TestUserToken(unittest.TestCase):
@@ -82,6 +114,872 @@ class TestUserTokenSigned(unittest.TestCase):
         self.assertEqual(u_id, None)
 
 
+class TestUsersNonStored(unittest.TestCase):
+    def setUp(self):
+        self.users = UsersNonStored(cache_size=2)
+
+    def test_no_session_metrics(self):
+        self.users.login(103)
+        self.assertEqual(self.users.render(), '')
+
+    def test_cached_validation(self):
+        token = self.users.login(103)
+        self.assertEqual(self.users.validate(token), 103)
+        with patch.object(UserTokenSigned, 'parse') as parse_mock:
+            self.assertEqual(self.users.validate(token), 103)
+            self.assertFalse(parse_mock.called)
+
+    def test_invalid_not_cached(self):
+        token = self.users.login(103)
+        self.assertIsNone(self.users.validate('AB' + token[2:]))
+        self.assertIsNone(self.users.validate('not a token'))
+        self.assertEqual(len(self.users.validated), 0)
+
+    @patch.object(storage.time, 'time')
+    def test_cached_token_expires(self, time_mock):
+        now = 1501546318
+        time_mock.return_value = now
+        token = self.users.login(103)
+        self.assertEqual(self.users.validate(token), 103)
+        time_mock.return_value = now + SESSION_KEY_EXPIRATION + 1
+        self.assertIsNone(self.users.validate(token))
+        self.assertNotIn(token, self.users.validated)
+
+    def test_bounded(self):
+        tokens = [self.users.login(user_id) for user_id in (1, 2, 3)]
+        for user_id, token in zip((1, 2, 3), tokens):
+            self.assertEqual(self.users.validate(token), user_id)
+        self.assertEqual(list(self.users.validated), tokens[1:])
+
+
+class TestSessionIndex(unittest.TestCase):
+    @patch.object(storage.time, 'time')
+    def test_expire(self, time_mock):
+        now = 1501546318
+        time_mock.return_value = now
+        sessions = SessionIndex(expiration=10)
+        sessions.add(1, 'token1', now)
+        sessions.add(2, 'token2', now - 5)
+        sessions.add(3, 'token3', now - 20)  # already expired
+        self.assertEqual(sessions.live_sessions(), 2)
+        self.assertEqual(sessions.get(3), None)
+
+        time_mock.return_value = now + 6  # removed at most one slot after expiring
+        sessions.add(1, 'token1b', now + 6)  # the old session of the user must not remove the new one
+        self.assertEqual(sessions.live_sessions(), 1)
+        self.assertEqual(sessions.get(2), None)
+
+        time_mock.return_value = now + 11
+        self.assertEqual(sessions.live_sessions(), 1)
+        self.assertEqual(sessions.get(1), 'token1b')
+
+        time_mock.return_value = now + 1000
+        self.assertEqual(sessions.live_sessions(), 0)
+        self.assertTrue(all(not slot for slot in sessions.wheel))
+
+    def test_users_stored(self):
+        users = UsersStored(forked=True)
+        token = users.login(7)
+        self.assertEqual(users.validate(token), 7)
+        self.assertEqual(users.stats(), {'live_sessions': 1})
+        self.assertIn('users_live_sessions 1\n', users.render())
+        self.assertEqual(list(users.dump()), [(7, token)])
+
+
+class TestCompactUsersStored(unittest.TestCase):
+    def setUp(self):
+        self.users = CompactUsersStored(forked=False, max_users=4)
+
+    def test_validate(self):
+        token = self.users.login(7)
+        self.assertEqual(self.users.validate(token), 7)
+        new_token = self.users.login(7)
+        self.assertIsNone(self.users.validate(token))
+        self.assertEqual(self.users.validate(new_token), 7)
+        self.assertIsNone(self.users.validate(UserToken.get(8)))  # never logged in
+        self.assertEqual(list(self.users.dump()), [(7, new_token)])
+
+    def test_collisions(self):
+        tokens = dict((user_id, self.users.login(user_id)) for user_id in (1, 5, 9, 2))
+        for user_id, token in tokens.items():
+            self.assertEqual(self.users.validate(token), user_id)
+        self.assertEqual(self.users.stats(), {'live_sessions': 4, 'max_users': 4, 'slots_used': 4})
+        self.assertIn('users_slots_used 4\n', self.users.render())
+        self.assertRaises(StorageFullError, self.users.login, 3)
+
+    def test_reuse_expired_slots(self):
+        for user_id in (1, 5, 9, 2):
+            self.users.login(user_id)
+        self.assertRaises(StorageFullError, self.users.login, 3)
+
+        with patch.object(storage.time, 'time') as time_mock:
+            time_mock.return_value = time.time() + SESSION_KEY_EXPIRATION + 1
+            self.assertEqual(self.users.live_sessions(), 0)
+            with self.users.lock:
+                self.assertEqual(self.users._claim_slot(3), 3 * 20)  # slot of the expired session of user 9
+            self.users.login(3)
+        self.assertEqual(self.users.stats()['slots_used'], 4)  # the slot was reused
+
+    def test_bounded_probing(self):
+        users = CompactUsersStored(forked=False, max_users=64)
+        users.max_probe = 4
+        for user_id in xrange(64):
+            users.login(user_id)
+        # every slot is used, an absent user is only looked for in its first max_probe slots
+        with patch.object(compact_users, '_KEY', wraps=compact_users._KEY) as key_struct:
+            self.assertIsNone(users.validate(UserToken.get(64)))
+            self.assertEqual(key_struct.unpack_from.call_count, 4)
+        self.assertRaises(StorageFullError, users.login, 64)
+        self.assertEqual(users.validate(users.login(63)), 63)
+
+
+class TestUrls(unittest.TestCase):
+    def setUp(self):
+        self.urls = Urls()
+
+    def test_match(self):
+        for path, klass, kwargs in [('/4711/login', LoginView, {'user_id': '4711'}),
+                                    ('/4711/login/', LoginView, {'user_id': '4711'}),
+                                    ('/2/score?sessionkey=abc', ScoreView, {'level_id': '2'}),
+                                    ('/scores/', BatchScoreView, {}),
+                                    ('/2/highscorelist', HighestScoreView, {'level_id': '2'}),
+                                    ('/highscorelists?levels=1,2', BatchHighestScoreView, {}),
+                                    ('/2/rank/4711', RankView, {'level_id': '2', 'user_id': '4711'}),
+                                    ('/2/ranks?from=1&to=5', RankRangeView, {'level_id': '2'}),
+                                    ('http://localhost:8080/3/login', LoginView, {'user_id': '3'})]:
+            view = self.urls.match(path)
+            self.assertIsInstance(view, klass)
+            for name, value in kwargs.items():
+                self.assertEqual(getattr(view, name), value)
+
+    def test_no_match(self):
+        for path in ['', '/', '/login', '/a1/login', '/1/login//', '/1/2/login', '/scores/1', '//scores',
+                     '/1/logins', '/-1/score']:
+            self.assertIsNone(self.urls.match(path), path)
+
+    def test_lazy_query_params(self):
+        view = self.urls.match('/2/score?sessionkey=abc&x=1')
+        self.assertIsNone(view._query_params)
+        self.assertEqual(view._get_query_param('sessionkey'), 'abc')
+        self.assertEqual(view.query_params, {'sessionkey': ['abc'], 'x': ['1']})
+
+
+class TestTopScores(unittest.TestCase):
+    def setUp(self):
+        self.scores = TopScores(3)
+
+    def test_sorted(self):
+        for user, score in [(1, 10), (2, 30), (3, 20)]:
+            self.assertTrue(self.scores.add(user, score))
+        self.assertEqual(self.scores.items(), [(2, 30), (3, 20), (1, 10)])
+
+    def test_only_highest_score(self):
+        self.assertTrue(self.scores.add(1, 10))
+        self.assertFalse(self.scores.add(1, 5))
+        self.assertTrue(self.scores.add(1, 15))
+        self.assertEqual(self.scores.items(), [(1, 15)])
+
+    def test_evict_lowest(self):
+        for user, score in [(1, 10), (2, 30), (3, 20)]:
+            self.scores.add(user, score)
+        self.assertFalse(self.scores.add(4, 5))
+        self.assertTrue(self.scores.add(4, 25))
+        self.assertEqual(self.scores.items(), [(2, 30), (4, 25), (3, 20)])
+        self.assertTrue(self.scores.add(1, 40))
+        self.assertEqual(self.scores.items(), [(1, 40), (2, 30), (4, 25)])
+
+    def test_pickle(self):
+        self.scores.add(1, 10)
+        self.scores.add(2, 30)
+        copy = pickle.loads(pickle.dumps(self.scores))
+        self.assertEqual(copy.items(), [(2, 30), (1, 10)])
+        self.assertFalse(copy.add(2, 20))
+
+
+class TestLevels(unittest.TestCase):
+    def setUp(self):
+        self.levels = Levels(forked=False, top_scores=2)
+
+    def test_empty_level(self):
+        self.assertEqual(self.levels.get_highest_scores(3), [])
+
+    def test_top_scores(self):
+        for user in range(1, 5):
+            self.levels.save_score(user, 1, user * 10)
+        self.levels.save_score(3, 1, 50)
+        self.assertEqual(self.levels.get_highest_scores(1), [(3, 50), (4, 40)])
+
+    def test_save_scores(self):
+        self.levels.save_score(1, 1, 10)
+        self.levels.save_scores([(2, 1, 20), (2, 2, 5), (3, 1, 5), (2, 1, 30), (4, 17, 1)])
+        self.assertEqual(self.levels.get_highest_scores(1), [(2, 30), (1, 10)])
+        self.assertEqual(self.levels.get_highest_scores(2), [(2, 5)])
+        self.assertEqual(self.levels.get_highest_scores(17), [(4, 1)])
+        self.assertEqual(self.levels.get_highest_scores_many([17, 3, 1]), [[(4, 1)], [], [(2, 30), (1, 10)]])
+
+    def test_version_bumped_on_change(self):
+        version = self.levels.get_version(1)
+        self.levels.save_score(1, 1, 10)
+        self.assertEqual(self.levels.get_version(1), version + 1)
+        self.levels.save_score(1, 1, 5)  # lower score, the table does not change
+        self.assertEqual(self.levels.get_version(1), version + 1)
+
+
+class TestShardedLevels(TestLevels):
+    def setUp(self):
+        self.levels = ShardedLevels(4, forked=False, top_scores=2)
+
+    def test_levels_spread_over_shards(self):
+        shards = [self.levels.shard(level) for level in range(1, 101)]
+        for shard in self.levels.shards:
+            self.assertGreater(shards.count(shard), 10)
+        # the levels of a shard are spread over its lock stripes too
+        stripes = set(level % 16 for level in range(1, 101) if self.levels.shard(level) is self.levels.shards[0])
+        self.assertGreater(len(stripes), 8)
+
+    def test_dump_and_snapshot(self):
+        self.levels.save_scores([(1, level, level) for level in range(1, 9)])
+        self.assertEqual(sorted(self.levels.dump()), [(level, [(1, level)]) for level in range(1, 9)])
+        snapshot = object()
+        self.levels.snapshot = snapshot
+        self.assertTrue(all(shard.snapshot is snapshot for shard in self.levels.shards))
+
+    def test_render(self):
+        self.levels.save_score(1, 1, 10)
+        shard = self.levels.shards.index(self.levels.shard(1))
+        lines = self.levels.render().splitlines()
+        self.assertIn('lock_stripe_acquired_total{shard="%s",stripe="1"} 1' % shard, lines)
+        self.assertEqual(len([line for line in lines if line.startswith('lock_stripe_contended_total{')]), 4 * 16)
+
+    def test_forked(self):
+        levels = ShardedLevels(2, forked=True)
+        pid = os.fork()
+        if not pid:
+            levels.save_scores([(1, level, 10) for level in range(1, 5)])
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(levels.get_highest_scores_many(range(1, 5)), [[(1, 10)]] * 4)
+        self.assertNotEqual(levels.shards[0].manager.address, levels.shards[1].manager.address)
+
+    def test_cache_entries_per_shard(self):
+        levels = ShardedLevels(2, forked=True)
+        cache = RenderCache(ShardedLevelsDict(levels), forked=False)
+        cache.put_many(dict((level, (0, '%s=10' % level)) for level in range(1, 9)))
+        cache.put(9, 1, '9=10')
+        self.assertEqual(cache.get_many(range(1, 10), [0] * 8 + [1]), ['%s=10' % level for level in range(1, 10)])
+        self.assertEqual(cache.get(9, 1), '9=10')
+        for shard, levels_dict in cache.entries.dicts.iteritems():
+            self.assertEqual(sorted(levels_dict.keys()),
+                             [level for level in range(1, 10) if levels.shard(level) is shard])
+
+
+class TestIndexableSkiplist(unittest.TestCase):
+    def test_against_sorted_list(self):
+        rnd = random.Random(3)
+        skiplist = IndexableSkiplist(levels=6)
+        values = []
+        for _ in xrange(2000):
+            if values and rnd.random() < 0.3:
+                value = values.pop(rnd.randrange(len(values)))
+                skiplist.remove(value)
+            else:
+                value = rnd.randrange(10 ** 6)
+                if value in values:
+                    continue
+                values.append(value)
+                skiplist.insert(value)
+        values.sort()
+        self.assertEqual(len(skiplist), len(values))
+        self.assertEqual([skiplist[i] for i in xrange(len(values))], values)
+        self.assertEqual(skiplist.slice(10, 20), values[10:20])
+        self.assertEqual(skiplist.slice(len(values) - 2, len(values) + 5), values[-2:])
+        for value in values[::50]:
+            self.assertEqual(skiplist.rank(value), values.index(value))
+        self.assertRaises(KeyError, skiplist.remove, -1)
+        self.assertRaises(IndexError, skiplist.__getitem__, len(values))
+
+
+class TestRankIndex(unittest.TestCase):
+    def setUp(self):
+        self.ranks = RankIndex()
+
+    def test_rank(self):
+        self.ranks.update_many([(1, 5, 10), (2, 5, 30), (3, 5, 20), (1, 5, 40), (4, 5, 20), (2, 5, 5), (1, 6, 1)])
+        self.assertEqual(self.ranks.rank(5, 1), (1, 40))
+        self.assertEqual(self.ranks.rank(5, 2), (2, 30))
+        self.assertEqual(self.ranks.rank(5, 3), (3, 20))
+        self.assertEqual(self.ranks.rank(5, 4), (4, 20))  # ties ordered by user id, as the high score lists
+        self.assertEqual(self.ranks.rank(5, 5), None)
+        self.assertEqual(self.ranks.rank(7, 1), None)
+        self.assertEqual(self.ranks.count(5), 4)
+        self.assertEqual(self.ranks.stats(), {'levels': 2, 'scores': 5})
+
+    def test_range(self):
+        self.ranks.update_many([(user, 1, user * 10) for user in xrange(1, 201)])
+        self.assertEqual(self.ranks.range(1, 100, 102), [(100, 101, 1010), (101, 100, 1000), (102, 99, 990)])
+        self.assertEqual(self.ranks.range(1, 199, 300), [(199, 2, 20), (200, 1, 10)])
+        self.assertEqual(self.ranks.range(2, 1, 10), [])
+
+    def test_ranked_levels(self):
+        levels = RankedLevels(Levels(forked=False, top_scores=2), self.ranks)
+        for user in xrange(1, 5):
+            levels.save_score(user, 1, user * 10)
+        levels.save_scores([(5, 1, 5), (5, 2, 1)])
+        self.assertEqual(levels.get_highest_scores(1), [(4, 40), (3, 30)])
+        self.assertEqual(self.ranks.range(1, 3, 5), [(3, 2, 20), (4, 1, 10), (5, 5, 5)])
+        self.assertEqual(self.ranks.rank(2, 5), (1, 1))
+        self.assertEqual(levels.stats()['ranks'], {'levels': 2, 'scores': 6})
+
+
+class TestRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = RenderCache(LevelsDict(), forked=False)
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.cache.get(1, 0), None)
+        self.cache.put(1, 0, '1=10')
+        self.assertEqual(self.cache.get(1, 0), '1=10')
+        self.assertEqual(self.cache.get(1, 1), None)  # stale version
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_get_many(self):
+        self.cache.put_many({1: (0, '1=10'), 2: (3, '2=20')})
+        self.assertEqual(self.cache.get_many([1, 2, 3], [0, 4, 0]), ['1=10', None, None])
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 2})
+
+
+class TestLocalRenderCache(unittest.TestCase):
+    def setUp(self):
+        self.shared = RenderCache(LevelsDict(), forked=False)
+        self.cache = LocalRenderCache(self.shared, size=2, forked=False)
+
+    def test_read_through(self):
+        self.shared.put(1, 0, '1=10')
+        self.assertEqual(self.cache.get(1, 0), '1=10')  # from the shared cache
+        self.shared.entries.clear()
+        self.assertEqual(self.cache.get(1, 0), '1=10')  # local
+        self.assertEqual(self.cache.get(1, 1), None)  # stale version
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'local_hits': 1, 'local_misses': 2})
+        lines = self.cache.render().splitlines()
+        self.assertIn('highscores_cache_hits_total{cache="shared"} 1', lines)
+        self.assertIn('highscores_cache_misses_total{cache="local"} 2', lines)
+
+    def test_lru_eviction(self):
+        self.cache.put_many({1: (0, '1=10'), 2: (0, '2=20')})
+        self.cache.get(1, 0)
+        self.cache.put(3, 0, '3=30')  # evicts 2, the least recently used
+        self.shared.entries.clear()
+        self.assertEqual(self.cache.get_many([1, 2, 3], [0, 0, 0]), ['1=10', None, '3=30'])
+
+    def test_without_shared_cache(self):
+        cache = LocalRenderCache(None, size=2, forked=False)
+        self.assertEqual(cache.get(1, 0), None)
+        cache.put(1, 0, '1=10')
+        self.assertEqual(cache.get_many([1, 2], [0, 0]), ['1=10', None])
+        self.assertEqual(cache.stats(), {'local_hits': 1, 'local_misses': 2})
+
+
+class TestSharedMemoryLevels(unittest.TestCase):
+    def setUp(self):
+        self.levels = SharedMemoryLevels(forked=False, max_levels=8)
+
+    def test_empty_level(self):
+        self.assertEqual(self.levels.get_highest_scores(3), [])
+
+    def test_highest_score_per_user(self):
+        self.levels.save_score(1000, 3, 25000)
+        self.levels.save_score(1000, 3, 35000)
+        self.levels.save_score(1000, 3, 100)
+        self.assertEqual(self.levels.get_highest_scores(3), [(1000, 35000)])
+
+    def test_top_scores(self):
+        for user in range(101, 121 + NUM_TOP_SCORES):
+            self.levels.save_score(user, 10, user - 100)
+        expected = [(user, user - 100) for user in range(120 + NUM_TOP_SCORES, 120, -1)]
+        self.assertEqual(self.levels.get_highest_scores(10), expected)
+
+    def test_colliding_levels(self):
+        self.levels.save_score(1, 2, 10)
+        with patch('shm_levels.SHARD_HASH_MULTIPLIER', 0):  # every level starts probing at the first slot
+            self.levels.save_score(1, 10, 20)
+            self.assertEqual(self.levels.get_highest_scores(10), [(1, 20)])
+            self.assertEqual(self.levels.get_highest_scores(18), [])
+        self.assertEqual(self.levels.get_highest_scores(2), [(1, 10)])
+
+    def test_bounded_probing(self):
+        levels = SharedMemoryLevels(forked=False, max_levels=1024)
+        levels.save_scores([(1, level, 10) for level in range(512)])  # consecutive ids, no cluster
+        with patch.object(shm_levels, '_HEADER', wraps=shm_levels._HEADER) as header:
+            self.assertEqual(levels.get_highest_scores(1024 + 100), [])
+            self.assertLessEqual(header.unpack_from.call_count, shm_levels.MAX_PROBE)
+
+        self.levels.max_probe = 2
+        with patch('shm_levels.SHARD_HASH_MULTIPLIER', 0):
+            self.levels.save_scores([(1, 1, 10), (1, 2, 10)])
+            # only the first max_probe slots of a level are probed, even if the table is not full
+            self.assertRaises(StorageFullError, self.levels.save_score, 1, 3, 10)
+
+    def test_save_scores(self):
+        self.levels.save_scores([(2, 1, 20), (2, 2, 5), (3, 1, 5), (2, 1, 30)])
+        self.assertEqual(self.levels.get_highest_scores(1), [(2, 30), (3, 5)])
+        self.assertEqual(self.levels.get_highest_scores(2), [(2, 5)])
+
+    def test_top_scores_size(self):
+        levels = SharedMemoryLevels(forked=False, max_levels=8, top_scores=2)
+        for user in range(1, 5):
+            levels.save_score(user, 1, user * 10)
+        self.assertEqual(levels.get_highest_scores(1), [(4, 40), (3, 30)])
+
+    def test_full(self):
+        for level in range(8):
+            self.levels.save_score(1, level, 10)
+        self.assertRaises(StorageFullError, self.levels.save_score, 1, 8, 10)
+
+
+class TestStripedLock(unittest.TestCase):
+    def setUp(self):
+        self.locks = StripedLock(4, forked=False)
+
+    def test_same_stripe_per_key(self):
+        self.assertIs(self.locks.stripe(1), self.locks.stripe(5))
+        self.assertIsNot(self.locks.stripe(1), self.locks.stripe(2))
+
+    def test_stats(self):
+        with self.locks.stripe(1):
+            pass
+        with self.locks.stripe(2):
+            pass
+        stats = self.locks.stats()
+        self.assertEqual(stats['acquired'], 2)
+        self.assertEqual(stats['contended'], 0)
+
+    def test_contended(self):
+        stripe = self.locks.stripe(3)
+        stripe.lock.acquire()
+        th = threading.Thread(target=lambda: stripe.__enter__() and stripe.__exit__(None, None, None))
+        th.start()
+        time.sleep(0.05)
+        stripe.lock.release()
+        th.join(1)
+        stats = self.locks.stats()
+        self.assertEqual(stats['contended'], 1)
+        self.assertEqual(stats['contended_per_stripe'], [0, 0, 0, 1])
+        lines = render_stripes([self.locks]).splitlines()
+        self.assertIn('lock_stripe_acquired_total{stripe="3"} 1', lines)
+        self.assertIn('lock_stripe_contended_total{stripe="3"} 1', lines)
+        self.assertIn('lock_stripe_contended_total{stripe="0"} 0', lines)
+
+    def test_metrics(self):
+        metrics = Metrics([], forked=False)
+        self.locks.set_metrics(metrics)
+        with self.locks.stripe(1):
+            time.sleep(0.01)
+        values = metrics.as_dict()
+        self.assertEqual(values['lock_wait_count'], 1)
+        self.assertEqual(values['lock_hold_count'], 1)
+        self.assertGreaterEqual(values['lock_hold_sum_us'], 10000)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_observe_request(self):
+        metrics = Metrics(['ScoreView'], forked=True, shards=2)
+        metrics.observe_request('ScoreView', 204, 0.0003)
+        metrics.observe_request('ScoreView', 401, 2)
+        metrics.observe_request(NOT_FOUND, 404, 0.00001)
+        pid = os.fork()
+        if not pid:
+            metrics.observe_request('ScoreView', 204, 0.0003)  # the shards are shared
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        values = metrics.as_dict()
+        self.assertEqual(values['requests_ScoreView'], 3)
+        self.assertEqual(values['responses_204'], 2)
+        self.assertEqual(values['responses_other'], 0)
+        self.assertEqual(values['requests_NotFound'], 1)
+
+        lines = metrics.render().splitlines()
+        self.assertIn('requests_total{view="ScoreView"} 3', lines)
+        self.assertIn('request_latency_seconds_bucket{view="ScoreView",le="0.00025"} 0', lines)
+        self.assertIn('request_latency_seconds_bucket{view="ScoreView",le="0.0005"} 2', lines)
+        self.assertIn('request_latency_seconds_bucket{view="ScoreView",le="1.0"} 2', lines)
+        self.assertIn('request_latency_seconds_bucket{view="ScoreView",le="+Inf"} 3', lines)
+        self.assertIn('request_latency_seconds_count{view="ScoreView"} 3', lines)
+        self.assertIn('responses_total{code="401"} 1', lines)
+
+    def test_manager_calls(self):
+        metrics = Metrics([], forked=True)
+        levels = Levels(forked=True)
+        CountingProxy.metrics = metrics
+        try:
+            levels.save_score(1, 1, 10)
+            levels.get_highest_scores(1)
+        finally:
+            CountingProxy.metrics = None
+        self.assertEqual(metrics.as_dict()['manager_calls_LevelsDict'], 3)  # get, set, get
+
+
+class TestScoreLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'scores.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_recover(self):
+        log = ScoreLog(self.path, forked=False)
+        levels = DurableLevels(Levels(forked=False, top_scores=2), log)
+        users = DurableUsers(UsersStored(forked=False), log)
+        token = users.login(7)
+        levels.save_score(1, 1, 10)
+        levels.save_score(1, 1, 5)  # not logged, the table does not change
+        levels.save_scores([(2, 1, 20), (3, 1, 30), (2, 2, 5)])
+        log.close()
+        self.assertEqual(log.stats(), {'records': 5, 'fsyncs': 3})
+
+        with open(self.path, 'a') as log_file:
+            log_file.write('S 4 1')  # partial record
+
+        new_levels = Levels(forked=False, top_scores=2)
+        new_users = UsersStored(forked=False)
+        recover(self.path, new_levels, new_users)
+        self.assertEqual(new_levels.get_highest_scores(1), [(3, 30), (2, 20)])
+        self.assertEqual(new_levels.get_highest_scores(2), [(2, 5)])
+        self.assertEqual(new_users.validate(token), 7)
+
+        # the log was compacted to the current state
+        with open(self.path) as log_file:
+            self.assertEqual(len(log_file.readlines()), 4)
+
+    def test_full_batch(self):
+        log = ScoreLog(self.path, forked=False)
+        levels = DurableLevels(SharedMemoryLevels(forked=False, max_levels=4), log)
+        levels.save_scores([(1, level, 10) for level in range(3)])
+        self.assertRaises(StorageFullError, levels.save_scores, [(1, 0, 20), (1, 5, 10), (1, 6, 10)])
+        # none of the batch was saved, so nothing is served without being logged
+        self.assertEqual(levels.get_highest_scores(0), [(1, 10)])
+        self.assertEqual(log.stats()['records'], 3)
+        self.assertEqual(levels.save_scores([(1, 0, 20), (1, 5, 10)]), [(1, 0, 20), (1, 5, 10)])
+        self.assertEqual(log.stats()['records'], 5)
+        log.close()
+
+    def test_group_commit(self):
+        log = ScoreLog(self.path, forked=False)
+        with patch('wal._fsync') as fsync_mock:
+            log.append(['S 1 1 1\n'])
+            log.append(['S 1 1 2\n'])
+            self.assertEqual(fsync_mock.call_count, 2)
+
+            os.write(log.fd, 'S 1 1 3\n')  # another writer, still waiting for the lock
+            log.append(['S 1 1 4\n'])
+            self.assertEqual(fsync_mock.call_count, 3)
+            log.append([])  # the other writer gets the lock, its record is already durable
+            self.assertEqual(fsync_mock.call_count, 3)
+        log.close()
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'scores.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write_and_read(self):
+        levels = Levels(forked=False, top_scores=2)
+        levels.save_scores([(1, 5, 10), (2, 5, 20), (3, 5, 30), (1, 2, 7)])
+        users = UsersStored(forked=False)
+        token = users.login(7)
+        write_snapshot(self.path, levels, users)
+
+        snapshot = Snapshot(self.path)
+        self.assertEqual(list(snapshot.iter_levels()), [2, 5])
+        self.assertEqual(snapshot.get_scores(5), [(3, 30), (2, 20)])
+        self.assertEqual(snapshot.get_scores(2), [(1, 7)])
+        self.assertEqual(snapshot.get_scores(3), [])
+        self.assertEqual(snapshot.get_token(7), token)
+        self.assertIsNone(snapshot.get_token(8))
+
+    def check_warm_start(self, levels_factory):
+        levels = levels_factory()
+        levels.save_scores([(1, 5, 10), (2, 5, 20), (1, 2, 7)])
+        write_snapshot(self.path, levels)
+
+        new_levels = levels_factory()
+        new_levels.snapshot = Snapshot(self.path)
+        self.assertEqual(new_levels.get_highest_scores(5), [(2, 20), (1, 10)])
+        self.assertEqual(new_levels.get_highest_scores_many([2, 3]), [[(1, 7)], []])
+        self.assertTrue(new_levels.save_score(3, 5, 15))
+        self.assertFalse(new_levels.save_score(4, 5, 1))
+        self.assertEqual(new_levels.get_highest_scores(5), [(2, 20), (3, 15)])
+        # only the changed level is in the store
+        self.assertEqual([level for level, _scores in new_levels.dump()], [5])
+
+        # a new snapshot merges the store and the previous snapshot
+        write_snapshot(self.path, new_levels)
+        snapshot = Snapshot(self.path)
+        self.assertEqual(snapshot.get_scores(5), [(2, 20), (3, 15)])
+        self.assertEqual(snapshot.get_scores(2), [(1, 7)])
+
+    def test_warm_start(self):
+        self.check_warm_start(lambda: Levels(forked=False, top_scores=2))
+
+    def test_warm_start_shm(self):
+        self.check_warm_start(lambda: SharedMemoryLevels(forked=False, max_levels=16, top_scores=2))
+
+    def test_users_warm_start(self):
+        users = UsersStored(forked=False)
+        token = users.login(7)
+        write_snapshot(self.path, Levels(forked=False), users)
+
+        new_users = UsersStored(forked=False)
+        new_users.snapshot = Snapshot(self.path)
+        self.assertEqual(new_users.validate(token), 7)
+        new_token = new_users.login(7)
+        self.assertEqual(new_users.validate(new_token), 7)
+        self.assertIsNone(new_users.validate(token))
+
+
+class TestRenderResponse(unittest.TestCase):
+    def test_default_response(self):
+        res = render_response(ResponseNotFound())
+        head, body = res.split('\r\n\r\n')
+        lines = head.split('\r\n')
+        self.assertEqual(lines[0], 'HTTP/1.1 404 Not Found')
+        self.assertIn('Content-Type: text/html', lines)
+        self.assertIn('Content-Length: %s' % len(body), lines)
+        self.assertIn('Connection: keep-alive', lines)
+        self.assertTrue(any(line.startswith('Date: ') for line in lines))
+        # encoded once per class
+        self.assertIs(ResponseNotFound().encode_headers(), ResponseNotFound().encode_headers())
+
+    def test_response(self):
+        res = render_response(Response(200, {'X-Test': '1'}, 'data'), close=True)
+        self.assertTrue(res.startswith('HTTP/1.1 200 OK\r\nContent-Length: 4\r\nContent-Type: text/plain\r\n'))
+        self.assertIn('\r\nX-Test: 1\r\n', res)
+        self.assertTrue(res.endswith('\r\nConnection: close\r\n\r\ndata'))
+
+    def test_extra_headers(self):
+        res = render_response(ResponseNotAllowed({'Allow': 'GET'}), head=True)
+        self.assertIn('\r\nAllow: GET\r\n', res)
+        self.assertTrue(res.endswith('\r\n\r\n'))
+
+
+class TestQueuedLogging(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test_logs')
+        self.logger.propagate = False
+        self.handler = logging.handlers.BufferingHandler(100)
+        self.writer = start_queued_logging(self.logger, [self.handler])
+
+    def tearDown(self):
+        self.logger.handlers = []
+        set_sample_rate(1.0)
+
+    def test_records_written_by_writer(self):
+        self.logger.warning('message %s', 1)
+        pid = os.fork()
+        if not pid:
+            self.logger.warning('from child %s', object())  # args that can't be pickled
+            os._exit(0)
+        os.waitpid(pid, 0)
+        try:
+            raise ValueError('error')
+        except ValueError:
+            self.logger.error('exception', exc_info=True)
+        self.writer.stop()
+
+        messages = [record.getMessage() for record in self.handler.buffer]
+        self.assertEqual(messages[0], 'message 1')
+        self.assertTrue(messages[1].startswith('from child <object object'))
+        self.assertEqual(messages[2], 'exception')
+        self.assertIn('ValueError: error', logging.Formatter().format(self.handler.buffer[2]))
+        self.assertNotEqual(self.handler.buffer[1].process, os.getpid())
+
+    def test_sampling(self):
+        self.writer.stop()
+        set_sample_rate(0)
+        self.assertFalse(any(sampled() for _ in xrange(100)))
+        set_sample_rate(1)
+        self.assertTrue(all(sampled() for _ in xrange(100)))
+
+
+class TestRequestProfiler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @staticmethod
+    def functions(path):
+        return set(func for _file, _line, func in pstats.Stats(path).stats)
+
+    def test_merge_per_route(self):
+        profiler = RequestProfiler(self.dir, sample_rate=1, mode='forked')
+        self.assertEqual(profiler.run('ScoreView', sorted, [3, 1, 2]), [1, 2, 3])
+        pid = os.fork()
+        if not pid:
+            profiler.run('ScoreView', sum, [1, 2])
+            os._exit(0)
+        os.waitpid(pid, 0)
+        th = threading.Thread(target=profiler.run, args=('LoginView', max, [1, 2]))
+        th.start()
+        th.join()
+
+        self.assertEqual(profiler.merge(), 3)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['forked.LoginView.prof', 'forked.ScoreView.prof', 'spool'])
+        self.assertEqual(os.listdir(os.path.join(self.dir, 'spool')), [])
+        functions = self.functions(os.path.join(self.dir, 'forked.ScoreView.prof'))
+        self.assertIn('<sorted>', functions)
+        self.assertIn('<sum>', functions)
+        self.assertNotIn('<max>', functions)
+
+        # merged with the previous profiles of the route
+        profiler.run('LoginView', min, [1, 2])
+        self.assertEqual(profiler.merge(), 1)
+        functions = self.functions(os.path.join(self.dir, 'forked.LoginView.prof'))
+        self.assertIn('<max>', functions)
+        self.assertIn('<min>', functions)
+
+    def test_sampling(self):
+        self.assertFalse(any(RequestProfiler(self.dir, sample_rate=0).sampled() for _ in xrange(100)))
+        self.assertTrue(all(RequestProfiler(self.dir, sample_rate=1).sampled() for _ in xrange(100)))
+
+
+class TestScoreQueue(unittest.TestCase):
+    def setUp(self):
+        self.levels = Levels(forked=False)
+        self.queue = ScoreQueue(self.levels, batch_size=100, forked=True)
+
+    def test_aggregate(self):
+        self.assertEqual(sorted(aggregate([(1, 2, 10), (1, 2, 30), (1, 3, 5), (2, 2, 20), (1, 2, 15)])),
+                         [(1, 2, 30), (1, 3, 5), (2, 2, 20)])
+
+    def test_applied_in_batches(self):
+        with patch.object(self.levels, 'save_scores', wraps=self.levels.save_scores) as save_scores:
+            pid = os.fork()
+            if not pid:
+                for score in (10, 30, 20):
+                    self.queue.put(1, 2, score)
+                os._exit(0)
+            os.waitpid(pid, 0)
+            self.queue.put(2, 2, 5)
+            self.assertEqual(self.queue.stats()['depth'], 4)
+
+            self.queue.start()
+            self.queue.stop()
+            self.assertEqual(save_scores.call_count, 1)
+        self.assertEqual(sorted(save_scores.call_args[0][0]), [(1, 2, 30), (2, 2, 5)])
+        self.assertEqual(self.levels.get_highest_scores(2), [(1, 30), (2, 5)])
+        stats = self.queue.stats()
+        self.assertEqual((stats['depth'], stats['applied'], stats['batches']), (0, 4, 1))
+        self.assertGreater(stats['lag_max_ms'], 0)
+        self.assertIn('score_queue_depth 0\n', self.queue.render())
+
+    def test_failed_batch_retried(self):
+        self.queue.put(1, 2, 10)
+        self.queue.put(2, 2, 20)
+        with patch.object(self.levels, 'save_scores', side_effect=[IOError(), None]) as save_scores, \
+                patch('ingest.time.sleep') as sleep:
+            self.queue.apply_retrying(self.queue._receive()[0])
+        self.assertEqual(save_scores.call_count, 2)
+        sleep.assert_called_once_with(0.1)
+        self.assertEqual(self.queue.stats()['depth'], 0)
+
+    def test_failed_batch_applied_one_by_one(self):
+        def save_scores(scores):
+            if len(scores) > 1 or scores[0][0] == 2:
+                raise StorageFullError()
+        self.queue.put(1, 2, 10)
+        self.queue.put(2, 2, 20)
+        self.queue.put(3, 2, 30)
+        with patch.object(self.levels, 'save_scores', side_effect=save_scores) as mock_save_scores, \
+                patch('ingest.time.sleep') as sleep:
+            self.queue.apply_retrying(self.queue._receive()[0])
+        self.assertEqual(mock_save_scores.call_count, 1 + 3)
+        self.assertFalse(sleep.called)  # not a transient error, not retried
+        stats = self.queue.stats()
+        self.assertEqual((stats['depth'], stats['applied'], stats['dropped']), (0, 2, 1))
+        self.assertIn('score_queue_dropped_total 1\n', self.queue.render())
+
+    def test_transient_errors_applied_one_by_one(self):
+        self.queue.put(1, 2, 10)
+        self.queue.put(2, 2, 20)
+        side_effect = [EOFError()] * 5 + [None, None]
+        with patch.object(self.levels, 'save_scores', side_effect=side_effect) as save_scores, \
+                patch('ingest.time.sleep') as sleep:
+            self.queue.apply_retrying(self.queue._receive()[0])
+        self.assertEqual(save_scores.call_count, 5 + 2)
+        self.assertEqual([args[0][0] for args in sleep.call_args_list], [0.1, 0.2, 0.4, 0.8])
+        self.assertEqual(self.queue.stats()['applied'], 2)
+
+    def test_full_queue(self):
+        queue = ScoreQueue(self.levels, forked=False, buffer_size=4096)
+        queued = [queue.put(1, 1, score) for score in xrange(10000)]
+        self.assertFalse(all(queued))
+        self.assertEqual(queue.stats()['full'], queued.count(False))
+
+
+class TestThreadedHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadedHTTPServer(('localhost', 0), Handler, queue_size=1)
+
+    def tearDown(self):
+        self.server.server_close()
+
+    def test_reject_when_queue_full(self):
+        self.server.requests = Queue.Queue(1)
+        self.server.requests.put(None)
+        server_side, client_side = socket.socketpair()
+        self.server.process_request(server_side, ('localhost', 0))
+        res = client_side.recv(4096)
+        client_side.close()
+        self.assertTrue(res.startswith('HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertIn('Connection: close\r\n', res)
+
+
+class TestEventLoopHTTPServer(unittest.TestCase):
+    def setUp(self):
+        self.server = EventLoopHTTPServer(('localhost', 0), Handler.url_patterns, max_requests=0)
+        server_side, self.client_side = socket.socketpair()
+        self.client_side.settimeout(5)
+        self.conn = _Connection(server_side, ('localhost', 0))
+
+    def tearDown(self):
+        self.conn.sock.close()
+        self.client_side.close()
+        self.server.server_close()
+
+    def test_bad_content_length(self):
+        for content_length in ('-100000', '1e3', '', str(event_server.MAX_BODY_SIZE + 1)):
+            self.conn.inbuf = 'POST /1/score HTTP/1.1\r\nContent-Length: %s\r\n\r\n' % content_length
+            self.conn.outbuf = ''
+            self.conn.close_after_write = False
+            self.server._process(self.conn)
+            self.assertTrue(self.conn.outbuf.startswith('HTTP/1.1 400 Bad Request\r\n'))
+            self.assertEqual(self.conn.outbuf.count('HTTP/1.1 '), 1)
+            self.assertTrue(self.conn.close_after_write)
+
+    def test_output_bounded(self):
+        request = 'GET /unknown HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        self.conn.inbuf = request * 100
+        with patch.object(event_server, 'MAX_OUTPUT_SIZE', 1000):
+            self.server._process(self.conn)
+            self.assertLess(len(self.conn.outbuf), 2000)
+            answered = self.conn.outbuf.count('HTTP/1.1 404')
+            self.assertEqual(len(self.conn.inbuf), (100 - answered) * len(request))
+            self.server.poller.register(self.conn.fd, event_server.POLL_IN)
+            while self.conn.inbuf or self.conn.outbuf:
+                self.server._write(self.conn)  # the next requests are answered as the output drains
+        self.assertEqual(self.server.counters.get('requests'), 100)
+        data = ''
+        while data.count('HTTP/1.1 404') < 100:
+            data += self.client_side.recv(65536)
+
+
 format_data = (
     "<html>"
     "<head>"
@@ -117,6 +1015,7 @@ class IntegTestViews(unittest.TestCase):
     integration tests, are launched with the actual server running
     """
     DEFAULT_PORT = '8080'
+    LIVE_SESSIONS_METRIC = True
 
     @classmethod
     def setUpClass(cls):
@@ -135,6 +1034,40 @@ class IntegTestViews(unittest.TestCase):
             """kill -9 `ps aux | grep run_server.py | awk '{printf $2 " "}'` 2>/dev/null""",
             shell=True)
 
+    def test_metrics(self):
+        self.login_request(4711)
+        res = requests.get('http://localhost:%s/metrics' % self.DEFAULT_PORT)
+        self.assertEqual(res.status_code, 200)
+        lines = res.content.splitlines()
+        login_requests = [line for line in lines if line.startswith('requests_total{view="LoginView"} ')]
+        self.assertEqual(len(login_requests), 1)
+        self.assertGreaterEqual(int(login_requests[0].split()[1]), 1)
+        self.assertTrue(any(line.startswith('lock_wait_seconds_count ') for line in lines))
+        self.assertTrue(any(line.startswith('manager_calls_total{typeid="LevelsDict"} ') for line in lines))
+        self.assertTrue(any(line.startswith('highscores_cache_misses_total{cache=') for line in lines))
+        self.assertEqual(any(line.startswith('users_live_sessions ') for line in lines), self.LIVE_SESSIONS_METRIC)
+        self.assertTrue(any(line.startswith('http_server_reused_total ') for line in lines))
+        self.assertTrue(any(line.startswith('lock_stripe_contended_total{') for line in lines))
+
+    def test_rank_without_index(self):
+        res = requests.get('http://localhost:%s/1/rank/4711' % self.DEFAULT_PORT)
+        self.assertEqual(res.status_code, 404)
+
+    def test_pipelined_requests(self):
+        sock = socket.create_connection(('localhost', int(self.DEFAULT_PORT)))
+        sock.sendall('GET /1/highscorelist HTTP/1.1\r\nHost: localhost\r\n\r\n'
+                     'DELETE /1/login HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        data = ''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+        self.assertTrue(data.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(data.count('HTTP/1.1 '), 2)
+        self.assertTrue(data.endswith(ErrorResponse_405.value))
+
     def login_request(self, user_id):
         host = 'localhost'
         port = self.DEFAULT_PORT
@@ -154,6 +1087,13 @@ class IntegTestViews(unittest.TestCase):
         res = requests.post(url, data=str(score))
         return res
 
+    def save_scores(self, session_key, data):
+        host = 'localhost'
+        port = self.DEFAULT_PORT
+        url = 'http://%(host)s:%(port)s/scores?sessionkey=%(session_key)s' % locals()
+        res = requests.post(url, data=data)
+        return res
+
     def get_high_scores(self, level_id):
         host = 'localhost'
         port = self.DEFAULT_PORT
@@ -253,6 +1193,39 @@ class IntegTestViews(unittest.TestCase):
         self.assertEquals(res.status_code, 200)
         self.assertEqual(res.content, expected_res)
 
+    def test_batch_scores(self):
+        res = self.login_request(1001)
+        session_key = res.content
+        res = self.save_scores(session_key, '200=10\n201=20\nbad=1\n200=30\n202=%s\n' % 2 ** 32)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, '200=204\n201=204\nbad=400\n200=204\n202=400')
+        self.assertEqual(self.get_high_scores(200).content, '1001=30')
+        self.assertEqual(self.get_high_scores(201).content, '1001=20')
+
+    def test_batch_scores_unauthorized(self):
+        res = self.save_scores('bad_session_key', '200=10')
+        self.assert_error_resp(res, ErrorResponse_401)
+
+    def test_batch_scores_empty(self):
+        res = self.login_request(1001)
+        res = self.save_scores(res.content, '')
+        self.assert_error_resp(res, ErrorResponse_400)
+
+    def test_batch_high_scores(self):
+        res = self.login_request(1002)
+        self.save_score(res.content, 210, 100)
+        self.save_score(res.content, 212, 300)
+        self.get_high_scores(210)  # cached
+        url = 'http://localhost:%s/highscorelists?levels=210,211,212' % self.DEFAULT_PORT
+        res = requests.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, '210:1002=100\n211:\n212:1002=300')
+
+    def test_batch_high_scores_bad_level(self):
+        url = 'http://localhost:%s/highscorelists?levels=210,%s' % (self.DEFAULT_PORT, 2 ** 32)
+        res = requests.get(url)
+        self.assert_error_resp(res, ErrorResponse_400)
+
     def test_high_score_bad_level(self):
         res = self.get_high_scores(2 ** 32)
         self.assert_error_resp(res, ErrorResponse_400)
@@ -286,6 +1259,8 @@ class IntegTestViewsTh(IntegTestViews):
 
 
 class IntegTestViewsNonStoredUsers(IntegTestViews):
+    LIVE_SESSIONS_METRIC = False
+
     @classmethod
     def setUpClass(cls):
         dir_name = os.path.dirname(__file__)
@@ -301,5 +1276,493 @@ class IntegTestViewsNonStoredUsers(IntegTestViews):
         self.assertEqual(len(res.content), 40)
 
 
+class IntegTestViewsShm(IntegTestViews):
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--shm_levels',
+                                            '--store_tokens'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+
+class IntegTestViewsSharded(IntegTestViews):
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--store_shards', '4',
+                                            '--store_tokens'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+
+class IntegTestViewsCompactTokens(IntegTestViews):
+    LIVE_SESSIONS_METRIC = False  # the slots used instead
+
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--store_tokens',
+                                            '--compact_tokens', '--max_users', '4096'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+
+class IntegTestViewsEventLoop(IntegTestViews):
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--event_loop',
+                                            '--store_tokens'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+
+class IntegTestViewsPreForked(IntegTestViews):
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--prefork', '4',
+                                            '--store_tokens'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+
+class IntegTestViewsPreForkedReusePort(IntegTestViews):
+    LIVE_SESSIONS_METRIC = False
+
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--prefork', '4',
+                                            '--reuse_port', '--shm_levels'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    def test_login_ok(self):
+        res = self.login_request(4711)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(res.content), 40)
+
+
+class IntegTestKeepAlive(unittest.TestCase):
+    """
+    integration tests of the persistent connection limits (forked server)
+    """
+    DEFAULT_PORT = '8080'
+    SERVER_ARGS = []
+
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--keep_alive_timeout', '1',
+                                            '--max_requests', '2'] + cls.SERVER_ARGS,
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server_proc.terminate()
+        # kill any zombi manager
+        subprocess.call(
+            """kill -9 `ps aux | grep run_server.py | awk '{printf $2 " "}'` 2>/dev/null""",
+            shell=True)
+
+    def read_until_closed(self, sock):
+        data = ''
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return data
+            data += chunk
+
+    def test_max_requests(self):
+        sock = socket.create_connection(('localhost', int(self.DEFAULT_PORT)), timeout=5)
+        sock.sendall('GET /1/highscorelist HTTP/1.1\r\nHost: localhost\r\n\r\n' * 3)
+        data = self.read_until_closed(sock)
+        sock.close()
+        self.assertEqual(data.count('HTTP/1.1 200 OK'), 2)
+        self.assertEqual(data.count('Connection: keep-alive'), 1)
+        self.assertTrue(data.endswith('Connection: close\r\n\r\n'))
+
+    def test_idle_timeout(self):
+        sock = socket.create_connection(('localhost', int(self.DEFAULT_PORT)), timeout=5)
+        sock.sendall('GET /1/highscorelist HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        start = time.time()
+        data = self.read_until_closed(sock)
+        sock.close()
+        self.assertEqual(data.count('HTTP/1.1 200 OK'), 1)
+        self.assertIn('Connection: keep-alive', data)
+        self.assertGreater(time.time() - start, 0.5)
+
+
+class IntegTestKeepAliveTh(IntegTestKeepAlive):
+    SERVER_ARGS = ['--threaded']
+
+
+class IntegTestKeepAliveEventLoop(IntegTestKeepAlive):
+    SERVER_ARGS = ['--event_loop']
+
+    def test_negative_content_length(self):
+        sock = socket.create_connection(('localhost', int(self.DEFAULT_PORT)), timeout=5)
+        sock.sendall('POST /1/score HTTP/1.1\r\nHost: localhost\r\nContent-Length: -100000\r\n\r\n')
+        data = self.read_until_closed(sock)
+        sock.close()
+        self.assertTrue(data.startswith('HTTP/1.1 400 Bad Request\r\n'))
+        self.assertEqual(data.count('HTTP/1.1 '), 1)
+
+
+class IntegTestIdleConnections(unittest.TestCase):
+    """
+    integration tests, idle keep-alive connections don't hold the workers (pre-forked server)
+    """
+    DEFAULT_PORT = '8080'
+    SERVER_ARGS = ['--prefork', '2']
+
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT] + cls.SERVER_ARGS,
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server_proc.terminate()
+        # kill any zombi manager
+        subprocess.call(
+            """kill -9 `ps aux | grep run_server.py | awk '{printf $2 " "}'` 2>/dev/null""",
+            shell=True)
+
+    def test_idle_clients(self):
+        idle = []
+        for _ in xrange(4):
+            sock = socket.create_connection(('localhost', int(self.DEFAULT_PORT)), timeout=5)
+            sock.sendall('GET /1/highscorelist HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            self.assertTrue(sock.recv(4096).startswith('HTTP/1.1 200 OK'))
+            idle.append(sock)
+        start = time.time()
+        res = requests.get('http://localhost:%s/1/highscorelist' % self.DEFAULT_PORT)
+        elapsed = time.time() - start
+        for sock in idle:
+            sock.close()
+        self.assertEqual(res.status_code, 200)
+        self.assertLess(elapsed, 1)
+
+
+class IntegTestIdleConnectionsTh(IntegTestIdleConnections):
+    SERVER_ARGS = ['--threaded', '--max_proc', '2']
+
+    def test_idle_clients(self):
+        IntegTestIdleConnections.test_idle_clients(self)
+        metrics = requests.get('http://localhost:%s/metrics' % self.DEFAULT_PORT).content
+        self.assertIn('http_server_busy_closed_total ', metrics)
+        self.assertNotIn('http_server_busy_closed_total 0\n', metrics)
+
+
+def concurrent_requests(base_url, clients=40, rounds=20):
+    """
+    Every client thread logs in, then posts a score and reads a high score list per round,
+    returns the unexpected responses (or errors) as (request, status or error) tuples
+    """
+    unexpected = []
+
+    def client(user):
+        session = requests.Session()
+        try:
+            res = session.get(base_url + '/%s/login' % user)
+            if res.status_code != 200:
+                unexpected.append(('login', res.status_code))
+                return
+            session_key = res.content
+            for i in xrange(rounds):
+                level = 400 + i % 5
+                res = session.post(base_url + '/%s/score?sessionkey=%s' % (level, session_key), data=str(user + i))
+                if res.status_code != 204:
+                    unexpected.append(('score', res.status_code))
+                res = session.get(base_url + '/%s/highscorelist' % level)
+                if res.status_code != 200 or not res.content:
+                    unexpected.append(('highscorelist', res.status_code))
+        except requests.RequestException as e:
+            unexpected.append(('error', e))
+
+    threads = [threading.Thread(target=client, args=(1000 + i,)) for i in xrange(clients)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    return unexpected
+
+
+class IntegTestRecovery(unittest.TestCase):
+    """
+    integration test, the server is restarted with the same log (or snapshot)
+    """
+    DEFAULT_PORT = '8080'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.dir, 'scores.log')
+        self.snapshot_path = os.path.join(self.dir, 'scores.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def start_server(self, *args):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        self.server_proc = subprocess.Popen(['python', server_main, '-p', self.DEFAULT_PORT, '--store_tokens'] +
+                                            list(args or ['--wal', self.log_path]),
+                                            shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    def stop_server(self):
+        self.server_proc.terminate()
+        # kill any zombi manager
+        subprocess.call(
+            """kill -9 `ps aux | grep run_server.py | awk '{printf $2 " "}'` 2>/dev/null""",
+            shell=True)
+        time.sleep(0.1)
+
+    def test_restart(self):
+        base_url = 'http://localhost:%s' % self.DEFAULT_PORT
+        self.start_server()
+        try:
+            session_key = requests.get(base_url + '/1003/login').content
+            res = requests.post(base_url + '/300/score?sessionkey=%s' % session_key, data='500')
+            self.assertEqual(res.status_code, 204)
+        finally:
+            self.stop_server()
+
+        self.start_server()
+        try:
+            self.assertEqual(requests.get(base_url + '/300/highscorelist').content, '1003=500')
+            res = requests.post(base_url + '/300/score?sessionkey=%s' % session_key, data='600')
+            self.assertEqual(res.status_code, 204)
+        finally:
+            self.stop_server()
+
+    def test_restart_concurrent(self):
+        base_url = 'http://localhost:%s' % self.DEFAULT_PORT
+        self.start_server()
+        try:
+            session_key = requests.get(base_url + '/1003/login').content
+            requests.post(base_url + '/300/score?sessionkey=%s' % session_key, data='500')
+        finally:
+            self.stop_server()
+
+        # the children forked after the recovery must not share its manager connections
+        self.start_server()
+        try:
+            self.assertEqual(concurrent_requests(base_url), [])
+        finally:
+            self.stop_server()
+
+    def test_restart_snapshot(self):
+        base_url = 'http://localhost:%s' % self.DEFAULT_PORT
+        self.start_server('--snapshot', self.snapshot_path)
+        try:
+            session_key = requests.get(base_url + '/1003/login').content
+            res = requests.post(base_url + '/300/score?sessionkey=%s' % session_key, data='500')
+            self.assertEqual(res.status_code, 204)
+            self.server_proc.send_signal(signal.SIGUSR1)
+            time.sleep(0.3)
+        finally:
+            self.stop_server()
+
+        self.start_server('--snapshot', self.snapshot_path)
+        try:
+            self.assertEqual(requests.get(base_url + '/300/highscorelist').content, '1003=500')
+            res = requests.post(base_url + '/300/score?sessionkey=%s' % session_key, data='600')
+            self.assertEqual(res.status_code, 204)
+            self.assertEqual(requests.get(base_url + '/300/highscorelist').content, '1003=600')
+        finally:
+            self.stop_server()
+
+
+class IntegTestProfiling(unittest.TestCase):
+    """
+    integration test, every request is profiled and the profiles are merged every second
+    """
+    DEFAULT_PORT = '8080'
+    SERVER_ARGS = []
+    MODE = 'forked'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        self.server_proc = subprocess.Popen(['python', server_main, '-p', self.DEFAULT_PORT, '--profile_dir', self.dir,
+                                             '--profile_sample', '1', '--profile_interval', '1'] + self.SERVER_ARGS,
+                                            shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    def tearDown(self):
+        self.server_proc.terminate()
+        self.server_proc.wait()
+        shutil.rmtree(self.dir)
+
+    def test_profiles_per_route(self):
+        base_url = 'http://localhost:%s' % self.DEFAULT_PORT
+        session_key = requests.get(base_url + '/1003/login').content
+        res = requests.post(base_url + '/300/score?sessionkey=%s' % session_key, data='500')
+        self.assertEqual(res.status_code, 204)
+        requests.get(base_url + '/300/highscorelist')
+        requests.get(base_url + '/not/found')
+        time.sleep(1.5)
+
+        self.assertEqual(sorted(os.listdir(self.dir)),
+                         sorted(['%s.%s.prof' % (self.MODE, route)
+                                 for route in ('LoginView', 'ScoreView', 'HighestScoreView', NOT_FOUND)] + ['spool']))
+        functions = set(func for _file, _line, func in
+                        pstats.Stats(os.path.join(self.dir, '%s.ScoreView.prof' % self.MODE)).stats)
+        self.assertIn('post', functions)
+
+
+class IntegTestProfilingTh(IntegTestProfiling):
+    SERVER_ARGS = ['--threaded']
+    MODE = 'threaded'
+
+
+class IntegTestAsyncScores(unittest.TestCase):
+    """
+    integration test, the scores are saved after answering
+    """
+    DEFAULT_PORT = '8080'
+
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--async_scores'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server_proc.terminate()
+        cls.server_proc.wait()
+
+    def test_scores_applied(self):
+        base_url = 'http://localhost:%s' % self.DEFAULT_PORT
+        session_key = requests.get(base_url + '/1003/login').content
+        for score in (500, 700, 600):
+            res = requests.post(base_url + '/310/score?sessionkey=%s' % session_key, data=str(score))
+            self.assertEqual(res.status_code, 204)
+        res = requests.post(base_url + '/310/score?sessionkey=bad', data='800')
+        self.assertEqual(res.status_code, 401)
+
+        for _ in xrange(50):
+            content = requests.get(base_url + '/310/highscorelist').content
+            if content == '1003=700':
+                break
+            time.sleep(0.02)
+        self.assertEqual(content, '1003=700')
+        metrics = requests.get(base_url + '/metrics').content
+        self.assertIn('score_queue_depth 0\n', metrics)
+        self.assertIn('score_queue_enqueued_total 3\n', metrics)
+
+
+class IntegTestRanks(unittest.TestCase):
+    """
+    integration test, ranks beyond the high score lists
+    """
+    DEFAULT_PORT = '8080'
+    SERVER_ARGS = []
+
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--rank_index'] +
+                                           cls.SERVER_ARGS, shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server_proc.terminate()
+        cls.server_proc.wait()
+
+    def test_ranks(self):
+        base_url = 'http://localhost:%s' % self.DEFAULT_PORT
+        session = requests.Session()
+        for user in xrange(1, 21):
+            session_key = session.get(base_url + '/%s/login' % user).content
+            res = session.post(base_url + '/320/score?sessionkey=%s' % session_key, data=str(user * 10))
+            self.assertEqual(res.status_code, 204)
+
+        self.assertEqual(session.get(base_url + '/320/highscorelist').content.count(','), NUM_TOP_SCORES - 1)
+        self.assertEqual(session.get(base_url + '/320/rank/2').content, '19:2=20')
+        self.assertEqual(session.get(base_url + '/320/ranks?from=17&to=19').content, '17:4=40\n18:3=30\n19:2=20')
+        self.assertEqual(session.get(base_url + '/320/ranks?from=20').content, '20:1=10')
+        self.assertEqual(session.get(base_url + '/320/rank/21').status_code, 404)
+        self.assertEqual(session.get(base_url + '/321/ranks').content, '')
+        self.assertEqual(session.get(base_url + '/320/ranks?from=5&to=500').status_code, 400)
+        self.assertEqual(session.get(base_url + '/320/ranks?from=0').status_code, 400)
+
+    def test_concurrent(self):
+        # the index is seeded by the main process, the children forked later must not share its connections
+        self.assertEqual(concurrent_requests('http://localhost:%s' % self.DEFAULT_PORT), [])
+
+
+class IntegTestRanksTh(IntegTestRanks):
+    SERVER_ARGS = ['--threaded']
+
+
+class IntegTestStorageFull(unittest.TestCase):
+    """
+    integration test, scores of new levels once the levels store is full
+    """
+    DEFAULT_PORT = '8080'
+
+    @classmethod
+    def setUpClass(cls):
+        dir_name = os.path.dirname(__file__)
+        server_main = os.path.join(dir_name, 'run_server.py')
+        fnull = open(os.devnull, 'w')
+        cls.server_proc = subprocess.Popen(['python', server_main, '-p', cls.DEFAULT_PORT, '--shm_levels',
+                                            '--max_levels', '2'],
+                                           shell=False, stdout=fnull, stderr=subprocess.STDOUT)
+        time.sleep(0.3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server_proc.terminate()
+        cls.server_proc.wait()
+
+    def test_score(self):
+        base_url = 'http://localhost:%s' % self.DEFAULT_PORT
+        session_key = requests.get(base_url + '/7/login').content
+        for level in (1, 2):
+            res = requests.post(base_url + '/%s/score?sessionkey=%s' % (level, session_key), data='10')
+            self.assertEqual(res.status_code, 204)
+        res = requests.post(base_url + '/3/score?sessionkey=%s' % session_key, data='10')
+        self.assertEqual(res.status_code, 503)
+        res = requests.post(base_url + '/1/score?sessionkey=%s' % session_key, data='20')
+        self.assertEqual(res.status_code, 204)
+        res = requests.post(base_url + '/scores?sessionkey=%s' % session_key, data='2=30\n3=30')
+        self.assertEqual(res.status_code, 503)
+
+
 if __name__ == '__main__':
     unittest.main()
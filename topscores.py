@@ -0,0 +1,63 @@
+"""
+Table of the highest scores of a level, kept sorted as the scores are saved
+"""
+from bisect import bisect_left, insort
+
+NUM_TOP_SCORES = 15
+
+
+class TopScores(object):
+    """
+    Highest score per user, for at most `size` users, in descending score order.
+    Entries are kept as (-score, user) tuples in an ascending sorted list, so the lowest score
+    is always the last entry (evicted in O(1)) and reading the table needs no sort.
+    Ties are broken by the lowest user id.
+    """
+    def __init__(self, size=NUM_TOP_SCORES, items=()):
+        """
+        :param size: max number of users in the table
+        :param items: (user, score) pairs already sorted in descending score order
+        """
+        self.size = size
+        self.keys = [(-score, user) for user, score in items]
+        self.scores = dict(items)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, user, score):
+        """
+        Save the score if it is the highest of the user and it fits in the table,
+        returns True if the table changed
+        """
+        key = (-score, user)
+        old_score = self.scores.get(user)
+        if old_score is not None:
+            if old_score >= score:
+                return False
+            del self.keys[bisect_left(self.keys, (-old_score, user))]
+
+        elif len(self.keys) >= self.size:
+            if key >= self.keys[-1]:
+                return False
+            _lowest_score, lowest_user = self.keys.pop()
+            del self.scores[lowest_user]
+
+        insort(self.keys, key)
+        self.scores[user] = score
+        return True
+
+    def items(self):
+        """
+        (user, score) pairs in descending score order
+        """
+        # slicing copies the list atomically, so threads can read while another one is adding
+        return [(user, -neg_score) for neg_score, user in self.keys[:]]
+
+    # only the sorted entries are pickled (sent to/from the sync manager), the dict is rebuilt
+    def __getstate__(self):
+        return self.size, self.keys
+
+    def __setstate__(self, state):
+        self.size, self.keys = state
+        self.scores = dict((user, -neg_score) for neg_score, user in self.keys)
@@ -1,32 +1,75 @@
-import re
-import urllib2
-from views import LoginView, ScoreView, HighestScoreView
+import urlparse
+from views import (LoginView, ScoreView, BatchScoreView, HighestScoreView, BatchHighestScoreView, RankView,
+                   RankRangeView, MetricsView)
+
+# {name} segments match digits and are passed to the view as keyword arguments,
+# a trailing slash is optional in every route
+ROUTES = [
+    ('/{user_id}/login', LoginView),
+    ('/{level_id}/score', ScoreView),
+    ('/scores', BatchScoreView),
+    ('/{level_id}/highscorelist', HighestScoreView),
+    ('/highscorelists', BatchHighestScoreView),
+    ('/{level_id}/rank/{user_id}', RankView),
+    ('/{level_id}/ranks', RankRangeView),
+    ('/metrics', MetricsView)
+]
+
+# keys of the trie nodes that can't be path segments
+_PARAM = object()
+_VIEW = object()
 
 
 class Urls(object):
     """
-    Match url patterns and get the right view handler
+    Match url patterns and get the right view handler.
+    The routes are compiled once into a trie of path segments, so a path is matched in a single pass
+    (one dictionary lookup per segment) instead of trying every pattern. Literal segments are tried before
+    the {name} ones without backtracking, which is fine as long as literal segments are not digits.
     """
-    def __init__(self):
-        urls = [
-            ('^/(?P<user_id>\d+)/login/?$', LoginView),
-            ('^/(?P<level_id>\d+)/score/?$', ScoreView),
-            ('^/(?P<level_id>\d+)/highscorelist/?$', HighestScoreView)
-        ]
-
-        self.urls = [(re.compile(r), c) for r, c in urls]
+    def __init__(self, routes=ROUTES):
+        # node: {segment: child node, _PARAM: child node, _VIEW: (view class, parameter names)}
+        self.root = {}
+        for route, klass in routes:
+            node = self.root
+            names = []
+            for segment in route.strip('/').split('/'):
+                if segment.startswith('{') and segment.endswith('}'):
+                    names.append(segment[1:-1])
+                    node = node.setdefault(_PARAM, {})
+                else:
+                    node = node.setdefault(segment, {})
+            node[_VIEW] = (klass, names)
 
     def match(self, url):
         """
         If a valid url is found, it returns an initialized view, else None
         """
-        parsed = urllib2.urlparse.urlparse(url)
+        path, _sep, query = url.partition('?')
+        if not path.startswith('/') or ';' in path or '#' in url:
+            # absolute urls, path parameters or fragments (unusual in a request line)
+            parsed = urlparse.urlparse(url)
+            path, query = parsed.path, parsed.query
+
+        segments = path.split('/')
+        if len(segments) > 2 and not segments[-1]:
+            segments.pop()
 
-        for regex, klass in self.urls:
-            res = regex.match(parsed.path)
-            if res:
-                kwargs = res.groupdict()
-                kwargs['query_params'] = urllib2.urlparse.parse_qs(parsed.query)
-                return klass(**kwargs)
+        node = self.root
+        values = []
+        for segment in segments[1:]:
+            child = node.get(segment)
+            if child is None:
+                child = node.get(_PARAM)
+                if child is None or not segment.isdigit():
+                    return None
+                values.append(segment)
+            node = child
 
-        return None
+        view = node.get(_VIEW)
+        if view is None:
+            return None
+        klass, names = view
+        kwargs = dict(zip(names, values))
+        kwargs['query_string'] = query
+        return klass(**kwargs)
@@ -3,10 +3,15 @@ import struct
 import base64
 import hashlib
 import hmac
+import threading
+from collections import OrderedDict
 from abc import ABCMeta, abstractmethod
 
 
 SESSION_KEY_EXPIRATION = 600
+TOKEN_CACHE_SIZE = 10000
+
+_SIGNED_TOKEN = struct.Struct('!II20s')  # user_id, timestamp, sha1 digest
 
 
 class Users(object):
@@ -29,43 +34,74 @@ class Users(object):
         """
         pass
 
+    def stats(self):
+        return {}
+
+    def render(self):
+        """
+        Live sessions of the stores keeping them (see stats), in the Prometheus text format
+        """
+        stats = self.stats()
+        if 'live_sessions' not in stats:
+            return ''
+        return '# TYPE users_live_sessions gauge\nusers_live_sessions %s\n' % stats['live_sessions']
+
 
 class UserTokenSigned(object):
 
     @staticmethod
-    def get(user_id, secret):
+    def keyed_hmac(secret):
+        """
+        HMAC object with the key already processed, to be copied for every token instead of
+        creating a new one (the key padding and the first hash blocks are computed only once)
+        """
+        return hmac.new(secret, digestmod=hashlib.sha1)
+
+    @staticmethod
+    def _digest(keyed_hmac, user_id, timestamp):
+        hash_obj = keyed_hmac.copy()
+        hash_obj.update('%s:%s' % (user_id, timestamp))
+        return hash_obj.digest()
+
+    @staticmethod
+    def get(user_id, secret, keyed_hmac=None):
         """
         Generate a new 224 bits token (encoded in base64) for a given user_id (int)
         user_id (uint32) timestamp(uint32) sha1(160bits)
         """
         timestamp = int(time.time())
-        hash_obj = hmac.new(secret, '%s:%s' % (user_id, timestamp), hashlib.sha1)
-        hash_digest = hash_obj.digest()
+        hash_digest = UserTokenSigned._digest(keyed_hmac or UserTokenSigned.keyed_hmac(secret), user_id, timestamp)
 
-        token = struct.pack('!II20B', user_id, timestamp, *[ord(i) for i in hash_digest])
+        token = _SIGNED_TOKEN.pack(user_id, timestamp, hash_digest)
         b64 = base64.urlsafe_b64encode(token)
         return b64
 
     @staticmethod
-    def validate(b64_token, timeout, secret):
+    def parse(b64_token, secret, keyed_hmac=None):
         """
-        Returns the user_id if the token is valid (correct format and not expired) None otherwise
+        Returns (user_id, timestamp) if the token is correctly signed (not checking its expiration) None otherwise
         """
         try:
-            hex_token = base64.urlsafe_b64decode(b64_token)
-            token_parts = struct.unpack('!II20B', hex_token)
-            user_id = token_parts[0]
-            timestamp = token_parts[1]
-            hash_digest = ''.join(chr(i) for i in token_parts[2:])
-            expected_hash = hmac.new(secret, '%s:%s' % (user_id, timestamp), hashlib.sha1)
-
-            if expected_hash.digest() == hash_digest:
-                now = time.time()
-                if (now - timeout) < timestamp <= now:
-                    return user_id
-        except:
-            pass
+            user_id, timestamp, hash_digest = _SIGNED_TOKEN.unpack(base64.urlsafe_b64decode(b64_token))
+        except (AttributeError, TypeError, ValueError, struct.error):
+            return None
+
+        expected_digest = UserTokenSigned._digest(keyed_hmac or UserTokenSigned.keyed_hmac(secret), user_id, timestamp)
+        if hmac.compare_digest(expected_digest, hash_digest):
+            return user_id, timestamp
+        return None
 
+    @staticmethod
+    def validate(b64_token, timeout, secret, keyed_hmac=None):
+        """
+        Returns the user_id if the token is valid (correct format and not expired) None otherwise
+        """
+        parsed = UserTokenSigned.parse(b64_token, secret, keyed_hmac)
+        if parsed is not None:
+            user_id, timestamp = parsed
+            now = time.time()
+            if (now - timeout) < timestamp <= now:
+                return user_id
         return None
 
 
@@ -76,8 +112,39 @@ class UsersNonStored(Users):
     """
     _key = 'secret_key_dadfgwrhghwhgreqhththwmkwrmrgnwkbjk23e3243dada3d"$%&/()=fagagfg34rf4*z<1fg56&'
 
+    def __init__(self, cache_size=TOKEN_CACHE_SIZE):
+        """
+        :param cache_size: number of validated tokens kept (with their expiration time) so a client posting
+            several scores with the same token only pays the signature check once. The cache is local to
+            the process (a forked per request server doesn't benefit from it), 0 disables it.
+        """
+        self._hmac = UserTokenSigned.keyed_hmac(self._key)
+        self.cache_size = cache_size
+        self.validated = OrderedDict()  # token: (user_id, expiration time), oldest first
+        self.validated_lock = threading.Lock()
+
     def login(self, user_id):
-        return UserTokenSigned.get(user_id, self._key)
+        return UserTokenSigned.get(user_id, self._key, self._hmac)
 
     def validate(self, token):
-        return UserTokenSigned.validate(token, SESSION_KEY_EXPIRATION, self._key)
+        entry = self.validated.get(token)
+        if entry is not None:
+            if time.time() < entry[1]:
+                return entry[0]
+            with self.validated_lock:
+                self.validated.pop(token, None)
+
+        parsed = UserTokenSigned.parse(token, self._key, self._hmac)
+        if parsed is None:
+            return None
+        user_id, timestamp = parsed
+        now = time.time()
+        if not (now - SESSION_KEY_EXPIRATION) < timestamp <= now:
+            return None
+
+        if self.cache_size:
+            with self.validated_lock:
+                if len(self.validated) >= self.cache_size:
+                    self.validated.popitem(last=False)
+                self.validated[token] = (user_id, timestamp + SESSION_KEY_EXPIRATION)
+        return user_id
@@ -1,5 +1,12 @@
+import urlparse
+
 from bootstrap import singletons
 from responses import *
+from shm_levels import StorageFullError
+
+MAX_BATCH_SCORES = 1000
+MAX_BATCH_LEVELS = 100
+MAX_RANK_RANGE = 100
 
 
 class ValidationError(Exception):
@@ -18,12 +25,29 @@ def validate_int(int_str, bit_len):
         raise ValidationError()
 
 
+def render_scores(scores):
+    """
+    dump to a csv with format <userid>=<score>,<userid>=<score>...
+    """
+    return ','.join(['%s=%s' % (user, score) for user, score in scores])
+
+
 class BaseView(object):
     """
     Base View to inherit from, allowed methods must be overridden
     """
+    query_string = ''
+    _query_params = None
+
+    @property
+    def query_params(self):
+        """ the query string is only parsed when the view reads a parameter """
+        if self._query_params is None:
+            self._query_params = urlparse.parse_qs(self.query_string)
+        return self._query_params
+
     def _get_query_param(self, param_name, default=None):
-        """ every query parameter is read as a list in the matcher """
+        """ every query parameter is read as a list """
         param = self.query_params.get(param_name,
                                       [default] if not isinstance(default, list) else default)
         if len(param) == 1:
@@ -49,9 +73,9 @@ class LoginView(BaseView):
     """
     View objects are created per request
     """
-    def __init__(self, user_id, query_params):
+    def __init__(self, user_id, query_string):
         self.user_id = user_id
-        self.query_params = query_params
+        self.query_string = query_string
 
     def get(self, headers, data):
         try:
@@ -59,14 +83,17 @@ class LoginView(BaseView):
         except ValidationError:
             return ResponseBadRequest()
 
-        token = singletons['users'].login(self.user_id)
+        try:
+            token = singletons['users'].login(self.user_id)
+        except StorageFullError:
+            return ResponseServiceUnavailable()
         return Response(200, {}, token)
 
 
 class ScoreView(BaseView):
-    def __init__(self, level_id, query_params):
+    def __init__(self, level_id, query_string):
         self.level_id = level_id
-        self.query_params = query_params
+        self.query_string = query_string
 
     def post(self, headers, data):
         try:
@@ -85,14 +112,58 @@ class ScoreView(BaseView):
         if not user_id:
             return ResponseUnauthorized()
 
-        singletons['levels'].save_score(user_id, self.level_id, score)
+        # with asynchronous ingestion the score is saved after answering, unless the queue is full
+        score_queue = singletons['score_queue']
+        if score_queue is None or not score_queue.put(user_id, self.level_id, score):
+            try:
+                singletons['levels'].save_score(user_id, self.level_id, score)
+            except StorageFullError:
+                return ResponseServiceUnavailable()
         return ResponseNoContent()
 
 
+class BatchScoreView(BaseView):
+    """
+    Save several scores of the session user at once, the body has a <levelid>=<score> line per score.
+    The session is validated once and every valid score is saved in a single store operation.
+    The response has a <levelid>=<status> line per input line (204 if saved, 400 if not valid).
+    """
+    def __init__(self, query_string):
+        self.query_string = query_string
+
+    def post(self, headers, data):
+        lines = [line.strip() for line in (data or '').splitlines()]
+        lines = [line for line in lines if line]
+        if not lines or len(lines) > MAX_BATCH_SCORES:
+            return ResponseBadRequest()
+
+        session_key = self._get_query_param('sessionkey')
+        user_id = singletons['users'].validate(session_key)
+        if not user_id:
+            return ResponseUnauthorized()
+
+        scores = []
+        status = []
+        for line in lines:
+            level_id, _sep, score = line.partition('=')
+            try:
+                scores.append((user_id, validate_int(level_id, 31), validate_int(score, 31)))
+                status.append('%s=%s' % (level_id, ResponseNoContent.code))
+            except ValidationError:
+                status.append('%s=%s' % (level_id, ResponseBadRequest.code))
+
+        if scores:
+            try:
+                singletons['levels'].save_scores(scores)
+            except StorageFullError:
+                return ResponseServiceUnavailable()
+        return Response(200, {}, '\n'.join(status))
+
+
 class HighestScoreView(BaseView):
-    def __init__(self, level_id, query_params):
+    def __init__(self, level_id, query_string):
         self.level_id = level_id
-        self.query_params = query_params
+        self.query_string = query_string
 
     def get(self, headers, data):
         try:
@@ -102,12 +173,127 @@ class HighestScoreView(BaseView):
 
         # user_id (session) is not required
 
-        # dump to a csv with format <userid>=<score>,<userid>=<score>...
-        res = singletons['levels'].get_highest_scores(self.level_id)
-        str_list = []
-        for user, score in res:
-            str_list.append('%s=%s' % (user, score))
-        message = ','.join(str_list)
+        # the version is read before the scores, so a cached list is never older than its version
+        levels = singletons['levels']
+        cache = singletons['highscores_cache']
+        version = levels.get_version(self.level_id)
+        message = cache.get(self.level_id, version)
+        if message is None:
+            message = render_scores(levels.get_highest_scores(self.level_id))
+            if message:
+                cache.put(self.level_id, version, message)
 
         return Response(200, {'Content-Type': 'text/csv'}, message)
 
+
+class BatchHighestScoreView(BaseView):
+    """
+    High score lists of several levels (levels query param, comma separated ids) in one response,
+    with a <levelid>:<high score list csv> line per level.
+    The cached lists are looked up at once and the missing ones are fetched from the store at once.
+    """
+    def __init__(self, query_string):
+        self.query_string = query_string
+
+    def get(self, headers, data):
+        level_ids = (self._get_query_param('levels') or '').split(',')
+        if len(level_ids) > MAX_BATCH_LEVELS:
+            return ResponseBadRequest()
+        try:
+            level_ids = [validate_int(level_id, 31) for level_id in level_ids]
+        except ValidationError:
+            return ResponseBadRequest()
+
+        levels = singletons['levels']
+        cache = singletons['highscores_cache']
+        versions = [levels.get_version(level_id) for level_id in level_ids]
+        messages = cache.get_many(level_ids, versions)
+
+        missing = [i for i, message in enumerate(messages) if message is None]
+        if missing:
+            new_entries = {}
+            scores = levels.get_highest_scores_many([level_ids[i] for i in missing])
+            for i, level_scores in zip(missing, scores):
+                messages[i] = render_scores(level_scores)
+                if messages[i]:
+                    new_entries[level_ids[i]] = (versions[i], messages[i])
+            if new_entries:
+                cache.put_many(new_entries)
+
+        lines = ['%s:%s' % (level_id, message) for level_id, message in zip(level_ids, messages)]
+        return Response(200, {}, '\n'.join(lines))
+
+
+def render_ranks(ranks):
+    """
+    dump (rank, user, score) tuples to lines with format <rank>:<userid>=<score>
+    """
+    return '\n'.join(['%s:%s=%s' % rank for rank in ranks])
+
+
+class RankView(BaseView):
+    """
+    Rank of a user in a level (see --rank_index), with format <rank>:<userid>=<score>.
+    404 if the user has no score in the level or there is no rank index.
+    """
+    def __init__(self, level_id, user_id, query_string):
+        self.level_id = level_id
+        self.user_id = user_id
+        self.query_string = query_string
+
+    def get(self, headers, data):
+        try:
+            self.level_id = validate_int(self.level_id, 31)
+            self.user_id = validate_int(self.user_id, 31)
+        except ValidationError:
+            return ResponseBadRequest()
+
+        ranks = singletons['ranks']
+        rank = ranks.rank(self.level_id, self.user_id) if ranks is not None else None
+        if rank is None:
+            return ResponseNotFound()
+        return Response(200, {}, render_ranks([(rank[0], self.user_id, rank[1])]))
+
+
+class RankRangeView(BaseView):
+    """
+    Users from the rank in the `from` query param to the one in `to` (both included, up to MAX_RANK_RANGE ranks)
+    of a level, with a <rank>:<userid>=<score> line per user (see --rank_index).
+    404 if there is no rank index.
+    """
+    def __init__(self, level_id, query_string):
+        self.level_id = level_id
+        self.query_string = query_string
+
+    def get(self, headers, data):
+        try:
+            self.level_id = validate_int(self.level_id, 31)
+            first = validate_int(self._get_query_param('from', '1'), 31)
+            last = validate_int(self._get_query_param('to', str(first + MAX_RANK_RANGE - 1)), 31)
+        except (ValidationError, TypeError):
+            return ResponseBadRequest()
+        if not 0 < first <= last or last - first >= MAX_RANK_RANGE:
+            return ResponseBadRequest()
+
+        ranks = singletons['ranks']
+        if ranks is None:
+            return ResponseNotFound()
+        return Response(200, {}, render_ranks(ranks.range(self.level_id, first, last)))
+
+
+class MetricsView(BaseView):
+    """
+    Request, connection, lock, sync manager, cache and session metrics of the server (Prometheus text format)
+    """
+    def __init__(self, query_string):
+        self.query_string = query_string
+
+    def get(self, headers, data):
+        data = singletons['metrics'].render()
+        data += singletons['server'].connection_counters.render('http_server')
+        data += singletons['levels'].render()
+        data += singletons['highscores_cache'].render()
+        data += singletons['users'].render()
+        if singletons['score_queue'] is not None:
+            data += singletons['score_queue'].render()
+        return Response(200, {'Content-Type': 'text/plain; version=0.0.4'}, data)
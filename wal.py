@@ -0,0 +1,164 @@
+"""
+Append only log of the saved scores (and logins when the tokens are stored) to recover them after a restart
+"""
+import os
+import logging
+import binascii
+import multiprocessing
+import threading
+
+from counters import Counters
+
+logger = logging.getLogger('storage')
+
+SCORE_RECORD = 'S %s %s %s\n'  # user, level, score
+LOGIN_RECORD = 'L %s %s\n'  # user, hex encoded token
+REPLAY_BATCH = 10000
+
+_fsync = getattr(os, 'fdatasync', os.fsync)
+
+
+class ScoreLog(object):
+    """
+    Records are appended with a single write to a file opened in append mode (before forking,
+    so every process shares it) and a writer returns once its records are on disk.
+
+    Group commit: fsync is serialized by a lock and the log size already on disk is shared, so a writer
+    whose records were covered by the fsync of another writer (done while it was waiting for the lock)
+    returns without calling fsync again. Concurrent writers share a single fsync instead of one per request.
+    """
+    def __init__(self, path, forked=True):
+        """
+        :param path: log file path
+        :param forked: boolean, if True the lock and the synced size are shared between processes,
+            otherwise only between threads.
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        if forked:
+            self.sync_lock = multiprocessing.Lock()
+            self.synced = multiprocessing.RawArray('L', 1)
+        else:
+            self.sync_lock = threading.Lock()
+            self.synced = [0]
+        self.synced[0] = os.fstat(self.fd).st_size
+        self.counters = Counters(['records', 'fsyncs'], forked)
+
+    def append(self, records):
+        """
+        Append the records (lines) and wait until they are durable
+        """
+        os.write(self.fd, ''.join(records))
+        # the offset is shared by every writer, so it is at or after the end of our records
+        end = os.lseek(self.fd, 0, os.SEEK_CUR)
+        self.counters.incr('records', len(records))
+
+        with self.sync_lock:
+            if self.synced[0] >= end:
+                return
+            size = os.fstat(self.fd).st_size
+            _fsync(self.fd)
+            self.synced[0] = size
+            self.counters.incr('fsyncs')
+
+    def close(self):
+        os.close(self.fd)
+
+    def stats(self):
+        return self.counters.as_dict()
+
+
+def recover(path, levels, users=None):
+    """
+    Replay the log into the stores and compact it (rewrite it with only the current top scores and
+    the tokens not expired yet), so the next start replays a log as small as the current state.
+    Records that can't be parsed (e.g. a partial last line) are skipped.
+    """
+    if os.path.exists(path):
+        num_records = 0
+        scores = []
+        with open(path) as log_file:
+            for line in log_file:
+                parts = line.split()
+                try:
+                    if parts[0] == 'S' and len(parts) == 4:
+                        scores.append(tuple(int(part) for part in parts[1:]))
+                    elif parts[0] == 'L' and len(parts) == 3:
+                        if users is not None:
+                            users.restore(int(parts[1]), binascii.unhexlify(parts[2]))
+                    else:
+                        raise ValueError('unknown record')
+                except (ValueError, IndexError, TypeError):
+                    logger.warning('Skipping bad log record: %r', line)
+                    continue
+
+                num_records += 1
+                if len(scores) >= REPLAY_BATCH:
+                    levels.save_scores(scores)
+                    scores = []
+        if scores:
+            levels.save_scores(scores)
+        logger.info('Replayed %s log records from %s', num_records, path)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as log_file:
+        for level, level_scores in levels.dump():
+            log_file.writelines(SCORE_RECORD % (user, level, score) for user, score in level_scores)
+        if users is not None:
+            log_file.writelines(LOGIN_RECORD % (user_id, binascii.hexlify(token)) for user_id, token in users.dump())
+        log_file.flush()
+        os.fsync(log_file.fileno())
+    os.rename(tmp_path, path)
+
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class DurableLevels(object):
+    """
+    Levels store logging the scores that change the top scores before returning,
+    every other method is served by the wrapped store
+    """
+    def __init__(self, levels, log):
+        self.levels = levels
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.levels, name)
+
+    def save_score(self, user, level, score):
+        changed = self.levels.save_score(user, level, score)
+        if changed:
+            self.log.append([SCORE_RECORD % (user, level, score)])
+        return changed
+
+    def save_scores(self, scores):
+        saved = self.levels.save_scores(scores)
+        if saved:
+            self.log.append([SCORE_RECORD % score for score in saved])
+        return saved
+
+    def stats(self):
+        stats = self.levels.stats()
+        stats['log'] = self.log.stats()
+        return stats
+
+
+class DurableUsers(object):
+    """
+    Stored users logging the new tokens before returning them
+    """
+    def __init__(self, users, log):
+        self.users = users
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.users, name)
+
+    def login(self, user_id):
+        token = self.users.login(user_id)
+        self.log.append([LOGIN_RECORD % (user_id, binascii.hexlify(token))])
+        return token